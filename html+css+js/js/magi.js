@@ -20,6 +20,7 @@ var isRunning = false;  // flag to track if assay is currently running
 var wakeLock;
 
 var assayTimer;              // timer for running an assay
+var assayEvents;             // EventSource for server push events during an assay
 var startTime;               // assay start time stamp
 const img = document.getElementById('image');      // chip image
 var imgCaptureTime;                                // time stamp for image
@@ -181,7 +182,7 @@ function enableElements(elements) {
 function disableAllElements() {
 	const allElements = ["load","start","stop","saveraw","adjust","period-slider","analyze",
 								"filter-slider","cut-time-slider", "threshold-slider", 
-                "toggleTTP","savefiltered","saveTTP","getImage","add-rois","reboot",
+                "toggleTTP","savefiltered","saveTTP","getImage","preview","add-rois","reboot",
                 "shutdown","getLog","clearLog"];
 	allElements.forEach(e => document.getElementById(e).disabled = true);
 }
@@ -215,7 +216,7 @@ window.onload = async function () {
     'red-gain': redGain,
     'blue-gain': blueGain
   });
-  enableElements(["load","adjust","shutdown","reboot","getImage","getLog","clearLog"]);
+  enableElements(["load","adjust","shutdown","reboot","getImage","preview","getLog","clearLog"]);
   // set up arrow key adjustments for sliders:
   sliderKeySetup('cut-time-slider','cut-time-slider-text');    
   sliderKeySetup('threshold-slider','threshold-slider-text'); 
@@ -369,7 +370,7 @@ document.getElementById('hidden-card-file-input').addEventListener('change', asy
           log(results);
           // Display & dim initial empty charts:
           if (filteredChart == null) {   // filteredChart has not yet been displayed,
-            displayFilteredData([[]]);}  // so display chart with empty data
+            displayFilteredData([], []);}  // so display chart with empty data
           dimChart(filteredChart);
           displayTTPGrouped();
           dimChart(ttpChartGrouped);
@@ -596,7 +597,7 @@ async function startPID() {
 	log("startPID() called");
 	wakeLock = getWakeLock();     // Acquire wake lock when assay starts
 	let message = 'start';
-	let data = '';
+	let data = {'period': document.getElementById('period-slider').value};  // server-side sampling period (s)
 	let response = await queryServer(JSON.stringify([message,data]));
   if (response.ok) {
 		results = await response.text();
@@ -618,6 +619,10 @@ async function endAssay() {
     log("wake lock released");
   	disableElements(["stop"]);
     isRunning = false;             // flip the flag to stop the assay
+    if (assayEvents) {
+      assayEvents.close();         // stop server push events
+      assayEvents = null;
+    }
     toggleTitleBarAnimation();     // turn off title bar animation
 		// if (assayTimer) clearInterval(assayTimer);
 	  enableElements(["load","start","period-slider"]);
@@ -664,6 +669,22 @@ async function getImageData() {
   }
 }
 
+// Get all samples captured by the server since the given sample index:
+async function getSamples(since) {
+  try {
+    let message = 'getSamples';
+    let data = {'since': since};
+    let response = await queryServer(JSON.stringify([message,data]));
+    if (response.ok) {
+      results = await response.text();
+      return(JSON.parse(results));   // [{index, t, time, values}, ...]
+    }
+  } catch(e) {
+    log(`Error in getSamples: ${e}`, color=logErrorColor, fontsize=7, bold=false, lines=true);
+  }
+  return([]);
+}
+
 async function getTemperature() {
   try {
     let message = 'getTemperature';
@@ -682,22 +703,46 @@ async function getTemperature() {
 
 
 
-// Get an image, optionally with ROIs added (if checkbox selected):
+// Get an image, optionally with ROIs added (if checkbox selected). The image
+// is loaded directly from the server's /image endpoint as raw bytes:
 async function getImage() {
 	log("getImage() called");
+  stopPreview();
   document.getElementById('image').style.backgroundColor = 'white';
-	let message = 'getImage';
-  let data = document.getElementById('add-rois').checked;  // status of checkbox to show ROIs in image
-  let response = await queryServer(JSON.stringify([message,data]));
-  if (response.ok) {
-		results = await response.text();
+  let rois = document.getElementById('add-rois').checked ? 1 : 0;  // status of checkbox to show ROIs in image
+  img.crossOrigin = "anonymous";  // served cross-origin; keeps the canvas in unscaledImage() readable
+  img.src = `${serverURL}/image?rois=${rois}&format=png&t=${Date.now()}`;
+  try {
+    await img.decode();             // wait until the image has been received
 		log("Image data received", color=logOkColor, fontsize=null, bold=false, lines=false);
-		const base64Image = results;
-		// Display the image:
-		img.src = base64Image;
     imgCaptureTime = ((Date.now()-startTime)/1000/60).toFixed(2);
     img.style.backgroundImage = "linear-gradient(#464d55, #25292e)"; // change background on image load
-	}
+  } catch (e) {
+    log(`Error in getImage: ${e}`, color=logErrorColor, fontsize=7, bold=false, lines=true);
+  }
+}
+
+
+// Toggle a live (MJPEG) preview of the chip for focusing and ROI alignment:
+let previewRunning = false;
+function togglePreview() {
+  if (previewRunning) {
+    getImage();   // stops the preview and shows a still image
+    return;
+  }
+	log("Live preview started");
+  let rois = document.getElementById('add-rois').checked ? 1 : 0;
+  img.crossOrigin = "anonymous";
+  img.src = `${serverURL}/preview.mjpg?rois=${rois}&t=${Date.now()}`;
+  previewRunning = true;
+  document.getElementById('preview').innerHTML = "Stop Preview";
+}
+function stopPreview() {
+  if (previewRunning) {
+    img.src = "";   // closes the stream connection
+    previewRunning = false;
+    document.getElementById('preview').innerHTML = "Live Preview";
+  }
 }
 
 
@@ -829,12 +874,12 @@ async function analyzeData() {
 	let response = await queryServer(JSON.stringify([message,data]));
 	if (response.ok) {
 		results = await response.text();
-    // results format: {'ttp': ttp, 'y_filt': y_filtered}
-    // where ttp is a list of TTP values for each well, and
-    // y_filtered is a list of data with format:
-    //   [ [{x: t1, y: val1}, {x: t2, y: val2}, ...]  <- well 1
-    //    [{x: t1, y: val1}, {x: t2, y: val2}, ...]  <- well 2
-    //     ... ]                                     <- etc
+    // results format (column oriented): {'ttp': ttp, 't': t, 'y': y}
+    // where ttp is a list of TTP values for each well, t is the list of
+    // sample times (min), and y is the list of filtered curves:
+    //   [ [val1, val2, ...]   <- well 1
+    //     [val1, val2, ...]   <- well 2
+    //      ... ]              <- etc
 		log("Server response: ");
 		if (results) { 
 		  // Check for NaN in filter results, which seems to happen when the
@@ -847,9 +892,8 @@ async function analyzeData() {
 		  else {
         let filteredData = JSON.parse(results);
         ttpValues = filteredData['ttp'];   // ttpValues is global (for plotting)
-        let xy = filteredData['y_filt'];
-        log(`Filter data length = ${xy.length}`);
-		    displayFilteredData(xy);
+        log(`Filter data length = ${filteredData['y'].length}`);
+		    displayFilteredData(filteredData['t'], filteredData['y']);
 				displayTTPGrouped();
 			  enableElements(["savefiltered","toggleTTP","saveTTP"]);
         log("Analysis complete",
@@ -944,7 +988,7 @@ async function reboot() {
     // try reloading after reboot
     await ping();
     await getImage(); 
-    enableElements(["load","adjust","shutdown","reboot","getImage","getLog","clearLog"]);
+    enableElements(["load","adjust","shutdown","reboot","getImage","preview","getLog","clearLog"]);
 	}
 	else {
 		log("reboot cancelled", color=logInfoColor, fontsize=null, bold=false, lines=false
@@ -953,18 +997,18 @@ async function reboot() {
 }
 
 
-// Show server log:
+// Show server log (the last lines; the server returns one page at a time):
 async function getServerLog() {
 	log("getServerLog() called");
 	let message = 'getLog';
-  let data = '';
+  let data = {'lines': 200};
 	let response = await queryServer(JSON.stringify([message,data]));
   if (response.ok) { 
-		let responseText = await response.text();
-		responseText = responseText.replace(/\\n/g, "<br>");  // repace newline with html break
-		responseText = responseText.replace(/^"|"$/g, '');    // strip double quotes @ start and end
+		let results = await response.json();
+		let logText = results.text.replace(/\n/g, "<br>");  // replace newline with html break
 		log("Start Server Log", color="#fff", fontSize=9, bold=false, lines=true);
-		log(responseText, color="#fff", fontSize=8, bold=true); 
+		log(logText, color="#fff", fontSize=8, bold=true); 
+		log(`Log file size: ${(results.size/1e6).toFixed(2)} MB`, color="#fff", fontSize=8, bold=false);
     log("End Server Log", color="#fff", fontSize=9, bold=false, lines=true);
 	} 
 }
@@ -1196,6 +1240,7 @@ function dimChart(chart) {
 // Start a new assay:
 async function startAssay() {
 	log("startAssay() called");
+  stopPreview();   // the preview would flash the LED between samples
 	log(`Starting assay with ${cardFilename}`, color="#fff", fontSize=9, bold=false, lines=true);
   // Update interface elements appropriately:
   document.getElementById("toggleTTP").innerHTML = "Show All Wells";  // Always start with grouped TTP values
@@ -1241,25 +1286,35 @@ async function startAssay() {
   nullData = await startPID();    // Tell Python to start the PID controller
   toggleTitleBarAnimation();      // turn on title bar animation once PID starts
 
+  // Samples are captured on the server's clock:
+  let nextSample = 0;
+  function addSample(sample) {
+    if (sample.index < nextSample) return;   // already plotted
+    log(`sample ${sample.index} @ t = ${(sample.t/60).toFixed(2)} min`);
+    // extend the amplification curve data:
+    for (let j=0; j<wellArray.length; j++) {
+      wellArray[j].push({
+        x: sample.t/60,
+        y: sample.values[j]
+      });
+    }
+    nextSample = sample.index + 1;
+  }
+
+  // Poll for new samples (used if the push channel is unavailable):
   async function updateAmplificationChart() {
     if (!isRunning) {
       //log("Assay stopped", color=logInfoColor, fontsize=null, bold=false, lines=false);
       return;
     }
-    let now = Date.now();   
-    minutes = (now - startTime)/1000/60;
-    newData = await getImageData();      // Get data from Python
-      // extend the amplification curve data:
-    for (let j=0; j<wellArray.length; j++) {
-      wellArray[j].push({
-        x: minutes,
-        y: newData[j]
-      });
-    }
+    let samples = await getSamples(nextSample);   // Get data from Python
+    samples.forEach(addSample);
     // Update the real-time amplification curve:
-    amplificationChart.render();
-    var sampleInterval = document.getElementById('period-slider').value * 1000;
-    setTimeout(updateAmplificationChart, sampleInterval);   // Execute again with given periodicity
+    if (samples.length > 0) {
+      amplificationChart.render();
+    }
+    var pollInterval = Math.min(document.getElementById('period-slider').value * 1000, 2000);
+    setTimeout(updateAmplificationChart, pollInterval);   // Poll again for new samples
   }
 
   async function updateTemperatureChart() {
@@ -1281,19 +1336,53 @@ async function startAssay() {
     setTimeout(updateTemperatureChart, temperatureInterval);   // Execute again with given periodicity
   }
 
-  updateAmplificationChart();
-  updateTemperatureChart();
+  // Subscribe once to the server push channel for samples, temperatures and
+  // status events, falling back to polling without EventSource support:
+  if (window.EventSource) {
+    assayEvents = new EventSource(serverURL + '/events?since=0');
+    assayEvents.addEventListener('sample', (e) => {
+      addSample(JSON.parse(e.data));
+      amplificationChart.render();
+    });
+    assayEvents.addEventListener('temperature', (e) => {
+      let T = JSON.parse(e.data);
+      temperature.push({
+        x: T.t/60,
+        y: T.temperature
+      });
+      temperatureChart.render();
+    });
+    assayEvents.addEventListener('well', (e) => {     // provisional TTP from online analysis
+      let w = JSON.parse(e.data);
+      log(`Well ${w.well+1} (${w.gene}) amplified: provisional TTP = ${w.ttp.toFixed(2)} min`,
+        color=logOkColor, fontsize=7, bold=false, lines=false);
+    });
+    assayEvents.addEventListener('call', (e) => {     // early hit call from online analysis
+      let c = JSON.parse(e.data);
+      log(`${c.target}: ${c.status}${c.provisional ? ' (provisional)' : ''} @ t = ${c.t.toFixed(2)} min`,
+        color=logInfoColor, fontsize=null, bold=true, lines=true);
+    });
+    assayEvents.addEventListener('status', (e) => {
+      log(`Server status: ${JSON.parse(e.data).state}`, color=logInfoColor, fontsize=7, bold=false, lines=false);
+    });
+  }
+  else {
+    updateAmplificationChart();
+    updateTemperatureChart();
+  }
 }
 
 
 
-async function displayFilteredData(data) {
+// Chart filtered curves y (one array per well) at times t (min):
+async function displayFilteredData(t, y) {
 	let wellArray;
 	[filteredChart, wellArray] = setupAmplificationChart('filteredDataChart');
 	filteredChart.options.title.text = "Fluorescence (filtered)";
-	for (let i=0; i<wellArray.length; i++) {
-		for (let j=0; j<data[0].length; j++) {
-			wellArray[i].push(data[i][j]);
+	for (let i=0; i<Math.min(wellArray.length, y.length); i++) {
+		let well = y[i];
+		for (let j=0; j<t.length; j++) {
+			wellArray[i].push({x: t[j], y: well[j]});
 		}
 	}
 	filteredChart.render();
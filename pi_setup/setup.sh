@@ -31,7 +31,9 @@ echo "==========================================="
 crontab -r
 CRON_SCHEDULE="@reboot"
 CURRENT_USER=$(logname)
-COMMAND="cd /home/$CURRENT_USER/magi && python3 -u /home/$CURRENT_USER/magi/magi_server.py >> /home/$CURRENT_USER/magi/magi_server.log 2>&1"
+# The server writes (and rotates) magi_server.log itself; stdout/stderr only
+# catch errors before logging is set up:
+COMMAND="cd /home/$CURRENT_USER/magi && python3 -u /home/$CURRENT_USER/magi/magi_server.py > /home/$CURRENT_USER/magi/magi_server.out 2>&1"
 CRON_ENTRY="$CRON_SCHEDULE $COMMAND"
 # Check if the cron job already exists:
 (sudo -u "$CURRENT_USER" crontab -l 2>/dev/null | grep -Fxq "$CRON_ENTRY") || {
@@ -69,11 +71,6 @@ echo "libcamera (SHOULD BE PREINSTALLED -- UNCOMMENT IF NEEDED)"
 echo "==========================================="
 # sudo apt-get --yes install python3-libcamera
 
-echo "==========================================="
-echo "matplotlib"
-echo "==========================================="
-sudo apt-get --yes install python3-matplotlib
-
 echo "==========================================="
 echo "numpy"
 echo "==========================================="
@@ -0,0 +1,88 @@
+# Server-side acquisition scheduler
+#
+# Captures ROI data on a fixed monotonic clock in a background thread and
+# buffers the samples in memory, so sample timing no longer depends on the
+# client. Clients fetch all samples since a given index with samples_since().
+
+import threading
+import time
+import math
+import logging
+
+import imager
+import online
+import events
+import config   # Cross-module global variables for all Python codes
+from config import log_function_call
+
+log = logging.getLogger('magi.acquisition')
+
+samples = []            # [{'index': i, 't': sec since start, 'time': unix time, 'values': [...]}, ...]
+samples_lock = threading.Lock()
+period = 15.0           # sampling period (s)
+missed = 0              # number of sample slots skipped because a capture overran
+start_time = 0.0        # unix time of the first sample
+stop_event = threading.Event()
+thread = None
+
+# Capture samples every `period` seconds until stop_event is set:
+@log_function_call
+def run(stop_event, period):
+    global missed
+    t_start = time.monotonic()
+    t_next = t_start
+    index = 0
+    while not stop_event.is_set():
+        t_sample = time.monotonic()
+        values = imager.get_image_data()
+        if isinstance(values, list):      # get_image_data() returns a string on error
+            sample = {'index': index, 't': t_sample - t_start,
+                      'time': start_time + (t_sample - t_start), 'values': values}
+            with samples_lock:
+                samples.append(sample)
+            events.publish('sample', sample, event_id=index)
+            index += 1
+            if config.online_analysis:
+                try:
+                    online.update(sample['t'], values)
+                except Exception as e:
+                    log.exception(f'Exception in online.update(): {e}')
+        t_next += period
+        now = time.monotonic()
+        if now > t_next:                  # capture overran one or more slots
+            skipped = math.ceil((now - t_next)/period)
+            missed += skipped
+            t_next += skipped*period
+            log.warning(f'skipped {skipped} sample slot(s)')
+        stop_event.wait(t_next - now)
+
+# Start sampling in a background thread:
+@log_function_call
+def start(sample_period):
+    global thread, period, missed, start_time, samples
+    stop()
+    with samples_lock:
+        samples = []
+    period = float(sample_period)
+    missed = 0
+    start_time = time.time()
+    if config.online_analysis:
+        online.reset(len(config.ROIs), period)
+    stop_event.clear()
+    thread = threading.Thread(target=run, args=(stop_event, period))
+    thread.daemon = True
+    thread.start()
+
+# Stop sampling and wait for an in-progress capture to finish:
+@log_function_call
+def stop():
+    global thread
+    stop_event.set()
+    if thread is not None:
+        thread.join()
+        thread = None
+
+# Return all samples with index >= since:
+def samples_since(since=0):
+    with samples_lock:
+        return(samples[max(int(since), 0):])
@@ -0,0 +1,196 @@
+# Staged analysis of run data with a result cache, and batch analysis
+#
+# filter_curves.filter() parses the run data, filters all wells, applies
+# the threshold and fits the TTPs on every call, although the client
+# usually changes one slider at a time. Here the stages are cached
+# separately, keyed by a hash of the file contents and the parameters the
+# stage depends on:
+#
+#   data      - parsed run data                     (content)
+#   filtered  - cut, repaired, filtered & normed    (content, cut_time, filter_factor)
+#   results   - thresholded curves and TTPs         (+ threshold)
+#
+# so a threshold change reuses the filtered curves (and their TTPs) and a
+# cut_time or filter_factor change reuses the parsed data. The caches are
+# LRU with config.analysis_cache_size entries each.
+#
+# analyze_directory() analyzes all runs in a directory (e.g. for
+# re-analysis with new parameters) with a pool of worker processes. It can
+# be run from the command line:
+#
+#   python3 analysis.py DIRECTORY [--filter-factor F] [--cut-time T]
+#                                 [--threshold N] [--processes P] [--card CARD]
+#                                 [--output FILE]
+
+import os
+import sys
+import csv
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import filter_curves
+import assay_card
+import metrics
+import config   # Cross-module global variables for all Python codes
+from config import log_function_call
+
+cache_lock = threading.Lock()
+data_cache = OrderedDict()        # content hash -> run data
+filtered_cache = OrderedDict()    # (hash, num_wells, cut_time, filter_factor) -> (t, y, yf_norm, ttp)
+results_cache = OrderedDict()     # (..., threshold) -> (t, yf_norm, ttp) after thresholding
+file_hashes = {}                  # (path, size, mtime) -> content hash
+cache_lookups = metrics.counter('magi_analysis_cache_lookups_total', 'Analysis stage cache lookups',
+                                label='result')
+
+# Hash of the contents of the file holding the data of a run. Hashes are
+# remembered per file size & modification time, so a file is only read
+# again when it has changed:
+def content_hash(filename):
+    path = os.path.realpath(filter_curves.data_file(filename))
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    digest = file_hashes.get(key)
+    if digest is None:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        digest = h.hexdigest()
+        with cache_lock:
+            file_hashes[key] = digest
+    return(digest)
+
+# Return cache[key], computing (outside the lock) and storing it if missing:
+def cached(cache, key, compute):
+    with cache_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            value = cache[key]
+        else:
+            value = None
+    if value is not None:
+        cache_lookups.inc(label='hit')
+        return(value)
+    cache_lookups.inc(label='miss')
+    value = compute()
+    with cache_lock:
+        cache[key] = value
+        while len(cache) > config.analysis_cache_size:
+            cache.popitem(last=False)
+    return(value)
+
+def clear_cache():
+    with cache_lock:
+        for cache in (data_cache, filtered_cache, results_cache, file_hashes):
+            cache.clear()
+
+# Cut, repaired, filtered & normed curves of a run, and their TTPs before
+# thresholding:
+def filter_stage(data, num_wells, cut_time, filter_factor):
+    t, y = filter_curves.cut_data(data, cut_time, num_wells)
+    yf_norm = filter_curves.smooth(t, y, filter_factor)
+    return(t, y, yf_norm, filter_curves.get_ttps(t, yf_norm))
+
+# Times (min), thresholded curves (samples x wells) and TTPs of a run,
+# from the caches where possible. num_wells defaults to the wells of the card:
+def analyze_curves(filename, filter_factor=10.0, cut_time=0.0, threshold=0, num_wells=None):
+    if num_wells is None:
+        num_wells = len(config.well_config) * len(config.well_config[0])  # rows * cols
+    digest = content_hash(filename)
+    key = (digest, num_wells, cut_time, filter_factor)
+
+    def compute_results():
+        data = cached(data_cache, digest, lambda: filter_curves.load_data(filename))
+        t, y, yf_norm, ttp = cached(filtered_cache, key,
+                                    lambda: filter_stage(data, num_wells, cut_time, filter_factor))
+        yf_norm, ttp = filter_curves.apply_threshold(t, y, yf_norm, threshold, ttp)
+        return(t, yf_norm, ttp)
+
+    return(cached(results_cache, key + (threshold,), compute_results))
+
+# Same results as filter_curves.filter(), from the caches where possible:
+@log_function_call
+@metrics.timed(filter_curves.stage_seconds, 'analyze')
+def analyze(filename, filter_factor=10.0, cut_time=0.0, threshold=0, num_wells=None):
+    return(filter_curves.format_results(*analyze_curves(filename, filter_factor, cut_time,
+                                                         threshold, num_wells)))
+
+# Run files in a directory (sample logs, and CSV files without a sample
+# log), excluding the files written by the analysis & temperature logging:
+def run_files(directory):
+    names = sorted(os.listdir(directory))
+    runs = []
+    for name in names:
+        base, ext = os.path.splitext(name)
+        if base.startswith('temp_data') or base.endswith(('_filt', '_temp', '_ttp')):
+            continue
+        if ext == '.magi' or (ext == '.csv' and base + '.magi' not in names):
+            runs.append(os.path.join(directory, name))
+    return(runs)
+
+# TTPs of all wells of one run (worker process):
+def analyze_run(args):
+    (filename, filter_factor, cut_time, threshold) = args
+    try:
+        data = filter_curves.load_data(filename)
+        t, y = filter_curves.cut_data(data, cut_time, data.shape[1] - 1)
+        yf_norm = filter_curves.smooth(t, y, filter_factor)
+        yf_norm, ttp = filter_curves.apply_threshold(t, y, yf_norm, threshold)
+        return({'ttp': ttp.tolist()})
+    except Exception as e:
+        return({'error': f'{type(e).__name__}: {e}'})
+
+# Analyze all runs in a directory with `processes` worker processes
+# (default: one per CPU). Returns {run name: {'ttp': [..]} or {'error': ..}}.
+# With a compiled card (assay_card.Card), the positive targets of all runs
+# with the card's wells are added as 'hits', classified in one operation:
+@log_function_call
+def analyze_directory(directory, filter_factor=10.0, cut_time=0.0, threshold=0, processes=None, card=None):
+    files = run_files(directory)
+    jobs = [(f, float(filter_factor), float(cut_time), int(threshold)) for f in files]
+    names = [os.path.splitext(os.path.basename(f))[0] for f in files]
+    if processes == 1 or len(jobs) <= 1:
+        results = list(map(analyze_run, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(analyze_run, jobs, chunksize=max(1, len(jobs)//32)))
+    if card is not None:
+        runs = [r for r in results if len(r.get('ttp', [])) == card.num_wells]
+        if runs:
+            positive = card.classify(np.array([r['ttp'] for r in runs]))   # runs x targets
+            for (r, hits) in zip(runs, positive):
+                r['hits'] = [target for (target, hit) in zip(card.targets, hits) if hit]
+    return(dict(zip(names, results)))
+
+# Write batch results as CSV: run, error, positive targets, TTP per well:
+def write_summary(results, filename):
+    num_wells = max((len(r.get('ttp', [])) for r in results.values()), default=0)
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['run', 'error', 'hits'] + [f'well {i}' for i in range(num_wells)])
+        for (name, r) in results.items():
+            writer.writerow([name, r.get('error', ''), ' '.join(r.get('hits', []))] + r.get('ttp', []))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Analyze all MAGI runs in a directory')
+    parser.add_argument('directory')
+    parser.add_argument('--filter-factor', type=float, default=10.0)
+    parser.add_argument('--cut-time', type=float, default=0.0)
+    parser.add_argument('--threshold', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--card', default=None, help='assay card file: classify the runs by its hit criteria')
+    parser.add_argument('--output', default=None, help='summary CSV (default: DIRECTORY/batch_ttp.csv)')
+    args = parser.parse_args()
+    card = assay_card.load(args.card) if args.card else None
+    results = analyze_directory(args.directory, args.filter_factor, args.cut_time,
+                                args.threshold, args.processes, card)
+    output = args.output or os.path.join(args.directory, 'batch_ttp.csv')
+    write_summary(results, output)
+    errors = sum('error' in r for r in results.values())
+    print(f'{len(results)} runs analyzed ({errors} errors), summary: {output}', flush=True)
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,161 @@
+# Compiled assay card
+#
+# A card (a .card file: well_config, ROI geometry and hit_criteria) is
+# compiled once into arrays, so nothing is looked up per well afterwards:
+#
+#   x, y         ROI upper left corners, one per well (well_config rows in order)
+#   gene_index   index into genes of the gene in each well
+#   membership   (genes x wells) 0/1 matrix of the wells of each gene
+#   colors       (genes x 4) RGBA ROI fill color of each gene
+#   rules        (targets x genes) hit rule matrix compiled from hit_criteria:
+#                +1 the gene must amplify, -1 it must not, 0 not in the rule
+#
+# A gene amplified if the mean TTP of its wells is in (0.1, 50) min (as in
+# the client). classify() evaluates every panel (e.g. MRSA, MSSA) for one
+# or many runs in one operation.
+#
+# Compiled cards are cached by a hash of the card contents (with the gene
+# names & colors sent by the client), so loading the same card again is a
+# dictionary lookup.
+
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import config   # Cross-module global variables for all Python codes
+from config import log_function_call
+
+cache = OrderedDict()     # content hash -> Card
+cache_size = 16
+cache_lock = threading.Lock()
+
+def hex_to_rgba(h, alpha=64):   # convert "#rrggbb" to (R,G,B,alpha)
+    return tuple(int(h[i:i+2], 16) for i in (1, 3, 5)) + (alpha,)
+
+class Card:
+    def __init__(self, card_dict, filename='', gene_names=None, gene_colors=None):
+        self.filename = filename
+        self.well_config = [[str(gene) for gene in row] for row in card_dict['well_config']]
+        self.rows, self.cols = len(self.well_config), len(self.well_config[0])
+        self.wells = [gene for row in self.well_config for gene in row]
+        self.num_wells = len(self.wells)
+        self.roi_upper_left = tuple(int(val) for val in card_dict['roi_upper_left'])
+        self.roi_width = int(card_dict['roi_width'])
+        self.roi_height = int(card_dict['roi_height'])
+        self.roi_spacing_x = int(card_dict['roi_spacing_x'])
+        self.roi_spacing_y = int(card_dict['roi_spacing_y'])
+        row, col = np.divmod(np.arange(self.num_wells), self.cols)
+        self.x = self.roi_upper_left[0] + self.roi_spacing_x*col
+        self.y = self.roi_upper_left[1] + self.roi_spacing_y*row
+        # Genes: the client's order (matching its colors), then genes in
+        # wells in order of appearance, then any genes only named in the hit
+        # criteria (no wells: never amplified):
+        self.hit_criteria = card_dict.get('hit_criteria', {})
+        genes = list(gene_names or []) + self.wells
+        for criteria in self.hit_criteria.values():
+            genes += list(criteria)
+        genes = self.genes = list(dict.fromkeys(genes))
+        self.gene_lut = {gene: i for (i, gene) in enumerate(genes)}
+        self.gene_index = np.array([self.gene_lut[gene] for gene in self.wells])
+        self.membership = np.zeros((len(genes), self.num_wells))
+        self.membership[self.gene_index, np.arange(self.num_wells)] = 1
+        self.wells_per_gene = self.membership.sum(axis=1)
+        self.gene_colors = list(gene_colors) if gene_colors else []
+        self.colors = np.array([hex_to_rgba(self.gene_colors[i]) if i < len(self.gene_colors)
+                                else (255, 255, 255, 64) for i in range(len(genes))], dtype=np.uint8)
+        self.fill_colors = [tuple(color) for color in self.colors.tolist()]
+        self.targets = list(self.hit_criteria)
+        self.rules = np.zeros((len(self.targets), len(genes)), dtype=np.int8)
+        for (t, criteria) in enumerate(self.hit_criteria.values()):
+            for (gene, amplifies) in criteria.items():
+                self.rules[t, self.gene_lut[gene]] = 1 if amplifies else -1
+        self.roi_list = [{'target': gene, 'x': int(x), 'y': int(y)}
+                         for (gene, x, y) in zip(self.wells, self.x, self.y)]
+
+    # ROIs as the list of dicts used by config.ROIs:
+    def rois(self):
+        return(self.roi_list)
+
+    # Mean TTP of each gene for TTPs (..., wells); NaN for genes without wells:
+    def gene_means(self, ttp):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return((np.asarray(ttp, dtype=float) @ self.membership.T)/self.wells_per_gene)
+
+    # Gene amplification (..., genes) for TTPs (..., wells):
+    def amplified(self, ttp):
+        means = self.gene_means(ttp)
+        with np.errstate(invalid='ignore'):
+            return((means > 0.1) & (means < 50))
+
+    # Positive (True) or not for every target (..., targets), from per-gene
+    # amplification (..., genes):
+    def classify_genes(self, amplified):
+        amplified = np.asarray(amplified, dtype=bool)[..., None, :]
+        violated = ((self.rules > 0) & ~amplified) | ((self.rules < 0) & amplified)
+        return(~violated.any(axis=-1))
+
+    # Positive or not for every target, from TTPs of one run (wells,) or of
+    # many runs (runs x wells):
+    def classify(self, ttp):
+        return(self.classify_genes(self.amplified(ttp)))
+
+    # Positive targets of one run:
+    def hits(self, ttp):
+        return([target for (target, hit) in zip(self.targets, self.classify(ttp)) if hit])
+
+    # Provisional calls while an assay runs, from the genes known to have
+    # amplified so far. A gene that has not amplified is only known not to
+    # once `decided`. Returns (status, final) per target, with status
+    # 'positive', 'negative' or 'pending':
+    def evaluate(self, amplified, decided):
+        amplified = np.asarray(amplified, dtype=bool)
+        required, excluded = self.rules > 0, self.rules < 0
+        negative = (excluded & amplified).any(axis=1)
+        missing = (required & ~amplified).any(axis=1)
+        if decided:
+            negative |= missing
+        pending = ~negative & missing
+        final = negative | decided | ~(required | excluded)[:, ~amplified].any(axis=1)
+        status = np.where(negative, 'negative', np.where(pending, 'pending', 'positive'))
+        return(status, final)
+
+def content_key(*parts):
+    return(hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest())
+
+# Compiled card for card data (cached):
+@log_function_call
+def compile_card(card_dict, filename='', gene_names=None, gene_colors=None):
+    key = content_key(card_dict, filename, gene_names, gene_colors)
+    with cache_lock:
+        card = cache.get(key)
+        if card is None:
+            card = cache[key] = Card(card_dict, filename, gene_names, gene_colors)
+            while len(cache) > cache_size:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+    return(card)
+
+# Compiled card from a .card file:
+def load(filename, gene_names=None, gene_colors=None):
+    with open(filename) as f:
+        card_dict = json.load(f)
+    return(compile_card(card_dict, filename.split('/')[-1], gene_names, gene_colors))
+
+# Make `card` the card of the current assay, updating the config.py globals
+# derived from it:
+def apply(card):
+    config.card = card
+    config.card_filename = card.filename
+    config.well_config = card.well_config
+    config.roi_upper_left = card.roi_upper_left
+    config.roi_width = card.roi_width
+    config.roi_height = card.roi_height
+    config.roi_spacing_x = card.roi_spacing_x
+    config.roi_spacing_y = card.roi_spacing_y
+    config.positives = card.hit_criteria
+    config.gene_names = card.genes
+    config.gene_colors = card.gene_colors
@@ -0,0 +1,923 @@
+# MAGI benchmark suite
+#
+# Runs off-Pi on the simulated hardware backends (see hardware.py) with
+# synthetic data, and reports latency (mean/p50/p99), throughput and peak
+# Python memory for each hot path, e.g.:
+#   python3 benchmarks.py                          # run all benchmarks
+#   python3 benchmarks.py roi filter               # run selected benchmarks
+#   python3 benchmarks.py --save baseline.json     # save results
+#   python3 benchmarks.py --compare baseline.json  # flag p50 regressions
+
+import os
+import sys
+import argparse
+import socket
+import subprocess
+import threading
+import urllib.request
+import urllib.error
+import time
+import json
+import tempfile
+import shutil
+import zlib
+import tracemalloc
+
+os.environ.setdefault('MAGI_SIMULATE', '1')   # use simulated hardware backends
+
+import numpy as np
+from PIL import Image
+
+import config   # Cross-module global variables for all Python codes
+import roi_engine
+import hardware
+
+repo_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+card_file = os.path.join(repo_directory, 'assay_cards', 'example.card')
+config.font_directory = os.path.join(repo_directory, 'fonts')
+
+results = {}    # benchmark name -> {'p50_ms': .., 'p99_ms': .., ...}
+
+# Time repeated calls of fn(), return per-call times in seconds:
+def time_calls(fn, repeat=5):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return(times)
+
+# Peak Python memory (bytes) allocated during one call of fn():
+def peak_memory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return(tracemalloc.get_traced_memory()[1])
+    finally:
+        tracemalloc.stop()
+
+def report(name, times, peak=None):
+    times_ms = np.array(times)*1e3
+    stats = {
+        'n': len(times_ms),
+        'mean_ms': float(times_ms.mean()),
+        'p50_ms': float(np.percentile(times_ms, 50)),
+        'p99_ms': float(np.percentile(times_ms, 99)),
+        'per_s': float(1e3/times_ms.mean()) if times_ms.mean() > 0 else float('inf'),
+        }
+    line = (f'{name:<44s} n={stats["n"]:<4d} '
+            f'mean={stats["mean_ms"]:9.3f} ms  '
+            f'p50={stats["p50_ms"]:9.3f} ms  '
+            f'p99={stats["p99_ms"]:9.3f} ms  '
+            f'{stats["per_s"]:9.1f}/s')
+    if peak is not None:
+        stats['peak_mb'] = peak/1e6
+        line += f'  peak={stats["peak_mb"]:7.2f} MB'
+    results[name] = stats
+    print(line, flush=True)
+
+# Time fn() and measure its peak memory in a separate call, then report:
+def measure(name, fn, repeat=20):
+    peak = peak_memory(fn)
+    report(name, time_calls(fn, repeat), peak)
+
+# Load the ROI geometry from the example card, scaled to the frame width
+# (the card geometry is defined for the default 640 px wide frame), with
+# optional ROI colors for the genes in sorted order:
+def setup_card(frame_width=640, gene_colors=None):
+    import assay_card
+    with open(card_file) as f:
+        card = json.load(f)
+    scale = frame_width/640
+    for key in ['roi_width', 'roi_height', 'roi_spacing_x', 'roi_spacing_y']:
+        card[key] = int(card[key]*scale)
+    card['roi_upper_left'] = [int(val*scale) for val in card['roi_upper_left']]
+    gene_names = sorted(set(g for row in card['well_config'] for g in row)) if gene_colors else None
+    assay_card.apply(assay_card.compile_card(card, os.path.basename(card_file), gene_names, gene_colors))
+    config.ROIs = config.card.rois()
+    roi_engine.build_index()
+
+def synthetic_frame(w, h, seed=0):
+    rng = np.random.default_rng(seed)
+    return(rng.integers(0, 256, size=(h, w, 3), dtype=np.uint8))
+
+# Per-pixel getpixel() loop formerly used by imager.roi_avg(), kept as the
+# reference implementation:
+def roi_avg_loop(image, roi):
+    r,b,g = 0,0,0
+    px = roi['x']
+    py = roi['y']
+    for x in range(int(px),int(px+config.roi_width)):
+        for y in range(int(py),int(py+config.roi_height)):
+            xy = (x,y)
+            r += image.getpixel(xy)[0]
+            g += image.getpixel(xy)[1]
+            b += image.getpixel(xy)[2]
+    pixels = config.roi_width * config.roi_height
+    r = int(100*r/pixels)
+    g = int(100*g/pixels)
+    b = int(100*b/pixels)
+    return((r,g,b))
+
+# Compare the getpixel() loop with the vectorized ROI engine:
+def bench_roi():
+    print('\n--- ROI extraction ---', flush=True)
+    for (w, h) in [(640, 480), (2592, 1944)]:
+        setup_card(w)
+        frame = synthetic_frame(w, h)
+        image = Image.fromarray(frame)
+        loop_values = [roi_avg_loop(image, roi)[1] for roi in config.ROIs]
+        vector_values = roi_engine.roi_values(frame, channel=1)
+        assert loop_values == vector_values, 'ROI engine does not match getpixel() loop'
+        label = f'{w}x{h}, {len(config.ROIs)} ROIs {config.roi_width}x{config.roi_height}'
+        loop = time_calls(lambda: [roi_avg_loop(image, roi)[1] for roi in config.ROIs], repeat=3)
+        report(f'getpixel loop ({label})', loop)
+        vector = time_calls(lambda: roi_engine.roi_values(np.asarray(image), channel=1), repeat=20)
+        report(f'roi_values ({label})', vector)
+        stats = time_calls(lambda: roi_engine.roi_stats(np.asarray(image)), repeat=20)
+        report(f'roi_stats ({label})', stats)
+        print(f'speedup (roi_values vs loop): {np.mean(loop)/np.mean(vector):.1f}x', flush=True)
+
+# Compare per-stage timings and peak memory of the PIL capture path
+# (capture_image -> np.asarray) with the raw array capture path (no
+# conversion stage):
+def bench_capture():
+    print('\n--- capture paths ---', flush=True)
+    for (w, h) in [(640, 480), (2592, 1944)]:
+        setup_card(w)
+        frame = synthetic_frame(w, h)
+        cam = hardware.SyntheticCamera(frame_source=lambda size: frame.copy())
+        cam.configure(cam.create_still_configuration(main={"size": (w, h)}))
+        cam.start()
+        try:
+            for path in ['pil', 'raw']:
+                stages = {'capture': [], 'convert': [], 'roi': []} if path == 'pil' else {'capture': [], 'roi': []}
+                peak = []
+                for _ in range(10):
+                    tracemalloc.start()
+                    t0 = time.perf_counter()
+                    if path == 'pil':
+                        image = cam.capture_image("main")
+                        t1 = time.perf_counter()
+                        array = np.asarray(image)
+                        pil_bytes = image.width * image.height * 4  # PIL stores RGB as 32-bit pixels
+                        t2 = time.perf_counter()
+                        stages['convert'].append(t2-t1)
+                    else:
+                        array = cam.capture_array("main")
+                        t1 = t2 = time.perf_counter()
+                        pil_bytes = 0
+                    roi_engine.roi_values(array, channel=1)
+                    t3 = time.perf_counter()
+                    # PIL allocates outside the Python allocator, so add its buffer:
+                    peak.append(tracemalloc.get_traced_memory()[1] + pil_bytes)
+                    tracemalloc.stop()
+                    stages['capture'].append(t1-t0)
+                    stages['roi'].append(t3-t2)
+                    image = array = None
+                for stage, times in stages.items():
+                    report(f'{path} {stage} ({w}x{h})', times)
+                print(f'{path} peak memory ({w}x{h}): {np.max(peak)/1e6:.2f} MB', flush=True)
+        finally:
+            cam.stop()
+
+# Compare sample latency and throughput of starting/stopping the camera for
+# every sample with keeping it streaming, using a simulated camera with
+# pipeline spin-up latency:
+def bench_stream(start_latency_s=0.25, samples=10):
+    import imager
+    print('\n--- camera streaming ---', flush=True)
+    setup_card(640)
+    config.data_directory = tempfile.mkdtemp()
+    imager.cam = hardware.SyntheticCamera(start_latency_s=start_latency_s)
+    imager.cam.configure(imager.cam.create_still_configuration(main={"size": imager.res}))
+    imager.cam.set_controls({"ExposureTime": 50000})
+    for persistent in [False, True]:
+        config.persistent_stream = persistent
+        t0 = time.perf_counter()
+        times = time_calls(imager.get_image_data, repeat=samples)
+        elapsed = time.perf_counter() - t0
+        imager.stop_streaming()
+        label = 'persistent stream' if persistent else 'start/stop per sample'
+        report(f'get_image_data ({label})', times)
+        print(f'throughput ({label}): {samples/elapsed:.2f} samples/s, '
+              f'last metadata: {imager.frame_metadata}', flush=True)
+
+# Measure sample spacing of the server-side acquisition scheduler:
+def bench_scheduler(period=0.2, duration=3.0):
+    import imager
+    import acquisition
+    print('\n--- acquisition scheduler ---', flush=True)
+    setup_card(640)
+    config.data_directory = tempfile.mkdtemp()
+    config.persistent_stream = True
+    imager.cam = hardware.SyntheticCamera()
+    imager.cam.set_controls({"ExposureTime": 20000})
+    acquisition.start(period)
+    time.sleep(duration)
+    acquisition.stop()
+    imager.stop_streaming()
+    t = np.array([sample['t'] for sample in acquisition.samples_since(0)])
+    spacing_ms = np.diff(t)*1e3
+    print(f'{len(t)} samples, period {period*1e3:.0f} ms: spacing mean={spacing_ms.mean():.2f} ms, '
+          f'std={spacing_ms.std():.2f} ms, max error={np.abs(spacing_ms - period*1e3).max():.2f} ms, '
+          f'missed slots={acquisition.missed}', flush=True)
+
+# Per-call cost of config.log_function_call (sampled tracing) vs the former
+# print & flush per call with stdout redirected to a log file (as under
+# cron), and of a log record through the queued log writer:
+def bench_logging(calls=20000):
+    import logging
+    import serverlog
+    print('\n--- logging ---', flush=True)
+    directory = tempfile.mkdtemp()
+
+    def log_function_call_print(func):       # former decorator
+        def wrapper(*args, **kwargs):
+            print(f"Calling function: {func.__name__}", flush=True)
+            sys.stdout.flush()
+            return func(*args, **kwargs)
+        return wrapper
+
+    def noop():
+        pass
+    traced = config.log_function_call(noop)
+    printed = log_function_call_print(noop)
+    stdout = sys.stdout
+    with open(directory + '/stdout.log', 'a') as sys.stdout:
+        t_print = time_calls(lambda: [printed() for i in range(calls)], repeat=3)
+    sys.stdout = stdout
+    t_traced = time_calls(lambda: [traced() for i in range(calls)], repeat=3)
+    t_bare = time_calls(lambda: [noop() for i in range(calls)], repeat=3)
+    us = lambda t: (np.median(t) - np.median(t_bare))/calls*1e6
+    print(f'decorator overhead per call: print & flush {us(t_print):.2f} us, '
+          f'sampled tracing (1/{config.trace_sample_every}) {us(t_traced):.3f} us', flush=True)
+    serverlog.setup(directory + '/magi_server.log', 'INFO')
+    log = logging.getLogger('magi.bench')
+    t_info = time_calls(lambda: [log.info(f'sample {i}') for i in range(calls)], repeat=3)
+    t_debug = time_calls(lambda: [log.debug(f'sample {i}') for i in range(calls)], repeat=3)
+    serverlog.stop()
+    print(f'log record per call: INFO (queued) {np.median(t_info)/calls*1e6:.2f} us, '
+          f'DEBUG (filtered) {np.median(t_debug)/calls*1e6:.2f} us', flush=True)
+    shutil.rmtree(directory)
+
+# Cost of a metric update (per-thread shards, no lock) from 1 and 4
+# threads vs. the lock-protected dict histogram formerly used for request
+# latency, and the cost of rendering all metrics:
+def bench_metrics(updates=20000):
+    import bisect
+    import metrics
+    print('\n--- metrics ---', flush=True)
+    histogram = metrics.histogram('magi_bench_seconds', 'Benchmark histogram', label='stage')
+    counter = metrics.counter('magi_bench_total', 'Benchmark counter')
+    buckets_ms = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float('inf')]
+    latency, lock = {}, threading.Lock()
+    def record_latency_locked(name, seconds):     # former request latency histogram
+        ms = seconds*1e3
+        with lock:
+            stats = latency.setdefault(name, {'count': 0, 'sum_ms': 0.0, 'buckets': [0]*len(buckets_ms)})
+            stats['count'] += 1
+            stats['sum_ms'] += ms
+            stats['buckets'][bisect.bisect_left(buckets_ms, ms)] += 1
+    for (label, update) in [('locked dict histogram', lambda: record_latency_locked('capture', 0.003)),
+                            ('Histogram.observe', lambda: histogram.observe(0.003, 'capture')),
+                            ('Counter.inc', lambda: counter.inc())]:
+        for threads in [1, 4]:
+            def run():
+                workers = [threading.Thread(target=lambda: [update() for i in range(updates)])
+                           for j in range(threads)]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+            t = time_calls(run, repeat=3)
+            print(f'{label + f" ({threads} threads)":<44s} {np.median(t)/(threads*updates)*1e6:.3f} us/update',
+                  flush=True)
+    measure('metrics.exposition()', metrics.exposition, repeat=50)
+    measure('metrics.snapshot()', metrics.snapshot, repeat=50)
+
+# Per-sample append cost and size of the binary sample log vs the CSV text
+# writer formerly used by get_image_data(), load time for analysis, and
+# recovery from a partially written record:
+def bench_samplelog(samples=2000, num_wells=12):
+    import csv
+    import pandas as pd
+    import samplelog
+    print('\n--- sample log ---', flush=True)
+    directory = tempfile.mkdtemp()
+    rng = np.random.default_rng(0)
+    values = [rng.integers(1000, 20000, num_wells).tolist() for _ in range(samples)]
+    csv_filename = os.path.join(directory, 'run.csv')
+    def csv_append(row):
+        with open(csv_filename, 'a') as f:
+            writer = csv.writer(f, delimiter=',', lineterminator='\n')
+            writer.writerow([int(time.time())] + row)
+    times = []
+    for row in values:
+        t0 = time.perf_counter()
+        csv_append(row)
+        times.append(time.perf_counter() - t0)
+    report(f'csv append ({num_wells} wells)', times)
+    for fsync in ['never', 'interval', 'always']:
+        log_filename = os.path.join(directory, f'run_{fsync}.magi')
+        log = samplelog.SampleLog(log_filename, num_wells, fsync=fsync, fsync_interval=10.0)
+        times = []
+        for row in values:
+            t0 = time.perf_counter()
+            log.append(time.time(), row)
+            times.append(time.perf_counter() - t0)
+        log.close()
+        report(f'sample log append, fsync={fsync} ({num_wells} wells)', times)
+    print(f'bytes/sample: csv={os.path.getsize(csv_filename)/samples:.1f}, '
+          f'log={log.dtype.itemsize}', flush=True)
+    with open(csv_filename) as f:
+        csv_data = pd.read_csv(f, header=None).to_numpy(dtype=float)
+    assert np.array_equal(csv_data[:, 1:], samplelog.to_array(log_filename)[:, 1:])
+    report('load csv (pandas)', time_calls(lambda: pd.read_csv(csv_filename, header=None).to_numpy(dtype=float)))
+    report('load sample log', time_calls(lambda: samplelog.to_array(log_filename)))
+    # Simulate a crash in the middle of writing a record:
+    with open(log_filename, 'ab') as f:
+        f.write(b'\x01'*(log.dtype.itemsize//2))
+    recovered = samplelog.SampleLog(log_filename)
+    assert recovered.count == samples, 'partial record not dropped'
+    recovered.append(time.time(), values[0])
+    recovered.close()
+    assert len(samplelog.load(log_filename)) == samples + 1
+    print('partial record recovery: ok', flush=True)
+
+# Write a synthetic run CSV (unix time + one column per well) of sigmoidal
+# LAMP amplification curves with noise and dropped samples:
+def synthetic_run_csv(filename, num_wells=12, hours=2.0, period=15.0, seed=0):
+    rng = np.random.default_rng(seed)
+    n = int(hours*3600/period)
+    t = 1.7e9 + period*np.arange(n)
+    t_min = (t - t[0])/60
+    ttp = rng.uniform(10, 60, num_wells)
+    ttp[rng.random(num_wells) < 0.3] = np.inf            # some negative wells
+    y = 3000 + 4000/(1 + np.exp(-(t_min[:, None] - ttp)/2.5))
+    y += rng.normal(0, 30, y.shape)
+    y[rng.random(y.shape) < 0.002] = 0                   # dropped samples
+    data = np.column_stack([t, y]).astype(int)
+    np.savetxt(filename, data, fmt='%d', delimiter=',')
+
+# Per-well filter formerly used by filter_curves.filter(), kept as the
+# reference implementation:
+def filter_loop(filename, filter_factor=10.0, cut_time=0.0, threshold=0):
+    import pandas as pd
+    from scipy.signal import butter, sosfiltfilt
+    import filter_curves
+    y_filtered = []
+    ttp = []
+    with open(filename) as f:
+        df = pd.read_csv(f, header=None)
+        t = df.iloc[:, 0].tolist()
+        t = [(val-t[0])/60.0 for val in t]
+        cut_num = int(cut_time/t[-1] * len(t))
+        t = t[cut_num:]
+        T = t[-1]
+        n = len(t)
+        fs = n/T
+        f_nyquist = fs/2.0
+        Wn = f_nyquist/filter_factor
+        if Wn >= f_nyquist:
+            Wn = 0.999*f_nyquist
+        order = 6
+        num_wells = len(config.well_config) * len(config.well_config[0])
+        for idx in range(1,num_wells+1):
+            y = df.iloc[:,idx].tolist()
+            y = y[cut_num:]
+            y = [float(val) for val in y]
+            for i,val in enumerate(y):
+                if val < 2 and i>0:
+                    y[i] = y[i-1]
+            sos = butter(order, Wn, btype='low', analog=False, fs=fs, output='sos')
+            yf = sosfiltfilt(sos, y)
+            yf_shifted = [x-min(yf) for x in yf]
+            yf_norm = [x/max(yf_shifted) for x in yf_shifted]
+            if max(y) < threshold:
+                yf_norm = [0 for _ in yf_norm]
+            yf_dict = [{'x':t[i], 'y':yf_norm[i]} for i in range(len(t))]
+            y_filtered.append(yf_dict)
+            ttp.append(filter_curves.get_ttp(t,yf_norm))
+    return({'ttp': ttp, 'y_filt': y_filtered})
+
+# Whether filter_loop() results match column-oriented results (identical
+# TTPs, times & curves equal up to the rounding of config.result_decimals):
+def same_results(reference, result):
+    t = [point['x'] for point in reference['y_filt'][0]]
+    y = [[point['y'] for point in well] for well in reference['y_filt']]
+    tolerance = 0.5*10**-config.result_decimals + 1e-12
+    return(reference['ttp'] == result['ttp'] and
+           np.allclose(t, result['t'], rtol=0, atol=tolerance) and
+           np.allclose(y, result['y'], rtol=0, atol=tolerance))
+
+# Compare the batched filter with the per-well loop for 12-384 wells and
+# runs of 2-8 hours. The loop is O(n^2) per well, so it is only run (and
+# checked against) where that finishes in reasonable time:
+def bench_filter():
+    import filter_curves
+    print('\n--- curve filtering ---', flush=True)
+    filename = tempfile.mkstemp(suffix='.csv')[1]
+    for num_wells in [12, 96, 384]:
+        for hours, period in [(2, 15.0), (8, 15.0), (8, 5.0)]:
+            synthetic_run_csv(filename, num_wells, hours, period)
+            config.well_config = [[0]*num_wells]
+            n = int(hours*3600/period)
+            label = f'{num_wells} wells, {hours} h @ {period:.0f} s'
+            batched = time_calls(lambda: filter_curves.filter(filename, 10.0, 2.0, 0), repeat=3)
+            report(f'batched filter ({label})', batched)
+            if num_wells*n**2 > 1e8:
+                continue
+            for threshold in [0, 5000]:
+                reference = filter_loop(filename, 10.0, 2.0, threshold)
+                result = filter_curves.filter(filename, 10.0, 2.0, threshold)
+                assert same_results(reference, result), f'batched filter does not match per-well loop ({label})'
+            loop = time_calls(lambda: filter_loop(filename, 10.0, 2.0, 0), repeat=1)
+            report(f'per-well loop ({label})', loop)
+            print(f'speedup: {np.mean(loop)/np.mean(batched):.1f}x (results match)', flush=True)
+    os.remove(filename)
+
+# Analysis output of a 384-well, 2 h run: the former list-of-dicts response
+# and row-by-row CSV append vs. the column-oriented response and the
+# vectorized CSV write (response size, formatting + JSON encoding time,
+# CSV write time):
+def bench_results(num_wells=384, hours=2, period=15.0):
+    import csv
+    import filter_curves
+    print('\n--- analysis results output ---', flush=True)
+    directory = tempfile.mkdtemp()
+    synthetic_run_csv(directory + '/run.csv', num_wells, hours, period)
+    config.well_config = [[0]*num_wells]
+    t, y = filter_curves.cut_data(filter_curves.load_data(directory + '/run.csv'), 0.0)
+    yf_norm, ttp = filter_curves.apply_threshold(t, y, filter_curves.smooth(t, y), 0)
+    def format_points():                # former response format
+        y_filtered = [[{'x': x, 'y': val} for (x, val) in zip(t.tolist(), well)] for well in yf_norm.T.tolist()]
+        return({'ttp': ttp.tolist(), 'y_filt': y_filtered})
+    def write_rows(results, filename):  # former CSV writer of imager.analyze_data()
+        y_filt = results['y_filt']
+        time_min = [entry['x'] for entry in y_filt[0]]
+        columns = [[entry['y'] for entry in well] for well in y_filt]
+        with open(filename, 'a') as f:
+            writer = csv.writer(f)
+            writer.writerow(['time (min)'] + [f'well {i}' for i in range(len(columns))])
+            for i, t_min in enumerate(time_min):
+                writer.writerow([t_min] + [values[i] for values in columns])
+    label = f'{num_wells} wells, {hours} h'
+    points = time_calls(lambda: json.dumps(format_points()), repeat=5)
+    report(f'points response + JSON ({label})', points)
+    columns = time_calls(lambda: json.dumps(filter_curves.format_results(t, yf_norm, ttp)), repeat=5)
+    report(f'columnar response + JSON ({label})', columns)
+    size_points = len(json.dumps(format_points()))
+    body = json.dumps(filter_curves.format_results(t, yf_norm, ttp), separators=(',', ':')).encode()
+    compressor = zlib.compressobj(1, zlib.DEFLATED, 31)     # as sent by magi_server
+    size_gzip = len(compressor.compress(body) + compressor.flush())
+    print(f'response size: points {size_points/1e6:.2f} MB, columnar {len(body)/1e6:.2f} MB '
+          f'({size_points/len(body):.1f}x smaller), gzipped {size_gzip/1e6:.2f} MB '
+          f'({size_points/size_gzip:.1f}x smaller); encoding {np.mean(points)/np.mean(columns):.1f}x faster',
+          flush=True)
+    results = format_points()
+    rows = time_calls(lambda: write_rows(results, directory + '/rows_filt.csv'), repeat=3)
+    report(f'row-by-row CSV append ({label})', rows)
+    bulk = time_calls(lambda: filter_curves.save_filtered(directory + '/run_filt.csv', t, yf_norm), repeat=3)
+    report(f'vectorized CSV replace ({label})', bulk)
+    print(f'CSV write {np.mean(rows)/np.mean(bulk):.1f}x faster; file after 3 analyses: '
+          f'appended {os.path.getsize(directory + "/rows_filt.csv")/1e6:.2f} MB, '
+          f'replaced {os.path.getsize(directory + "/run_filt.csv")/1e6:.2f} MB', flush=True)
+    shutil.rmtree(directory)
+
+# Replay synthetic runs through the online TTP detector and compare with
+# the offline (zero-phase) result:
+def bench_online():
+    import online
+    print('\n--- online TTP detection ---', flush=True)
+    filename = tempfile.mkstemp(suffix='.csv')[1]
+    for num_wells in [12, 96]:
+        synthetic_run_csv(filename, num_wells, 2, 15.0, seed=1)
+        config.well_config = [[0]*num_wells]
+        config.positives = {}
+        config.card = None
+        t0 = time.perf_counter()
+        result = online.replay(filename)
+        elapsed = time.perf_counter() - t0
+        ok = ~np.isnan(result['online_ttp']) & (result['offline_ttp'] > 0)
+        error = np.abs(result['online_ttp'] - result['offline_ttp'])[ok]
+        missed = np.sum((result['offline_ttp'] > 0) & np.isnan(result['online_ttp']))
+        print(f'{num_wells} wells: {ok.sum()} called, {missed} missed, '
+              f'TTP error median={np.median(error):.3f} max={error.max():.3f} min, '
+              f'call latency after offline TTP median={np.median(result["latency"][ok]):.2f} min, '
+              f'replay {elapsed*1e3/online.n:.3f} ms/sample (incl. offline filter)', flush=True)
+    os.remove(filename)
+
+# Slider changes in the analysis view (threshold, then cut time, then
+# filter factor) with & without the stage caches of analysis.py, and batch
+# re-analysis of a directory of runs serially & with a process pool:
+def bench_analysis(num_runs=48):
+    import filter_curves
+    import analysis
+    print('\n--- analysis cache & batch ---', flush=True)
+    directory = tempfile.mkdtemp()
+    filename = directory + '/run.csv'
+    synthetic_run_csv(filename, 96, 2, 15.0)
+    config.well_config = [[0]*96]
+    changes = [(10.0, 2.0, t) for t in [0, 1000, 2000, 5000]] + \
+              [(10.0, c, 5000) for c in [1.0, 3.0, 4.0]] + [(f, 4.0, 5000) for f in [8.0, 12.0]]
+    for (f, c, t) in changes:
+        assert analysis.analyze(filename, f, c, t) == filter_curves.filter(filename, f, c, t)
+    analysis.clear_cache()
+    uncached = time_calls(lambda: [filter_curves.filter(filename, *args) for args in changes], repeat=3)
+    report(f'filter() x{len(changes)} slider changes', uncached)
+    for stage, subset in [('threshold', changes[:4]), ('cut time', changes[4:7]), ('filter factor', changes[7:])]:
+        analysis.analyze(filename, *changes[0])         # parsed & filtered data cached
+        times = []
+        for args in subset:
+            times += time_calls(lambda: analysis.analyze(filename, *args), repeat=1)
+            analysis.results_cache.clear()              # a new combination each time
+        report(f'analyze() {stage} change', times)
+        analysis.clear_cache()
+    for i in range(num_runs):
+        synthetic_run_csv(f'{directory}/run{i:03d}.csv', 96, 2, 15.0, seed=i)
+    os.remove(filename)
+    serial = time_calls(lambda: analysis.analyze_directory(directory, processes=1), repeat=1)
+    report(f'batch {num_runs} runs, 1 process', serial)
+    pooled = time_calls(lambda: analysis.analyze_directory(directory), repeat=1)
+    report(f'batch {num_runs} runs, {os.cpu_count()} processes', pooled)
+    print(f'batch speedup: {np.mean(serial)/np.mean(pooled):.1f}x', flush=True)
+    shutil.rmtree(directory)
+
+# Hit classification as done by the client (per target, per gene dict
+# lookups), kept as the reference implementation:
+def hits_loop(hit_criteria, wells, ttp):
+    mean_ttp = {gene: np.mean([v for (g, v) in zip(wells, ttp) if g == gene]) for gene in set(wells)}
+    return([target for (target, criteria) in hit_criteria.items()
+            if all((0.1 < mean_ttp.get(gene, np.nan) < 50) == amplifies
+                   for (gene, amplifies) in criteria.items())])
+
+# Compiling the example card (first time & cached), and classifying runs by
+# its hit criteria with the compiled rule matrix vs per-run dict lookups:
+def bench_card(runs=10000):
+    import assay_card
+    print('\n--- assay card ---', flush=True)
+    with open(card_file) as f:
+        card_dict = json.load(f)
+    genes = list(dict.fromkeys(g for row in card_dict['well_config'] for g in row))
+    colors = ['#ff0000']*len(genes)
+    def compile_uncached():
+        assay_card.cache.clear()
+        return(assay_card.compile_card(card_dict, 'example.card', genes, colors))
+    report('compile card', time_calls(compile_uncached, repeat=20))
+    report('compile card (cached)', time_calls(lambda: assay_card.compile_card(card_dict, 'example.card', genes, colors), repeat=20))
+    card = assay_card.compile_card(card_dict, 'example.card', genes, colors)
+    rng = np.random.default_rng(0)
+    ttp = np.where(rng.random((runs, card.num_wells)) < 0.5, rng.uniform(5, 40, (runs, card.num_wells)), -0.001)
+    reference = [hits_loop(card.hit_criteria, card.wells, row) for row in ttp[:200]]
+    assert reference == [card.hits(row) for row in ttp[:200]], 'compiled hit rules do not match'
+    loop = time_calls(lambda: [hits_loop(card.hit_criteria, card.wells, row) for row in ttp[:1000]], repeat=3)
+    report('classify 1000 runs (dict lookups)', loop)
+    vectorized = time_calls(lambda: card.classify(ttp[:1000]), repeat=10)
+    report('classify 1000 runs (rule matrix)', vectorized)
+    report(f'classify {runs} runs (rule matrix)', time_calls(lambda: card.classify(ttp), repeat=10))
+    print(f'speedup: {np.median(loop)/np.median(vectorized):.0f}x (results match)', flush=True)
+
+# Calibration polynomial formerly evaluated by the control loop
+# (magi_server.cali_fun), kept as the reference for the lookup tables of
+# calibration.py:
+def cali_fun(y_data):
+    c = config.cali_coeffs
+    y_adj = (
+        c[0] * y_data ** 5 +
+        c[1] * y_data ** 4 +
+        c[2] * y_data ** 3 +
+        c[3] * y_data ** 2 +
+        c[4] * y_data +
+        c[5]
+        )
+    return y_adj
+
+# Free-running control loop formerly used by magi_server.run_pid(), kept as
+# the reference implementation:
+def run_pid_busy(stop_event):
+    import magi_server as m
+    m.pid.sample_time = 0.01       # simple_pid default, which paced the old loop
+    while not stop_event.is_set():
+        m.pid.setpoint = m.Gp(m.set_temp)
+        values = [x*1023 for x in [m.const.value, m.Tb.value, m.Tt.value]]
+        m.duty_cycle = m.pid(config.b_bias*cali_fun(values[1] - values[0]) + (1-config.b_bias)*cali_fun(values[2] - values[0]))
+        m.pwm.ChangeDutyCycle(m.duty_cycle)
+
+# Temperature control of the simulated thermal plant (sped up to a 2 s time
+# constant) by the busy loop and the fixed-rate loop: process CPU use and
+# tracking error after the step from ambient to the setpoint:
+def bench_pid(duration=8.0):
+    import magi_server
+    print('\n--- PID control loop ---', flush=True)
+    for (label, loop) in [('busy loop', run_pid_busy), ('fixed-rate loop', magi_server.run_pid)]:
+        hardware.plant.__init__(heat_capacity=0.1)      # tau = 2 s
+        magi_server.r_F_prev = magi_server.set_temp     # constant setpoint (no pre-filter ramp)
+        magi_server.pid.reset()
+        stop_event = threading.Event()
+        thread = threading.Thread(target=loop, args=(stop_event,), daemon=True)
+        trace = []
+        cpu0, t0 = time.process_time(), time.monotonic()
+        thread.start()
+        while time.monotonic() - t0 < duration:
+            time.sleep(0.05)
+            trace.append(hardware.plant.update())
+        cpu = (time.process_time() - cpu0)/(time.monotonic() - t0)
+        stop_event.set()
+        thread.join()
+        error = np.array(trace[len(trace)//2:]) - magi_server.set_temp
+        print(f'{label:<16s} cpu={cpu*100:5.1f}% of a core  steady-state error: '
+              f'mean={error.mean():+.3f} rms={np.sqrt(np.mean(error**2)):.3f} degC', flush=True)
+        results[f'pid {label}'] = {'cpu': cpu, 'rms_error': float(np.sqrt(np.mean(error**2)))}
+    stats = magi_server.pid_stats
+    print(f'fixed-rate loop: {stats["iterations"]} iterations @ {stats["period_s"]*1e3:.0f} ms, '
+          f'overruns={stats["overruns"]}, jitter mean={stats["jitter_mean_ms"]:.3f} ms '
+          f'max={stats["jitter_max_ms"]:.3f} ms, loop thread cpu={stats["cpu"]*100:.1f}%', flush=True)
+    hardware.plant.__init__()
+
+# Accuracy of the calibration lookup tables against the polynomial
+# (cali_fun) over the whole oversampled ADC range, and the cost
+# of one well temperature evaluation:
+def bench_calibration(calls=20000):
+    import magi_server
+    import calibration
+    print('\n--- temperature calibration ---', flush=True)
+    for n in [1, config.adc_oversample]:
+        calibration.build(n=n)
+        d = np.arange(-1023*n, 1023*n + 1)
+        reference = np.array([cali_fun(x/n) for x in d.tolist()])
+        error = np.abs(np.array(calibration.lut_bottom)[d + calibration.offset]/config.b_bias - reference)
+        in_range = (d >= 0) & (d <= 700*n)    # ADC differences seen in use
+        print(f'oversample={n}: max |LUT - polynomial| = {error.max():.2e} degC '
+              f'({error[in_range].max():.2e} in 0..700)', flush=True)
+    rng = np.random.default_rng(0)
+    sums = [[50*n, int(v), int(v) - 10] for v in rng.integers(300*n, 500*n, calls)]
+    def polynomial():
+        for s in sums:
+            values = [x/n for x in s]
+            config.b_bias*cali_fun(values[1] - values[0]) + (1-config.b_bias)*cali_fun(values[2] - values[0])
+    def lookup():
+        for s in sums:
+            calibration.well_temperature(s)
+    poly = time_calls(polynomial, repeat=5)
+    lut = time_calls(lookup, repeat=5)
+    report(f'polynomial blend x{calls}', poly)
+    report(f'lookup table blend x{calls}', lut)
+    print(f'per evaluation: polynomial {np.mean(poly)/calls*1e6:.2f} us, '
+          f'lookup {np.mean(lut)/calls*1e6:.2f} us', flush=True)
+    measure('read_adc (simulated MCP3008)', magi_server.read_adc, repeat=200)
+
+# Use the simulated camera drawing amplification curves into the card's ROIs:
+def setup_imager():
+    import imager
+    setup_card(640, ['#ff0000', '#00ff00', '#0000ff', '#ffff00', '#ff00ff'])
+    config.data_directory = tempfile.mkdtemp()
+    imager.cam = hardware.SyntheticCamera(frame_source=hardware.AmplificationFrames(time_scale=60))
+    imager.cam.configure(imager.cam.create_still_configuration(main={"size": imager.res}))
+    imager.cam.set_controls({"ExposureTime": 10000})
+    return(imager)
+
+# Annotation formerly done by imager.annotate_image() (overlay and fonts
+# rebuilt for every image), kept as the reference implementation:
+def annotate_image_uncached(img, add_roi=False):
+    from PIL import ImageDraw, ImageFont
+    img = img.convert('RGBA')
+    img_tmp = Image.new('RGBA', img.size, (255, 255, 255, 0))
+    draw = ImageDraw.Draw(img_tmp)
+    font = ImageFont.truetype(config.font_directory + "/" + "OpenSans.ttf", 12)
+    draw.text((10,10), config.card_filename, font=font)
+    draw.text((10,20), time.strftime("%b %d %Y @ %H:%M:%S"), font=font)
+    if add_roi:
+        for roi in config.ROIs:
+            roi_lower_right = (roi['x'] + config.roi_width, roi['y'] + config.roi_height)
+            idx = config.gene_names.index(roi['target'])
+            h = config.gene_colors[idx]
+            fill_color = [int(h[i:i+2], 16) for i in (1, 3, 5)] + [64]
+            draw.rectangle([(roi['x'],roi['y']), roi_lower_right], outline='#ffffff', fill=tuple(fill_color))
+            font = ImageFont.truetype(config.font_directory + "/" + "OpenSans.ttf", 9)
+            draw.text((roi['x'] + config.roi_width + 1, roi['y']), roi['target'],'#ffffff',font=font)
+    return(Image.alpha_composite(img, img_tmp))
+
+# Sample and image pipeline through imager.py on the simulated camera:
+def bench_pipeline():
+    print('\n--- imager pipeline ---', flush=True)
+    imager = setup_imager()
+    config.persistent_stream = True
+    measure('get_image_data', imager.get_image_data)
+    image = Image.fromarray(imager.cam.capture_array("main"))
+    measure('annotate_image, uncached (ROIs)', lambda: annotate_image_uncached(image, True))
+    measure('annotate_image (no ROIs)', lambda: imager.annotate_image(image, False))
+    measure('annotate_image (ROIs)', lambda: imager.annotate_image(image, True))
+    annotated = imager.annotate_image(image, True)
+    for (image_format, scale) in [('png', 1.0), ('jpeg', 1.0), ('webp', 1.0), ('jpeg', 0.5)]:
+        size = len(imager.encode_image(annotated, image_format, scale=scale)[0])
+        measure(f'encode {image_format} x{scale} ({size/1e3:.0f} kB)',
+                lambda: imager.encode_image(annotated, image_format, scale=scale))
+    measure('get_image (ROIs, png)', lambda: imager.get_image(True), repeat=10)
+    measure('get_image (ROIs, jpeg)', lambda: imager.get_image(True, 'jpeg'), repeat=10)
+    imager.stop_streaming()
+
+# Sample noise, latency and peak memory of burst capture with N frames per
+# sample, on a steady scene with sensor noise:
+def bench_burst(samples=10):
+    print('\n--- burst capture ---', flush=True)
+    imager = setup_imager()
+    rng = np.random.default_rng(0)
+    scene = synthetic_frame(*imager.res)
+    imager.cam = hardware.SyntheticCamera(
+        frame_source=lambda size: np.clip(scene + rng.normal(0, 8, scene.shape), 0, 255).astype(np.uint8))
+    imager.cam.configure(imager.cam.create_still_configuration(main={"size": imager.res}))
+    imager.cam.set_controls({"ExposureTime": 10000})
+    imager.exposure_us = 10000
+    for n in [1, 4, 16]:
+        config.frames_per_sample = n
+        values = np.array([imager.get_image_data() for _ in range(samples)])
+        noise = values.std(axis=0).mean()/100
+        times = time_calls(imager.get_image_data, repeat=samples)
+        report(f'get_image_data, {n} frame(s)/sample', times, peak_memory(imager.get_image_data))
+        print(f'{n} frame(s)/sample: ROI mean noise {noise:.4f} (pixel value units)', flush=True)
+    config.frames_per_sample = 1
+    imager.stop_streaming()
+
+# ROI registration of a shifted card and tracking of a slow drift, on
+# simulated amplification frames (wells slightly brighter than background):
+def bench_registration(shift=(7, -5), drift_steps=8):
+    import registration
+    print('\n--- ROI registration & drift tracking ---', flush=True)
+    setup_card(640)
+    source = hardware.AmplificationFrames()
+    def shifted(dx, dy):
+        return(np.roll(source((640, 480)), (dy, dx), axis=(0, 1)))
+    frame = shifted(*shift)
+    offset = registration.register(frame)
+    print(f'registered offset {offset} (true {shift}), score {registration.score:.1f}', flush=True)
+    assert offset == shift, 'registration failed'
+    report('register (FFT, 640x480)', time_calls(lambda: registration.register(frame), repeat=10))
+    dx, dy = shift
+    for step in range(drift_steps):          # 1 px drift per sample
+        dx += 1 if step % 2 == 0 else 0
+        dy += 1
+        offset = registration.track(shifted(dx, dy))
+    print(f'tracked offset {offset} (true {(dx, dy)})', flush=True)
+    assert offset == (dx, dy), 'drift tracking failed'
+    frame = shifted(dx, dy)
+    report('track (integral image)', time_calls(lambda: registration.track(frame), repeat=100))
+    blank = hardware.noise_frame((640, 480))
+    roi_engine.build_index()
+    print(f'blank frame: offset {registration.register(blank)}, score {registration.score:.1f}', flush=True)
+
+# HTTP round-trips to a server running on simulated hardware:
+# HTTP status of a GET request:
+def http_status(url):
+    try:
+        with urllib.request.urlopen(url) as response:
+            return(response.status)
+    except urllib.error.HTTPError as e:
+        return(e.code)
+
+def bench_http():
+    import magi_server
+    print('\n--- HTTP round-trips ---', flush=True)
+    imager = setup_imager()
+    with socket.socket() as sock:        # find a free port
+        sock.bind(('localhost', 0))
+        port = sock.getsockname()[1]
+    threading.Thread(target=magi_server.run, args=(port,), daemon=True).start()
+    url = f'http://localhost:{port}'
+    for _ in range(100):                 # wait for the server (camera setup takes ~3 s)
+        try:
+            urllib.request.urlopen(url + '/', b'todo=' + json.dumps(['ping', '']).encode()).read()
+            break
+        except OSError:
+            time.sleep(0.1)
+    def post(action, data=''):
+        body = 'todo=' + json.dumps([action, data])
+        return(urllib.request.urlopen(url + '/', body.encode()).read())
+    post('start', {'period': 0.5})
+    time.sleep(2)
+    measure('POST ping', lambda: post('ping'), repeat=50)
+    measure('POST getTemperature', lambda: post('getTemperature'), repeat=10)
+    measure('POST getSamples', lambda: post('getSamples', {'since': 0}), repeat=50)
+    measure('POST getImage', lambda: post('getImage', True), repeat=10)
+    measure('GET /image', lambda: urllib.request.urlopen(url + '/image?rois=1').read(), repeat=10)
+    for (label, fetch) in [('POST getImage (base64 png)', lambda: post('getImage', True)),
+                           ('GET /image (png)', lambda: urllib.request.urlopen(url + '/image?rois=1').read()),
+                           ('GET /image (jpeg)', lambda: urllib.request.urlopen(url + '/image?rois=1&format=jpeg').read()),
+                           ('GET /image (jpeg x0.5)', lambda: urllib.request.urlopen(url + '/image?rois=1&format=jpeg&scale=0.5').read())]:
+        print(f'{label:<44s} {len(fetch())/1e3:9.1f} kB', flush=True)
+    for (path, query) in [('/image', 'quality=abc'), ('/image', 'quality=0'), ('/image', 'quality=101'),
+                          ('/image', 'scale=0'), ('/image', 'scale=-1'), ('/image', 'scale=nan'),
+                          ('/image', 'scale=inf'), ('/image', 'format=gif'), ('/preview.mjpg', 'period=0'),
+                          ('/preview.mjpg', 'period=-1'), ('/preview.mjpg', 'period=abc'),
+                          ('/preview.mjpg', 'scale=0'), ('/preview.mjpg', 'quality=abc')]:
+        assert http_status(f'{url}{path}?{query}') == 400, f'{path}?{query} not answered with 400'
+    assert http_status(url + '/image?format=jpeg&quality=100&scale=0.25') == 200
+    synthetic_run_csv(config.data_directory + '/bench_run.csv', 96, 2, 15.0)
+    measure('GET run csv (96 wells, 2 h)',
+            lambda: urllib.request.urlopen(url + config.data_directory + '/bench_run.csv').read(), repeat=20)
+    gzip_request = urllib.request.Request(url + config.data_directory + '/bench_run.csv',
+                                          headers={'Accept-Encoding': 'gzip'})
+    measure('GET run csv, gzip (96 wells, 2 h)', lambda: urllib.request.urlopen(gzip_request).read(), repeat=20)
+    tail_request = urllib.request.Request(url + config.data_directory + '/bench_run.csv',
+                                          headers={'Range': 'bytes=-4096'})
+    measure('GET run csv, last 4 kB (Range)', lambda: urllib.request.urlopen(tail_request).read(), repeat=50)
+    post('endAssay')
+
+# Fleet fan-out to 1..16 simulated units (separate server processes):
+# rounds of one action on all units, sent concurrently over pooled
+# persistent connections (fleet.Fleet) vs. one unit after the other with a
+# new connection per request (urllib, as before):
+def bench_fleet(sizes=(1, 2, 4, 8, 16), rounds=10):
+    import fleet
+    print('\n--- fleet fan-out ---', flush=True)
+    simulated = fleet.simulate(max(sizes))
+    try:
+        addresses = [address for (address, process, directory) in simulated]
+        with open(card_file) as f:
+            card = json.load(f)
+        def post(address, action, data=''):
+            body = 'todo=' + json.dumps([action, data])
+            return(urllib.request.urlopen(f'http://{address}/', body.encode()).read())
+        for address in addresses:
+            post(address, 'setupAssay', {'card_filename': 'example.card', 'card_dict': card})
+        for n in sizes:
+            units = fleet.Fleet(addresses[:n])
+            units.ping()                  # open the connections
+            for action in ['getTemperature', 'getImageData']:
+                measure(f'{action} x{n}, sequential (urllib)',
+                        lambda: [post(address, action) for address in addresses[:n]], repeat=rounds)
+                measure(f'{action} x{n}, fan-out (pooled)', lambda: units.fan_out(action), repeat=rounds)
+            units.close()
+    finally:
+        fleet.stop_simulated(simulated)
+
+# Server startup: time to import magi_server (simulated hardware) in a
+# fresh interpreter, and whether the analysis libraries were loaded:
+def bench_startup(repeat=5):
+    print('\n--- server startup ---', flush=True)
+    code = ('import time; t0 = time.perf_counter(); import sys, magi_server; '
+            'print(time.perf_counter() - t0, "scipy.signal" in sys.modules, "pandas" in sys.modules)')
+    env = dict(os.environ, MAGI_SIMULATE='1')
+    times = []
+    for i in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        seconds, scipy_loaded, pandas_loaded = output.split()[-3:]
+        times.append(float(seconds))
+    report('import magi_server', times)
+    print(f'scipy.signal loaded: {scipy_loaded}, pandas loaded: {pandas_loaded}', flush=True)
+
+BENCHMARKS = {
+    'roi': bench_roi,
+    'capture': bench_capture,
+    'stream': bench_stream,
+    'scheduler': bench_scheduler,
+    'samplelog': bench_samplelog,
+    'logging': bench_logging,
+    'metrics': bench_metrics,
+    'filter': bench_filter,
+    'online': bench_online,
+    'results': bench_results,
+    'analysis': bench_analysis,
+    'pid': bench_pid,
+    'calibration': bench_calibration,
+    'card': bench_card,
+    'pipeline': bench_pipeline,
+    'burst': bench_burst,
+    'registration': bench_registration,
+    'http': bench_http,
+    'fleet': bench_fleet,
+    'startup': bench_startup,
+    }
+
+# Print benchmarks whose p50 latency grew by more than `tolerance` (fraction)
+# relative to a saved baseline:
+def compare(baseline_file, tolerance=0.2):
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    regressions = 0
+    print(f'\n--- comparison with {baseline_file} ---', flush=True)
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        ratio = stats['p50_ms']/baseline[name]['p50_ms'] if baseline[name]['p50_ms'] > 0 else 1.0
+        flag = 'REGRESSION' if ratio > 1 + tolerance else ''
+        regressions += bool(flag)
+        print(f'{name:<44s} p50 {baseline[name]["p50_ms"]:9.3f} -> {stats["p50_ms"]:9.3f} ms '
+              f'({ratio:5.2f}x) {flag}', flush=True)
+    return(regressions)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='MAGI benchmark suite')
+    parser.add_argument('names', nargs='*', choices=[[]] + list(BENCHMARKS), help='benchmarks to run (default: all)')
+    parser.add_argument('--save', help='save results to a JSON file')
+    parser.add_argument('--compare', help='compare results with a saved JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p50 slowdown (fraction)')
+    args = parser.parse_args()
+    for name in args.names or list(BENCHMARKS):
+        BENCHMARKS[name]()
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare and compare(args.compare, args.tolerance):
+        sys.exit(1)
@@ -0,0 +1,69 @@
+# ADC to temperature calibration for the control loop
+#
+# The calibration polynomial (config.cali_coeffs, ADC difference -> deg C)
+# is evaluated once per possible input at startup. The control loop reads
+# integer sums of config.adc_oversample readings per channel, so the
+# sensor - reference differences are integers in [-1023*n, 1023*n] and the
+# well temperature, including the b_bias blend of the bottom and top
+# sensors, is two table lookups:
+#
+#   T = b_bias*f(d_bottom/n) + (1 - b_bias)*f(d_top/n)
+#     = lut_bottom[d_bottom] + lut_top[d_top]
+#
+# New coefficients (and b_bias) can be loaded from a JSON file:
+#   {"cali_coeffs": [c5, c4, c3, c2, c1, c0], "b_bias": 0.82}
+
+import os
+import json
+import logging
+
+import numpy as np
+
+import config   # Cross-module global variables for all Python codes
+from config import log_function_call
+
+log = logging.getLogger('magi.calibration')
+
+coeffs = None          # polynomial coefficients in use, highest order first
+b_bias = None
+oversample = None      # readings summed per channel
+lut_bottom = None      # b_bias*f(d/n) for d = -1023*n ... 1023*n
+lut_top = None         # (1-b_bias)*f(d/n)
+offset = 0             # table index of d = 0
+
+# Temperature for an ADC difference (any shape), by Horner's rule:
+def temperature(adc_difference):
+    return(np.polyval(coeffs, adc_difference))
+
+# Build the lookup tables for the current coefficients:
+@log_function_call
+def build(cali_coeffs=None, bias=None, n=None):
+    global coeffs, b_bias, oversample, lut_bottom, lut_top, offset
+    coeffs = list(config.cali_coeffs if cali_coeffs is None else cali_coeffs)
+    b_bias = config.b_bias if bias is None else bias
+    oversample = config.adc_oversample if n is None else n
+    offset = 1023*oversample
+    table = temperature(np.arange(-offset, offset + 1)/oversample)
+    lut_bottom = (b_bias*table).tolist()     # lists: faster scalar indexing than arrays
+    lut_top = ((1 - b_bias)*table).tolist()
+
+# Load coefficients (and optionally b_bias) from a JSON file and rebuild:
+@log_function_call
+def load(filename):
+    with open(filename) as f:
+        data = json.load(f)
+    cali_coeffs = [float(c) for c in data['cali_coeffs']]
+    bias = float(data.get('b_bias', config.b_bias))
+    build(cali_coeffs, bias)
+    config.cali_coeffs = cali_coeffs
+    config.b_bias = bias
+    log.info(f'calibration loaded from {filename}: {cali_coeffs}, b_bias={bias}')
+
+# Well temperature from summed raw readings [reference, bottom, top]:
+def well_temperature(sums):
+    return(lut_bottom[sums[1] - sums[0] + offset] + lut_top[sums[2] - sums[0] + offset])
+
+if os.path.isfile(config.calibration_file):
+    load(config.calibration_file)
+else:
+    build()
@@ -1,5 +1,10 @@
 import os
 import sys
+import time
+import functools
+import itertools
+
+import serverlog
 
 # -------------------------------------
 # Cross-module Python global variables
@@ -16,12 +21,48 @@ ROIs = []                # list of upper left corners for all ROIs
 # File information:
 magi_directory = os.environ['HOME'] + '/magi'
 font_directory = magi_directory + '/fonts'
-data_directory = '/path/to/ramdisk'
+data_directory = os.environ.get('MAGI_DATA_DIRECTORY', '/path/to/ramdisk')
 card_filename = ""
+card = None           # compiled card of the current assay (assay_card.Card); the
+                      # card globals here are set from it by assay_card.apply()
 logfile = magi_directory + "/magi_server.log"
 
+# Logging (serverlog.py):
+log_level = 'INFO'            # DEBUG adds sampled call durations and request details
+log_max_bytes = 2*1024*1024   # size at which the log file is rotated
+log_backup_count = 3          # rotated log files kept
+log_tail_lines = 200          # lines returned by getLog
+trace_sample_every = 16       # time every n-th call of @log_function_call functions
+
 gene_names = []       # list of all unique gene target names
 gene_colors = []      # list of colors for each unique target
+positives = {}        # hit criteria from the assay card: {target: {gene: amplifies}}
+
+# Hardware:
+simulate_hardware = os.environ.get('MAGI_SIMULATE', '') == '1'   # run off-Pi with simulated devices
+replay_frames = os.environ.get('MAGI_REPLAY_FRAMES', '')         # simulated camera: directory of recorded frames
+simulation_time_scale = float(os.environ.get('MAGI_TIME_SCALE', '1'))  # simulated assay time speed-up
+raw_capture = True       # read ROI data from raw frame arrays (no PIL image)
+persistent_stream = True # keep the camera streaming between samples
+frames_per_sample = 1    # frames averaged per sample (burst capture)
+burst_exposure_factors = [1.0]   # exposures per sample, relative to the adjusted exposure (HDR stacking)
+exposure_settle_frames = 6       # max frames skipped while a new exposure time takes effect
+capture_timeout = 30.0   # max time (s) of a frame capture before it is given up and retried
+saturation_level = 255   # pixel value counted as saturated
+roi_registration = True  # align ROIs to the wells when an assay card is loaded
+registration_search = 40 # max ROI shift (px) searched by registration
+registration_ring = 4    # width (px) of the background ring around each well
+registration_min_score = 6.0     # min correlation peak z-score to accept a registration
+drift_tracking = True    # follow card drift from sample to sample (after a registration)
+drift_search = 3         # max ROI shift (px) per sample
+drift_hysteresis = 0.05  # min score gain (fraction of score range) to move the ROIs
+image_quality = 85       # JPEG/WebP quality of preview images
+png_compress_level = 1   # zlib level of PNG preview images (fast)
+preview_frame_period = 0.2   # min time (s) between frames of the /preview.mjpg live stream
+
+# Binary sample log (samplelog.py):
+sample_log_fsync = 'interval'    # 'always' (every sample), 'interval' or 'never'
+sample_log_fsync_interval = 10.0 # min time (s) between fsyncs for 'interval'
 
 # GPIO pins:
 PWM_PIN = 19			# Heater PWM
@@ -38,17 +79,69 @@ Kd = 0
 # PID setpoint pre-filter parameters:
 a_val = 0.999949127
 b_val = 0.000050873
+prefilter_reference_period = 1e-3   # loop iteration time (s) a_val/b_val were tuned at
+
+# PID control loop:
+pid_period = 0.01       # control loop period (s)
+adc_oversample = 4      # ADC readings averaged per channel and iteration
 
 b_bias = 0.82           # Temperature interpolation paramneter
 
+# Temperature calibration polynomial (ADC difference -> deg C), highest order first:
+cali_coeffs = [
+    0.00000000000225474,
+    -0.00000000027648357,
+    -0.00000000611604906,
+    0.00005022119088712,
+    0.10392688339191500,
+    24.8772182731984000
+    ]
+
+calibration_file = magi_directory + '/calibration.json'   # optional: replaces cali_coeffs & b_bias
+
+temperature_event_period = 1.0   # period (s) of temperature push events
+temperature_average_window = 0.15   # window (s) of the getTemperature mean
+temperature_history_period = 1.0    # period (s) of saved temperature history samples
+temperature_history_length = 24*3600   # length (s) of temperature history kept
+
+# Online (real-time) TTP detection:
+online_analysis = True           # detect TTPs & hits while sampling
+online_min_rise = 500            # min filtered rise (ROI value units) for a well to be called
+online_plateau_fraction = 0.5    # call a well once its slope falls below this fraction of its peak
+online_decision_time = 60.0      # assay time (min) after which unamplified genes are final
+
+# Analysis:
+analysis_cache_size = 16         # entries per analysis stage cache (analysis.py)
+analysis_processes = None        # worker processes for batch analysis (None: one per CPU)
+result_decimals = 4              # decimals of times (min) & normalized curves sent to the client
+
+# Server:
+server_port = int(os.environ.get('MAGI_PORT', '8080'))
+download_chunk_size = 64*1024   # read size (bytes) for streamed file downloads
+gzip_min_bytes = 16*1024        # gzip action responses at least this large (if the client accepts gzip)
+background_camera_setup = True  # serve requests while the camera is being configured
+camera_ready_timeout = 30.0     # max wait (s) of camera requests for the camera setup
+
 # -------------------------------------
 # Global Decorators
 # -------------------------------------
 
-# Decorator to log the name of the function being called:
+# Decorator to trace calls of a function: every trace_sample_every-th call
+# (starting with the first) is timed and recorded by serverlog.trace(); the
+# other calls only cost a counter increment:
 def log_function_call(func):
+    module = sys.modules.get(func.__module__)
+    module_name = os.path.splitext(os.path.basename(getattr(module, '__file__', None) or func.__module__))[0]
+    name = f'{module_name}.{func.__qualname__}'
+    counter = itertools.count()
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        print(f"Calling function: {func.__name__}", flush=True)
-        sys.stdout.flush()
-        return func(*args, **kwargs)
+        n = next(counter)
+        if n % trace_sample_every:
+            return func(*args, **kwargs)
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            serverlog.trace(name, time.perf_counter() - t0, n + 1)
     return wrapper
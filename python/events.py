@@ -0,0 +1,42 @@
+# Event bus for the server push channel (Server-Sent Events)
+#
+# Producers (acquisition scheduler, PID loop, request handlers) call
+# publish(); each connected /events client owns a bounded queue filled by
+# publish() and drained by its request handler thread.
+
+import json
+import queue
+import threading
+
+subscribers = set()
+subscribers_lock = threading.Lock()
+
+# Register a new client queue:
+def subscribe(maxsize=1000):
+    q = queue.Queue(maxsize=maxsize)
+    with subscribers_lock:
+        subscribers.add(q)
+    return(q)
+
+def unsubscribe(q):
+    with subscribers_lock:
+        subscribers.discard(q)
+
+# Send an event to every subscriber. Events for a client that has stopped
+# reading are dropped rather than blocking the producer:
+def publish(event, data, event_id=None):
+    with subscribers_lock:
+        targets = list(subscribers)
+    for q in targets:
+        try:
+            q.put_nowait((event, data, event_id))
+        except queue.Full:
+            pass
+
+# Encode an event in text/event-stream format:
+def format_event(event, data, event_id=None):
+    message = f'event: {event}\n'
+    if event_id is not None:
+        message += f'id: {event_id}\n'
+    message += f'data: {json.dumps(data)}\n\n'
+    return(message.encode('utf-8'))
@@ -1,15 +1,24 @@
 # Code to filter LAMP data and calulate times to positive (TTPs)
 #
 # Will remove noise due to bubbles and spurious measurement errors
+#
+# scipy.signal and pandas take seconds to import on the Pi, so they are
+# imported on first use rather than when the server starts.
 
+import os
+import logging
 import numpy as np
-from scipy.signal import butter, filtfilt, sosfiltfilt
-import matplotlib.pyplot as plt
-import pandas as pd
 
+import samplelog
+import metrics
 import config   # Cross-module global variables for all Python codes
 from config import log_function_call
 
+log = logging.getLogger('magi.filter_curves')
+
+stage_seconds = metrics.histogram('magi_analysis_stage_seconds', 'Duration of each analysis stage',
+                                  label='stage')
+
 @log_function_call
 def get_ttp(t,y):
     # Calculate slope at midpoint and project back to baseline to find TTP
@@ -25,74 +34,187 @@ def get_ttp(t,y):
             ttp = -b/m     # define ttp as the x-axis intercept
     return ttp
 
-@log_function_call
-def filter(filename, filter_factor=10.0, cut_time=0.0, threshold=0):
-    y_filtered = []
-    ttp = []
+# Batched TTP calculation for normalized curves y (samples x wells): the
+# first sample above 0.5 in each well is found for all wells at once; only
+# the 4-point linear fits use np.polyfit() per well so the results are
+# identical to get_ttp():
+def get_ttps(t, y):
+    npoints = 2    # number of points before and after midpoint for linear fit
+    t = np.asarray(t)
+    above = y > 0.5
+    idx = above.argmax(axis=0)                           # idx of 1st value >0.5
+    valid = above.any(axis=0) & (idx > npoints+1) & (idx < len(t)-npoints)
+    ttp = np.full(y.shape[1], -0.001)   # set initial value slightly less than zero
+    for well in np.flatnonzero(valid):
+        i = idx[well]
+        m,b = np.polyfit(t[i-npoints:i+npoints], y[i-npoints:i+npoints, well], 1)
+        ttp[well] = -b/m     # define ttp as the x-axis intercept
+    return ttp
+
+# Replace spurious dropped data (values < 2) with the last good value,
+# for all wells (columns) at once:
+def repair_dropouts(y):
+    good = y >= 2
+    good[0] = True                       # first value is never replaced
+    good |= np.isnan(y)                  # NaN values are left as they are
+    rows = np.where(good, np.arange(y.shape[0])[:, None], 0)
+    rows = np.maximum.accumulate(rows, axis=0)   # index of last good value
+    return np.take_along_axis(y, rows, axis=0)
+
+# File holding the data of a run: the binary sample log saved next to the
+# CSV file when present (no text parsing), else the CSV file:
+def data_file(filename):
+    log_filename = os.path.splitext(filename)[0] + '.magi'
+    return log_filename if os.path.isfile(log_filename) else filename
+
+# Load run data as a samples x (time + wells) array:
+@metrics.timed(stage_seconds, 'load')
+def load_data(filename):
+    filename = data_file(filename)
+    if filename.endswith('.magi'):
+        return samplelog.to_array(filename)
+    import pandas as pd
     with open(filename) as f:
-        df = pd.read_csv(f, header=None)
-        t = df.iloc[:, 0].tolist()
-        t = [(val-t[0])/60.0 for val in t]       # Start at t=0 and convert sec -> min
-        cut_num = int(cut_time/t[-1] * len(t))   # number of initial data points to drop
-        
-        t = t[cut_num:]                          # Remove initial data points
-        #t = [float(val-t[0]) for val in t]       # start time axis at t=0
-    
-        cols = df.columns[1:]
-    
-        # Set up Butterworth low-pass filter parameters:
-        T = t[-1]                # sample Period (min)
-        n = len(t)               # total number of samples
-        fs = n/T                 # sample rate (cycles/min)
-        f_nyquist = fs/2.0       # Nyquist frequency
-        Wn = f_nyquist/filter_factor    # Low pass cutoff (cycles/min)
-        if Wn >= f_nyquist:      # Wn < f_nyquist required
-            Wn = 0.999*f_nyquist
-        order = 6          # filter order       
-        print(f'filter parameters: n={n}, T={T}, fs={fs}, f_nyquist={f_nyquist}, Wn={Wn}', flush=True)
-
-        # Find TTP for each well:
+        return pd.read_csv(f, header=None).to_numpy(dtype=float)
+
+# The stages of filter() are separate functions so that analysis.py can
+# cache and reuse intermediate results:
+#
+# Time (min) and dropout-repaired data of the first num_wells wells
+# (default: all wells of the card) after dropping data before cut_time:
+@metrics.timed(stage_seconds, 'cut')
+def cut_data(data, cut_time=0.0, num_wells=None):
+    t = (data[:, 0] - data[0, 0])/60.0      # Start at t=0 and convert sec -> min
+    cut_num = int(cut_time/t[-1] * len(t))  # number of initial data points to drop
+    t = t[cut_num:]                         # Remove initial data points
+    # Data for all wells as a (samples x wells) array:
+    if num_wells is None:
         num_wells = len(config.well_config) * len(config.well_config[0])  # rows * cols
-        for idx in range(1,num_wells+1):
-            y = df.iloc[:,idx].tolist()
-            y = y[cut_num:]          # Remove initial data points
-            y = [float(val) for val in y]
-    
-            # Remove spurious dropped data:
-            for i,val in enumerate(y):
-                if val < 2 and i>0:
-                    y[i] = y[i-1]
-
-            # Implement the Butterworth low-pass filter:
-            #
-            # Pre-SOS filter:
-            # b, a = butter(order, Wn, btype='low', analog=False, fs=fs)
-            # yf = filtfilt(b, a, y)   # filtered data
-            #
-            # SOS filter is a better option:
-            sos = butter(order, Wn, btype='low', analog=False, fs=fs, output='sos')
-            yf = sosfiltfilt(sos, y)   # filtered data
-            # print(yf, flush=True)
-
-            # shift curves to min value:
-            #y_shifted = [x-min(yf) for x in y]
-            yf_shifted = [x-min(yf) for x in yf]
-    
-            # normalize to max value:
-            #y_norm = [x/max(yf_shifted) for x in y_shifted]
-            yf_norm = [x/max(yf_shifted) for x in yf_shifted]
-
-            # If original data is below the given threshold value (noise background),
-            # set all normed values to zero:
-            if max(y) < threshold:
-                yf_norm = [0 for _ in yf_norm]
-
-            yf_dict = [{'x':t[i], 'y':yf_norm[i]} for i in range(len(t))]
-            y_filtered.append(yf_dict)
-
-            ttp.append(get_ttp(t,yf_norm))
-            
-    return({'ttp': ttp, 'y_filt': y_filtered})
+    y = data[cut_num:, 1:num_wells+1]       # Remove initial data points
+    y = repair_dropouts(y)                  # Remove spurious dropped data
+    return t, y
+
+min_samples = 22   # sosfiltfilt() of the order 6 filter pads 21 samples at each end
+
+# Low-pass filtered curves, shifted to their min value & normalized to
+# their max value:
+@metrics.timed(stage_seconds, 'smooth')
+def smooth(t, y, filter_factor=10.0):
+    from scipy.signal import butter, sosfiltfilt
+    # Set up Butterworth low-pass filter parameters:
+    T = t[-1]                # sample Period (min)
+    n = len(t)               # total number of samples
+    fs = n/T                 # sample rate (cycles/min)
+    f_nyquist = fs/2.0       # Nyquist frequency
+    Wn = f_nyquist/filter_factor    # Low pass cutoff (cycles/min)
+    if Wn >= f_nyquist:      # Wn < f_nyquist required
+        Wn = 0.999*f_nyquist
+    order = 6          # filter order
+    log.debug(f'filter parameters: n={n}, T={T}, fs={fs}, f_nyquist={f_nyquist}, Wn={Wn}')
+
+    # Implement the Butterworth low-pass filter, designed once and applied
+    # to all wells:
+    #
+    # Pre-SOS filter:
+    # b, a = butter(order, Wn, btype='low', analog=False, fs=fs)
+    # yf = filtfilt(b, a, y, axis=0)   # filtered data
+    #
+    # SOS filter is a better option:
+    sos = butter(order, Wn, btype='low', analog=False, fs=fs, output='sos')
+    yf = sosfiltfilt(sos, y, axis=0)   # filtered data
+
+    # shift curves to min value & normalize to max value:
+    yf_shifted = yf - yf.min(axis=0)
+    return yf_shifted/yf_shifted.max(axis=0)
+
+# If original data is below the given threshold value (noise background),
+# set all normed values to zero. Returns the thresholded curves and TTPs;
+# ttp, if given, holds the TTPs of the unthresholded curves (a zeroed well
+# has no TTP, so they are not recalculated):
+@metrics.timed(stage_seconds, 'threshold')
+def apply_threshold(t, y, yf_norm, threshold, ttp=None):
+    below = y.max(axis=0) < threshold
+    if below.any():
+        yf_norm = yf_norm.copy()
+        yf_norm[:, below] = 0
+    if ttp is None:
+        ttp = get_ttps(t, yf_norm)
+    else:
+        ttp = np.where(below, -0.001, ttp)
+    return yf_norm, ttp
 
+# Results in the column-oriented format returned to the client:
+#   {'ttp': [TTP of each well], 't': [time (min)], 'y': [[curve of well 1], [well 2], ...]}
+# with times and (normalized) curves rounded to config.result_decimals:
+@metrics.timed(stage_seconds, 'format')
+def format_results(t, yf_norm, ttp):
+    return({'ttp': ttp.tolist(),
+            't': np.round(t, config.result_decimals).tolist(),
+            'y': np.round(yf_norm.T, config.result_decimals).tolist()})
 
+# Groups of three digits for csv_text(), indexed by group value + one of:
+digits_full = 0       # '007'
+digits_lead = 1000    # '7' ('' for 0): leading group of the integer part
+digits_trail = 2000   # '007', '5' for 500 ('' for 0): last group of the decimals
+digits_units = 3000   # '7' ('0' for 0): integer part below 1000
+digit_groups = np.array([f'{i:03d}' for i in range(1000)] + [str(i) if i else '' for i in range(1000)]
+                        + [f'{i:03d}'.rstrip('0') for i in range(1000)] + [str(i) for i in range(1000)],
+                        dtype='S3')
 
+# CSV text (bytes) of a 2-D array with 6 decimals (trailing zeros dropped,
+# 'nan'/'inf' for non-finite values), without formatting each value in
+# Python: the integer part and the decimals are split into groups of three
+# digits, looked up in digit_groups and stored in the fields of one record
+# per value (sign, digit groups, '.', decimals, separator). The table pads
+# with zero bytes, which are deleted from the records at the end:
+def csv_text(data):
+    finite = np.isfinite(data)
+    q = np.rint(np.abs(np.where(finite, data, 0))*1e6).astype(np.int64)
+    whole, fraction = np.divmod(q, 1000000)
+    groups = (max(len(str(whole.max())) if whole.size else 1, 1) + 2)//3
+    record = ([('sign', 'S1')] + [(f'whole{i}', 'S3') for i in range(groups)]
+              + [('point', 'S1'), ('decimals0', 'S3'), ('decimals1', 'S3'), ('separator', 'S1')])
+    text = np.zeros(data.shape, dtype=record)
+    text['sign'] = np.where((data < 0) & ((q > 0) | ~finite), b'-', b'')    # no '-0'
+    leading = np.ones(data.shape, dtype=bool)      # no non-zero digit yet
+    for i in range(groups - 1):
+        group = whole//1000**(groups - 1 - i) % 1000
+        text[f'whole{i}'] = digit_groups[group + digits_lead*leading]
+        leading &= group == 0
+    units = text[f'whole{groups - 1}']
+    units[...] = digit_groups[whole % 1000 + digits_units*leading]
+    units[np.isnan(data)] = b'nan'
+    units[np.isinf(data)] = b'inf'
+    high, low = np.divmod(fraction.astype(np.int32), 1000)
+    text['point'] = np.where(fraction > 0, b'.', b'')
+    text['decimals0'] = digit_groups[high + digits_trail*(low == 0)]
+    text['decimals1'] = digit_groups[low + digits_trail]
+    text['separator'] = b','
+    text['separator'][:, -1] = b'\n'
+    return(text.tobytes().translate(None, b'\0'))
+
+# Save filtered curves as CSV (time (min), then one column per well). The
+# file is written to a temp file that then replaces it, so a new analysis
+# overwrites the previous one and a download never gets a partly written
+# file. Rows are formatted by csv_text() in blocks of csv_block_rows:
+csv_block_rows = 1024
+
+@metrics.timed(stage_seconds, 'save')
+def save_filtered(filename, t, yf_norm):
+    header = ','.join(['time (min)'] + [f'well {i}' for i in range(yf_norm.shape[1])])
+    data = np.column_stack([t, yf_norm])
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        f.write(header.encode() + b'\n')
+        for i in range(0, len(data), csv_block_rows):
+            f.write(csv_text(data[i:i + csv_block_rows]))
+    os.replace(temp_filename, filename)
+
+@log_function_call
+@metrics.timed(stage_seconds, 'total')
+def filter(filename, filter_factor=10.0, cut_time=0.0, threshold=0):
+    data = load_data(filename)              # samples x (time + wells)
+    t, y = cut_data(data, cut_time)
+    yf_norm = smooth(t, y, filter_factor)
+    yf_norm, ttp = apply_threshold(t, y, yf_norm, threshold)
+    return format_results(t, yf_norm, ttp)
@@ -0,0 +1,324 @@
+# Multi-imager fleet coordinator
+#
+# Drives several MAGI servers (units) as one. Each unit keeps a pool of
+# persistent HTTP/1.1 connections (no TCP setup per request), and actions
+# are fanned out to all units concurrently from a thread pool. Samples of
+# all units are merged into one time-aligned dataset, and TTPs and hits of
+# all units are computed centrally. Sampling is either:
+#
+#   sample()         coordinator driven: getImageData on all units at once,
+#                    one row per tick, stamped with the coordinator's clock
+#   start(period)    server-side sampling on each unit; collect() polls
+#                    getSamples and merge() interpolates the units' samples
+#                    onto a common time grid (unit clocks are synchronized
+#                    by NTP, see pi_setup/setup.sh)
+#
+# simulate(n) starts n local simulated servers (MAGI_SIMULATE=1) for testing.
+#
+#   python3 fleet.py --simulate 4 --card ../assay_cards/example.card --samples 60
+#   python3 fleet.py --card CARD --period 15 --samples 240 pi1:8080 pi2:8080 ...
+
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import filter_curves
+import assay_card
+from config import log_function_call
+
+log = logging.getLogger('magi.fleet')
+
+# One MAGI server:
+class Unit:
+    def __init__(self, address, pool_size=4, timeout=60.0):
+        host, _, port = address.partition(':')
+        self.name = address
+        self.host, self.port = host, int(port or 8080)
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(maxsize=pool_size)   # idle persistent connections
+        self.samples = []       # samples collected from getSamples
+        self.next_index = 0
+
+    # Send a request on an idle pooled connection (or a new one); returns
+    # (status, body). A pooled connection the server has closed meanwhile
+    # is replaced and the request sent again:
+    def request(self, method, path, body=None, headers={}):
+        while True:
+            try:
+                conn, reused = self.idle.get_nowait(), True
+            except queue.Empty:
+                conn, reused = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                try:
+                    self.idle.put_nowait(conn)
+                except queue.Full:
+                    conn.close()
+            return(response.status, data)
+
+    # POST an action (as the client does); returns the response text:
+    def post(self, action, data=''):
+        body = ('todo=' + json.dumps([action, data])).encode('utf-8')
+        status, response = self.request('POST', '/', body, {'Content-Type': 'text/plain'})
+        if status != 200:
+            raise RuntimeError(f'{self.name}: {action} failed (HTTP {status})')
+        return(response.decode('utf-8'))
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+# ROI values from a getImageData response:
+def parse_values(text):
+    return([float(v) for v in text.split(',')] if text else [])
+
+class Fleet:
+    def __init__(self, addresses, pool_size=4, timeout=60.0):
+        self.units = [Unit(address, pool_size, timeout) for address in addresses]
+        self.workers = ThreadPoolExecutor(max_workers=2*max(len(self.units), 1))
+        self.card = None
+        self.rows = []          # coordinator-driven samples: (time, {unit: values})
+
+    # Call an action on all units concurrently. Returns {unit name: result},
+    # where the result of a failed unit is the exception:
+    def fan_out(self, action, data='', parse=None):
+        futures = {unit.name: self.workers.submit(unit.post, action, data) for unit in self.units}
+        results = {}
+        for (name, future) in futures.items():
+            try:
+                result = future.result()
+                results[name] = parse(result) if parse else result
+            except Exception as e:
+                log.warning(f'{name}: {action}: {e}')
+                results[name] = e
+        return(results)
+
+    def ping(self):
+        return(self.fan_out('ping'))
+
+    # Load the same card on all units:
+    @log_function_call
+    def setup_assay(self, card_file):
+        with open(card_file) as f:
+            card_dict = json.load(f)
+        self.card = assay_card.load(card_file)
+        return(self.fan_out('setupAssay', {'card_filename': os.path.basename(card_file),
+                                           'card_dict': card_dict}))
+
+    # Start the assay on all units (with server-side sampling every `period`
+    # seconds if given):
+    @log_function_call
+    def start(self, period=None):
+        self.rows = []
+        for unit in self.units:
+            unit.samples, unit.next_index = [], 0
+        return(self.fan_out('start', {'period': period} if period else ''))
+
+    # One coordinator-driven sample of all units:
+    def sample(self):
+        t = time.time()
+        values = self.fan_out('getImageData', parse=parse_values)
+        self.rows.append((t, values))
+        return(values)
+
+    def get_temperature(self):
+        return(self.fan_out('getTemperature', parse=float))
+
+    # Fetch the new server-side samples of all units:
+    def collect(self):
+        def fetch(unit):
+            new = json.loads(unit.post('getSamples', {'since': unit.next_index}))
+            if new:
+                unit.samples += new
+                unit.next_index = new[-1]['index'] + 1
+            return(len(new))
+        futures = [self.workers.submit(fetch, unit) for unit in self.units]
+        return(sum(future.result() for future in futures))
+
+    @log_function_call
+    def end_assay(self):
+        return(self.fan_out('endAssay'))
+
+    # Number of ROI values of each unit:
+    def widths(self):
+        if self.card is not None:
+            return([self.card.num_wells]*len(self.units))
+        widths = [0]*len(self.units)
+        for (t, values) in self.rows:
+            for (i, unit) in enumerate(self.units):
+                if isinstance(values[unit.name], list):
+                    widths[i] = max(widths[i], len(values[unit.name]))
+        for (i, unit) in enumerate(self.units):
+            if unit.samples:
+                widths[i] = max(widths[i], len(unit.samples[0]['values']))
+        return(widths)
+
+    # Time-aligned dataset of all units as a (samples x (1 + values)) array
+    # in the run CSV layout (unix time, then the values of each unit in
+    # turn), and the column names. A value missing from a sample (failed
+    # request) is 0, which analysis treats as a dropout (replaced by the
+    # last good value):
+    def dataset(self):
+        widths = self.widths()
+        names = ['time'] + [f'{unit.name}:{i}' for (unit, w) in zip(self.units, widths) for i in range(w)]
+        if self.rows:
+            data = np.zeros((len(self.rows), 1 + sum(widths)))
+            for (r, (t, values)) in enumerate(self.rows):
+                data[r, 0] = t
+                column = 1
+                for (unit, w) in zip(self.units, widths):
+                    v = values[unit.name]
+                    if isinstance(v, list) and len(v) == w:
+                        data[r, column:column+w] = v
+                    column += w
+            return(data, names)
+        return(self.merge(), names)
+
+    # Server-side samples of all units interpolated onto a common time grid:
+    # the sample period of the first unit, over the time all units sampled:
+    def merge(self):
+        series = [(np.array([s['time'] for s in unit.samples]),
+                   np.array([s['values'] for s in unit.samples], dtype=float)) for unit in self.units]
+        if any(len(t) < 2 for (t, values) in series):
+            return(np.zeros((0, 1 + sum(self.widths()))))
+        period = float(np.median(np.diff(series[0][0])))
+        t0 = max(t[0] for (t, values) in series)
+        t1 = min(t[-1] for (t, values) in series)
+        grid = np.arange(t0, t1 + period/2, period)
+        columns = [grid] + [np.interp(grid, t, values[:, i])
+                            for (t, values) in series for i in range(values.shape[1])]
+        return(np.column_stack(columns))
+
+    # Filter the dataset of all units at once and return per-unit TTPs and,
+    # with a card, the positive targets of all units (classified in one
+    # operation): {unit name: {'ttp': [...], 'hits': [...]}}. A run too
+    # short to filter gives {unit name: {'error': ...}}:
+    @log_function_call
+    def analyze(self, filter_factor=10.0, cut_time=0.0, threshold=0):
+        data, names = self.dataset()
+        if len(data) < filter_curves.min_samples:
+            error = f'{len(data)} samples, at least {filter_curves.min_samples} needed to filter the curves'
+            log.warning(f'analyze: {error}')
+            return({unit.name: {'error': error} for unit in self.units})
+        t, y = filter_curves.cut_data(data, cut_time, data.shape[1] - 1)
+        yf_norm = filter_curves.smooth(t, y, filter_factor)
+        yf_norm, ttp = filter_curves.apply_threshold(t, y, yf_norm, threshold)
+        widths = self.widths()
+        bounds = np.cumsum([0] + widths)
+        results = {unit.name: {'ttp': ttp[bounds[i]:bounds[i+1]].tolist()}
+                   for (i, unit) in enumerate(self.units)}
+        if self.card is not None and len(set(widths)) == 1:
+            positive = self.card.classify(ttp.reshape(len(self.units), widths[0]))   # units x targets
+            for (unit, hits) in zip(self.units, positive):
+                results[unit.name]['hits'] = [target for (target, hit) in zip(self.card.targets, hits) if hit]
+        return(results)
+
+    # Save the dataset as CSV (run CSV layout, with a header row):
+    def save(self, filename):
+        data, names = self.dataset()
+        np.savetxt(filename, data, fmt='%.6f', delimiter=',', header=','.join(names), comments='')
+
+    def close(self):
+        for unit in self.units:
+            unit.close()
+        self.workers.shutdown()
+
+# Start n simulated MAGI servers on local ports port, port+1, ... Each has
+# its own home directory (log, data). Returns [(address, process, directory)]
+# once all answer ping:
+def simulate(n, port=18100, time_scale=1.0, timeout=30.0):
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'magi_server.py')
+    fonts = os.path.realpath(os.path.join(os.path.dirname(server), '..', 'fonts'))
+    units = []
+    for i in range(n):
+        directory = tempfile.mkdtemp(prefix=f'magi_unit{i}_')
+        os.makedirs(directory + '/magi/data')
+        if os.path.isdir(fonts):
+            os.symlink(fonts, directory + '/magi/fonts')
+        env = dict(os.environ, HOME=directory, MAGI_SIMULATE='1', MAGI_PORT=str(port + i),
+                   MAGI_DATA_DIRECTORY=directory + '/magi/data', MAGI_TIME_SCALE=str(time_scale))
+        with open(directory + '/magi/magi_server.out', 'w') as out:
+            process = subprocess.Popen([sys.executable, server], env=env, cwd=os.path.dirname(server),
+                                       stdout=out, stderr=subprocess.STDOUT)
+        units.append((f'localhost:{port + i}', process, directory))
+    deadline = time.monotonic() + timeout
+    for (address, process, directory) in units:
+        unit = Unit(address, timeout=1.0)
+        while True:
+            try:
+                unit.post('ping')
+                break
+            except OSError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    stop_simulated(units)
+                    raise RuntimeError(f'simulated server {address} did not start (see {directory}/magi)')
+                time.sleep(0.05)
+        unit.close()
+    return(units)
+
+def stop_simulated(units):
+    for (address, process, directory) in units:
+        process.terminate()
+    for (address, process, directory) in units:
+        process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run an assay on several MAGI units')
+    parser.add_argument('units', nargs='*', help='HOST[:PORT] of each unit')
+    parser.add_argument('--simulate', type=int, default=0, help='start N local simulated units')
+    parser.add_argument('--card', required=True, help='assay card file')
+    parser.add_argument('--period', type=float, default=1.0, help='sample period (s)')
+    parser.add_argument('--samples', type=int, default=60,
+                        help=f'number of samples (at least {filter_curves.min_samples} to analyze)')
+    parser.add_argument('--server-sampling', action='store_true', help='sample on the units (start with period)')
+    parser.add_argument('--output', default='fleet_data.csv', help='merged dataset CSV')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    simulated = simulate(args.simulate) if args.simulate else []
+    fleet = Fleet(args.units + [address for (address, process, directory) in simulated])
+    try:
+        fleet.setup_assay(args.card)
+        fleet.start(args.period if args.server_sampling else None)
+        t_next = time.monotonic()
+        for i in range(args.samples):
+            if not args.server_sampling:
+                fleet.sample()
+            t_next += args.period
+            time.sleep(max(t_next - time.monotonic(), 0))
+        if args.server_sampling:
+            fleet.collect()
+        fleet.end_assay()
+        fleet.save(args.output)
+        for (name, result) in fleet.analyze().items():
+            if 'error' in result:
+                print(f"{name}: {result['error']}", flush=True)
+            else:
+                print(f"{name}: hits {result.get('hits')}, TTPs {np.round(result['ttp'], 2).tolist()}", flush=True)
+    finally:
+        fleet.close()
+        stop_simulated(simulated)
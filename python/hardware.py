@@ -0,0 +1,304 @@
+# Hardware abstraction layer
+#
+# The server talks to the camera through the small subset of the Picamera2
+# API used in imager.py, to the GPIO pins through the RPi.GPIO API and to
+# the temperature sensors through gpiozero.MCP3008. With MAGI_SIMULATE=1
+# these are replaced by simulated backends implementing the same subsets:
+#
+#   SyntheticCamera  - frames from a frame source: sensor noise, recorded
+#                      frames (ReplayFrames) or synthetic LAMP amplification
+#                      curves in the card's ROIs (AmplificationFrames)
+#   SimulatedGPIO    - pin states and heater PWM duty cycle
+#   SimulatedMCP3008 - ADC readings of a first-order thermal plant heated
+#                      through the simulated PWM pin
+#
+# so the whole server can run and be benchmarked on a Linux workstation.
+
+import os
+import time
+import threading
+
+import numpy as np
+
+import config   # Cross-module global variables for all Python codes
+
+# Clock used by libcamera for SensorTimestamp metadata:
+def sensor_clock_ns():
+    try:
+        return(time.clock_gettime_ns(time.CLOCK_BOOTTIME))
+    except AttributeError:    # not Linux
+        return(time.monotonic_ns())
+
+# Return a Picamera2 instance, or a SyntheticCamera when simulating hardware:
+def open_camera():
+    if config.simulate_hardware:
+        if config.replay_frames:
+            return(SyntheticCamera(frame_source=ReplayFrames(config.replay_frames)))
+        return(SyntheticCamera(frame_source=AmplificationFrames(config.simulation_time_scale)))
+    from picamera2 import Picamera2
+    return(Picamera2())
+
+# Default synthetic frame source: dark background with sensor noise:
+def noise_frame(size, rng=np.random.default_rng()):
+    w, h = size
+    return(rng.integers(0, 32, size=(h, w, 3), dtype=np.uint8))
+
+# Frame source replaying recorded frames (.npy arrays or image files) from
+# a directory, in file name order, looping at the end:
+class ReplayFrames:
+    def __init__(self, directory):
+        self.files = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                            if name.lower().endswith(('.npy', '.png', '.jpg', '.bmp', '.tif')))
+        if not self.files:
+            raise FileNotFoundError(f'no frames in {directory}')
+        self.index = 0
+
+    def __call__(self, size):
+        filename = self.files[self.index % len(self.files)]
+        self.index += 1
+        if filename.endswith('.npy'):
+            return(np.load(filename))
+        from PIL import Image
+        with Image.open(filename) as image:
+            return(np.asarray(image.convert('RGB')))
+
+# Frame source drawing synthetic LAMP amplification curves into the ROIs
+# of the current card (config.ROIs). Each well follows a sigmoid with a
+# random TTP (some wells never amplify). time_scale speeds up assay time
+# relative to wall-clock time:
+class AmplificationFrames:
+    def __init__(self, time_scale=1.0, seed=0, background=30, baseline=30, amplitude=40):
+        self.rng = np.random.default_rng(seed)
+        self.time_scale = time_scale
+        self.background = background
+        self.baseline = baseline
+        self.amplitude = amplitude
+        self.t0 = time.monotonic()
+        self.ttp = {}          # well index -> TTP (min), inf for negative wells
+
+    def well_level(self, well, t_min):
+        if well not in self.ttp:
+            self.ttp[well] = self.rng.uniform(10, 40) if self.rng.random() < 0.7 else np.inf
+        return(self.baseline + self.amplitude/(1 + np.exp(-(t_min - self.ttp[well] - 5)/2.5)))
+
+    def __call__(self, size):
+        w, h = size
+        t_min = (time.monotonic() - self.t0)*self.time_scale/60
+        frame = self.rng.integers(0, self.background, size=(h, w, 3), dtype=np.uint8)
+        for (well, roi) in enumerate(config.ROIs):
+            x, y = int(roi['x']), int(roi['y'])
+            level = self.well_level(well, t_min)
+            box = frame[y:y+config.roi_height, x:x+config.roi_width, 1]
+            box[:] = np.clip(level + self.rng.normal(0, 2, box.shape), 0, 255)
+        return(frame)
+
+# Completed request returned by SyntheticCamera.capture_request():
+class SyntheticRequest:
+    def __init__(self, frame, metadata):
+        self.frame = frame
+        self.metadata = metadata
+
+    def make_array(self, name="main"):
+        return(self.frame)
+
+    def make_image(self, name="main"):
+        from PIL import Image
+        return(Image.fromarray(self.frame))
+
+    def get_metadata(self):
+        return(self.metadata)
+
+    def release(self):
+        self.frame = None
+
+class SyntheticCamera:
+    # frame_source(size) must return an (h, w, 3) uint8 array.
+    # start_latency_s models the pipeline spin-up time of cam.start(); frames
+    # are then delivered every FrameDuration (at least the exposure time).
+    def __init__(self, frame_source=noise_frame, start_latency_s=0.0, min_frame_duration_s=1/30):
+        self.frame_source = frame_source
+        self.start_latency_s = start_latency_s
+        self.min_frame_duration_s = min_frame_duration_s
+        self.size = (640, 480)
+        self.controls = {"ExposureTime": 50000, "AnalogueGain": 1.0}
+        self.started = False
+        self.first_frame_ns = 0
+        self.sequence = 0
+
+    def create_still_configuration(self, main=None, **kwargs):
+        return({'main': dict(main or {})})
+
+    def configure(self, cam_config):
+        self.size = tuple(cam_config['main'].get('size', self.size))
+
+    def set_controls(self, controls):
+        self.controls.update(controls)
+
+    def frame_duration_ns(self):
+        exposure_s = self.controls.get("ExposureTime", 0)/1e6
+        return(int(max(exposure_s, self.min_frame_duration_s)*1e9))
+
+    def start(self):
+        time.sleep(self.start_latency_s)
+        self.first_frame_ns = sensor_clock_ns()
+        self.sequence = 0
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+    def close(self):
+        self.started = False
+
+    # Wait for the next frame to finish exposing; SensorTimestamp is the
+    # start of its exposure:
+    def capture_request(self, name="main"):
+        if not self.started:
+            raise RuntimeError('camera not started')
+        period = self.frame_duration_ns()
+        now = sensor_clock_ns()
+        n = max(self.sequence, (now - self.first_frame_ns)//period + 1)
+        exposure_start = self.first_frame_ns + n*period
+        delay = (exposure_start + period - now)/1e9
+        if delay > 0:
+            time.sleep(delay)
+        self.sequence = n + 1
+        metadata = {
+            "SensorTimestamp": exposure_start,
+            "ExposureTime": self.controls.get("ExposureTime"),
+            "AnalogueGain": self.controls.get("AnalogueGain"),
+            "FrameDuration": period//1000,
+            }
+        return(SyntheticRequest(self.frame_source(self.size), metadata))
+
+    def capture_array(self, name="main"):
+        request = self.capture_request(name)
+        frame = request.make_array(name)
+        request.release()
+        return(frame)
+
+    def capture_image(self, name="main"):   # same conversion Picamera2 does
+        from PIL import Image
+        return(Image.fromarray(self.capture_array(name)))
+
+# Subset of the RPi.GPIO API, recording pin states:
+class SimulatedGPIO:
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self):
+        self.pins = {}
+        self.lock = threading.Lock()
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, mode, initial=0):
+        with self.lock:
+            self.pins[pin] = initial
+
+    def output(self, pin, state):
+        with self.lock:
+            self.pins[pin] = state
+
+    def input(self, pin):
+        return(self.pins.get(pin, 0))
+
+    def cleanup(self):
+        with self.lock:
+            self.pins.clear()
+
+    def PWM(self, pin, frequency):
+        return(SimulatedPWM(self, pin, frequency))
+
+# Heater PWM output; the duty cycle drives the simulated thermal plant:
+class SimulatedPWM:
+    def __init__(self, gpio, pin, frequency):
+        self.gpio = gpio
+        self.pin = pin
+        self.frequency = frequency
+        self.duty_cycle = 0.0
+
+    def start(self, duty_cycle):
+        self.ChangeDutyCycle(duty_cycle)
+
+    def ChangeDutyCycle(self, duty_cycle):
+        plant.update()          # integrate up to now with the previous duty cycle
+        self.duty_cycle = float(duty_cycle)
+        plant.duty_cycle = self.duty_cycle
+
+    def stop(self):
+        self.ChangeDutyCycle(0)
+
+# First-order thermal model of the heated card:
+#   C dT/dt = P*duty/100 - (T - T_ambient)/R
+class ThermalPlant:
+    def __init__(self, ambient=23.0, heater_power=4.0, heat_capacity=10.0, thermal_resistance=20.0):
+        self.ambient = ambient
+        self.heater_power = heater_power              # W at 100% duty cycle
+        self.heat_capacity = heat_capacity            # J/K
+        self.thermal_resistance = thermal_resistance  # K/W
+        self.temperature = ambient
+        self.duty_cycle = 0.0
+        self.t_last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def update(self):
+        with self.lock:
+            now = time.monotonic()
+            dt = now - self.t_last
+            self.t_last = now
+            tau = self.heat_capacity*self.thermal_resistance
+            t_final = self.ambient + self.heater_power*self.duty_cycle/100*self.thermal_resistance
+            self.temperature = t_final + (self.temperature - t_final)*np.exp(-dt/tau)
+            return(self.temperature)
+
+plant = ThermalPlant()
+
+# ADC difference (sensor - reference channel) for a temperature, found by
+# inverting the calibration polynomial (config.cali_coeffs) over the 10-bit
+# ADC range:
+adc_reference = 50              # raw value of the reference channel (0)
+_adc_grid = np.arange(0, 1024 - adc_reference)
+_adc_temps = np.polyval(config.cali_coeffs, _adc_grid)
+
+def temperature_to_adc(temperature):
+    return(np.interp(temperature, _adc_temps, _adc_grid))
+
+# gpiozero.MCP3008 stand-in: channel 0 is the reference voltage, channels
+# 1 and 2 the bottom and top temperature sensors (the top sensor reads
+# sensor_offset degrees lower):
+class SimulatedMCP3008:
+    sensor_offset = {1: 0.0, 2: -1.5}
+
+    def __init__(self, channel=0, noise_lsb=0.5, rng=None):
+        self.channel = channel
+        self.noise_lsb = noise_lsb
+        self.rng = rng or np.random.default_rng(channel)
+
+    @property
+    def raw_value(self):
+        if self.channel == 0:
+            raw = adc_reference
+        else:
+            temperature = plant.update() + self.sensor_offset.get(self.channel, 0.0)
+            raw = adc_reference + temperature_to_adc(temperature)
+        raw += self.rng.normal(0, self.noise_lsb)
+        return(int(min(max(round(raw), 0), 1023)))
+
+    @property
+    def value(self):
+        return(self.raw_value/1023)
+
+if config.simulate_hardware:
+    GPIO = SimulatedGPIO()
+    MCP3008 = SimulatedMCP3008
+else:
+    import RPi.GPIO as GPIO
+    from gpiozero import MCP3008
@@ -1,12 +1,19 @@
 import time
-from picamera2 import Picamera2
 import numpy as np
-import csv
 import json
 import os
-import sys
+import threading
+import logging
+import functools
+import concurrent.futures
+import analysis
 import filter_curves
-import RPi.GPIO as GPIO
+import roi_engine
+import registration
+import samplelog
+import hardware
+import metrics
+from hardware import GPIO
 from PIL import Image, ImageDraw, ImageFont
 import base64
 from io import BytesIO
@@ -14,7 +21,8 @@ from io import BytesIO
 import config   # Cross-module global variables for all Python codes
 from config import log_function_call
 
-import signal
+log = logging.getLogger('magi.imager')
+
 
 GPIO.setmode(GPIO.BCM)
 GPIO.setup(config.IMAGER_LED_PIN, GPIO.OUT, initial=GPIO.LOW) 
@@ -24,105 +32,142 @@ w = 640         # min of 64, max of 2592 for 5MP camera
 h = int(3*w/4)  # native 4:3 aspect ratio
 res = (w,h)  
 
-cam = Picamera2() 
+cam = hardware.open_camera()   # Picamera2, or SyntheticCamera when simulating
+
+stage_times = {}     # duration (s) of each stage of the last get_image_data() call
+streaming = False    # True while the camera is kept running between captures
+frame_metadata = {}  # exposure metadata of the last LED-on frame
+camera_lock = threading.RLock()   # serializes camera access between threads
+camera_ready = threading.Event()  # set once setup_camera() has configured the camera
+exposure_us = 50000  # exposure time set by adjust_settings()
+sample_log = None    # samplelog.SampleLog of the current assay
+sample_log_lock = threading.Lock()
+
+sample_seconds = metrics.histogram('magi_sample_stage_seconds',
+                                   'Duration of each stage of taking a sample (capture, roi, write, total)',
+                                   label='stage')
+samples_taken = metrics.counter('magi_samples_total', 'Samples taken (ROI values stored)')
+sample_errors = metrics.counter('magi_sample_errors_total', 'Failed samples')
 
-# Create a flat list of ROI dicts from well_config 2D array:
+# Set up the ROIs (flat list of ROI dicts) of the current card:
 @log_function_call
 def setup_ROIs():
-    config.ROIs = []
-    rows = len(config.well_config)
-    for r in range(rows):
-        cols = config.well_cols = len(config.well_config[0])
-        for c in range(cols):
-            config.ROIs.append( {
-                "target": str(config.well_config[r][c]),
-                "x": config.roi_upper_left[0] + config.roi_spacing_x * c,
-                "y": config.roi_upper_left[1] + config.roi_spacing_y * r
-                } )
-    print(config.ROIs, flush=True)
-    sys.stdout.flush()
-
-
-def hex_to_rgb(h):   # convert "#rrggbb" to [R,G,B]
-    return [int(h[i:i+2], 16) for i in (1, 3, 5)]
+    config.ROIs = config.card.rois()   # precomputed by the compiled card
+    config.well_cols = config.card.cols
+    roi_engine.build_index()   # precompute ROI pixel indexes
+    overlays.clear()           # ROI annotation layers are rebuilt for the new card
+    log.debug(f'ROIs: {config.ROIs}')
+
+
+# Fonts are loaded once per size:
+@functools.lru_cache(maxsize=None)
+def load_font(size):
+    return(ImageFont.truetype(config.font_directory + "/" + "OpenSans.ttf", size))
+
+# Static annotation layers (card name, and optionally the ROI boxes), cropped
+# to their bounding box: (img size, add_roi, card) -> [(RGBA layer, position,
+# follows registration)]. The ROI boxes are drawn at the card positions and
+# shifted by roi_engine.offset when pasted, so drift does not add entries.
+# Cleared by setup_ROIs() when a new card is loaded:
+overlays = {}
+
+def cropped(layer, shifted):
+    bbox = layer.getbbox()
+    return([(layer.crop(bbox), bbox[:2], shifted)] if bbox else [])
+
+# [(layer, paste position)] for an image of `size`:
+def get_overlay(size, add_roi):
+    key = (size, add_roi, config.card_filename)
+    if key not in overlays:
+        layer = Image.new('RGBA', size, (255, 255, 255, 0))
+        ImageDraw.Draw(layer).text((10,10), config.card_filename, font=load_font(12))
+        layers = cropped(layer, False)
+        if add_roi and config.card is not None:     # no ROIs before a card is loaded
+            layer = Image.new('RGBA', size, (255, 255, 255, 0))  # create new image with ROIs only
+            draw = ImageDraw.Draw(layer)
+            font = load_font(9)
+            card = config.card
+            for (x, y, gene) in zip(card.x.tolist(), card.y.tolist(), card.gene_index.tolist()):
+                roi_lower_right = (x + card.roi_width, y + card.roi_height)
+                draw.rectangle([(x,y), roi_lower_right], outline='#ffffff', fill=card.fill_colors[gene])   # Draw ROI
+                text_position = (x + card.roi_width + 1, y)
+                draw.text(text_position, card.genes[gene],'#ffffff',font=font)    # Add well target text
+            layers += cropped(layer, True)
+        overlays[key] = layers
+    dx, dy = roi_engine.offset   # ROI positions corrected by registration
+    return([(layer, (x + dx, y + dy) if shifted else (x, y)) for (layer, (x, y), shifted) in overlays[key]])
 
 @log_function_call
 def annotate_image(img, add_roi=False):      # Add timestamp and ROIs to image
     try:
-        img = img.convert('RGBA')   # convert captured image to support an alpha channel
-        img_tmp = Image.new('RGBA', img.size, (255, 255, 255, 0))  # create new image with ROIs only
-        draw = ImageDraw.Draw(img_tmp)
+        img = img.convert('RGB')   # copy of the captured image to draw on
+        for (layer, position) in get_overlay(img.size, add_roi):
+            img.paste(layer, position, layer)    # blend the cached card name & ROI layers
         # add timestamp:
-        font = ImageFont.truetype(config.font_directory + "/" + "OpenSans.ttf", 12) 
-        draw.text((10,10), config.card_filename, font=font)  
+        draw = ImageDraw.Draw(img)
         month = time.strftime('%b')
         day = time.strftime('%d')
         year = time.strftime('%Y')
-        draw.text((10,20), f'{month} {day} {year} @ {time.strftime("%H:%M:%S")}', font=font)
+        draw.text((10,20), f'{month} {day} {year} @ {time.strftime("%H:%M:%S")}', font=load_font(12))
         # draw.text((10,20), time.strftime("%Y%m%d_%H:%M:%S"), font=font)
-        # add ROIs:
-        if add_roi:
-            for roi in config.ROIs:
-                roi_lower_right = (roi['x'] + config.roi_width, roi['y'] + config.roi_height)
-                idx = config.gene_names.index(roi['target'])      # find index in gene_names matching current ROI targe
-                fill_color = hex_to_rgb(config.gene_colors[idx])  # convert "#rrggbb" to [R,G,B]
-                fill_color.append(64)                               # Add alpha channel for transparency
-                draw.rectangle([(roi['x'],roi['y']), roi_lower_right], outline='#ffffff', fill=tuple(fill_color))   # Draw ROI
-                font = ImageFont.truetype(config.font_directory + "/" + "OpenSans.ttf", 9)         # Add well target text
-                text_position = (roi['x'] + config.roi_width + 1, roi['y'])
-                draw.text(text_position, roi['target'],'#ffffff',font=font)
-        img_new = Image.alpha_composite(img, img_tmp)  # composite captured & ROI images
-        img = None
-        img_tmp = None
-        return(img_new)
+        return(img)
     except Exception as e:
-        print('Exception in annotate_image():', flush=True)
-        print(f'{type(e)}: {e}', flush=True)
+        log.exception('Exception in annotate_image()')
+
+# Encode a PIL image, optionally downscaled, as 'png', 'jpeg' or 'webp'.
+# Returns (bytes, MIME type):
+image_formats = {'png': ('PNG', 'image/png'), 'jpeg': ('JPEG', 'image/jpeg'), 'webp': ('WEBP', 'image/webp')}
+
+def encode_image(image, image_format='png', quality=None, scale=1.0):
+    pil_format, mime_type = image_formats[image_format]
+    if not 0 < scale < float('inf'):      # also NaN
+        raise ValueError(f'invalid image scale: {scale}')
+    if scale != 1.0 and (1/scale).is_integer():
+        image = image.reduce(int(1/scale))   # fast box filter for 1/2, 1/3, ...
+    elif scale != 1.0:
+        size = (max(int(image.width*scale), 1), max(int(image.height*scale), 1))
+        image = image.resize(size, Image.Resampling.BILINEAR)
+    buffer = BytesIO()                 # create a buffer to hold the image
+    if pil_format == 'PNG':
+        image.save(buffer, format=pil_format, compress_level=config.png_compress_level)
+    else:
+        image.save(buffer, format=pil_format, quality=quality or config.image_quality)
+    return(buffer.getvalue(), mime_type)
 
 @log_function_call
 def adjust_settings(exposure_time_ms, analogue_gain, color_gains):
-    global cam
+    global cam, exposure_us
     try:
-        cam.set_controls({
-            "AeEnable": False,                 # auto update of gain & exposure settings
-            "AwbEnable": False,                # auto white balance
-            "ExposureTime": int(exposure_time_ms*1e3),   # units of microseconds
-            "AnalogueGain": float(analogue_gain),   # range [0,6.0] ?
-            "ColourGains": color_gains              # (red,blue) gains, range [0,32.0]
-        })
+        with camera_lock:      # not while a burst changes the exposure
+            exposure_us = int(exposure_time_ms*1e3)
+            cam.set_controls({
+                "AeEnable": False,                 # auto update of gain & exposure settings
+                "AwbEnable": False,                # auto white balance
+                "ExposureTime": int(exposure_time_ms*1e3),   # units of microseconds
+                "AnalogueGain": float(analogue_gain),   # range [0,6.0] ?
+                "ColourGains": color_gains              # (red,blue) gains, range [0,32.0]
+            })
         time.sleep(3)   # time to stabilize settings
-        print('adjust_settings() done', flush=True)
+        log.info('adjust_settings() done')
         return('adjust_settings() done')
     except Exception as e:
-        print(f'error in adjust_settings(): {e}', flush=True)
+        log.exception(f'error in adjust_settings(): {e}')
 
 @log_function_call
 def setup_camera(exposure_time_ms=50, analogue_gain=0.5, color_gains=(1.2,1.0)):    # Set up camera
     global cam
-    cam_config = cam.create_still_configuration(main={"size": res})
-    cam.configure(cam_config)
+    with camera_lock:
+        stop_streaming()     # camera must be stopped to change its configuration
+        cam_config = cam.create_still_configuration(main={"size": res})
+        cam.configure(cam_config)
     adjust_settings(exposure_time_ms, analogue_gain, color_gains)
-    print('Picamera2 setup complete', flush=True)
+    log.info('Picamera2 setup complete')
     os.makedirs(config.data_directory, exist_ok=True)
+    camera_ready.set()
 
-def roi_avg(image, roi):   # Return average pixel values in ROI
-    r,b,g = 0,0,0
-    px = roi['x']
-    py = roi['y']
-    for x in range(int(px),int(px+config.roi_width)):
-        for y in range(int(py),int(py+config.roi_height)):
-            xy = (x,y)
-            r += image.getpixel(xy)[0]
-            g += image.getpixel(xy)[1]
-            b += image.getpixel(xy)[2]
-    pixels = config.roi_width * config.roi_height;
-    r = int(100*r/pixels);
-    g = int(100*g/pixels);
-    b = int(100*b/pixels);
-    return((r,g,b))
-
-# TimeoutException class, signal handler function, and decorator
-# to capture timeouts during image capture.
+# Decorator to capture timeouts during image capture: the call runs in the
+# capture_pool and returns None if it takes more than config.capture_timeout
+# seconds, so the capture loops below try again.
 #
 # Implemented to handle apparent hardware error: "Zero sequence expected 
 # for first frame (got 1)" but did not fix this problem since it
@@ -131,124 +176,288 @@ def roi_avg(image, roi):   # Return average pixel values in ROI
 #
 # Timeout handling has been left here in case other possible imager
 # errors may also lead to image capture timeouts...
-class TimeoutException(Exception):
-    pass
-# signal handler function:
-def timeout_handler(signum, frame):       
-    raise TimeoutException("Function execution exceeded the timeout limit.")
-# decorator to apply signal handler:
-def add_timeout(func, timeout_sec=30):
+#
+# (SIGALRM, used before, only works in the main thread, and captures are
+# made by the HTTP, worker and acquisition threads.) A hung call keeps its
+# pool thread; its result, if it ever arrives, is released and dropped.
+capture_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='capture')
+
+def add_timeout(func):
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        global cam
-        # Set the signal handler for the timeout
-        signal.signal(signal.SIGALRM, timeout_handler)
-        signal.alarm(timeout_sec)  # Set the timeout
+        future = capture_pool.submit(func, *args, **kwargs)
         try:
-            result = func(*args, **kwargs)
-            return result
-        except TimeoutException:
+            return(future.result(config.capture_timeout))
+        except concurrent.futures.TimeoutError:
+            log.warning(f'{func.__name__}() timed out after {config.capture_timeout} s, retrying')
+            future.add_done_callback(release_late)
             """
-            print('timeout exception, re-initializing the camera', flush=True)
+            log.warning('timeout exception, re-initializing the camera')
             cam.close()
-            cam = Picamera2() 
+            cam = hardware.open_camera()
             setup_camera()
             """
             return(None)
-        finally:
-            signal.alarm(0)  # Cancel the alarm            
     return wrapper
 
+def release_late(future):
+    if future.exception() is None and hasattr(future.result(), 'release'):
+        future.result().release()    # camera request of a timed-out capture
+
+# Next completed request of the running camera with timeout handling:
+@add_timeout
+def capture_request():
+    return(cam.capture_request())
+
 # Capture a single image with timeout handling: 
 @add_timeout
 def capture_single_image():
     return(cam.capture_image("main"))       # capture PIL image
 
-# Extract fluorescence measurements from ROIs in image:
+# Capture a single frame as a numpy array (no PIL image) with timeout handling:
+@add_timeout
+def capture_single_array():
+    return(cam.capture_array("main"))       # capture (h, w, 3) uint8 array
+
+# Keep the sensor streaming between captures (config.persistent_stream):
 @log_function_call
-def get_image_data():
-    try:
+def start_streaming():
+    global streaming
+    if not streaming:
         cam.start()
-        GPIO.output(config.IMAGER_LED_PIN, GPIO.HIGH)    # Turn on LED
-        image = None   # start with None to enter loop
-        while image is None:
-            # If image capture fails, capture_single_image() + add_timeout()
-            # decoration restarts the camera and returns None, forcing
-            # another image to be captured:
-            image = capture_single_image()               # capture PIL image
+        streaming = True
+
+@log_function_call
+def stop_streaming():
+    global streaming
+    if streaming:
         cam.stop()
+        streaming = False
+
+# Switch on the LED and return the first streamed frame exposed after that,
+# with its metadata. Frames exposed before the LED was on are released
+# without being copied:
+@add_timeout
+def capture_led_frame(as_array=True):
+    GPIO.output(config.IMAGER_LED_PIN, GPIO.HIGH)    # Turn on LED
+    led_on_ns = hardware.sensor_clock_ns()
+    try:
+        while True:
+            request = cam.capture_request()
+            try:
+                metadata = request.get_metadata()
+                if metadata.get("SensorTimestamp", led_on_ns) >= led_on_ns:
+                    if as_array:
+                        frame = request.make_array("main")   # (h, w, 3) uint8 array
+                    else:
+                        frame = request.make_image("main")   # PIL image
+                    return((frame, metadata))
+            finally:
+                request.release()
+    finally:
+        GPIO.output(config.IMAGER_LED_PIN, GPIO.LOW)     # Turn off LED
+
+# Capture one LED-lit frame, either from the persistent stream or by
+# starting and stopping the camera around the capture:
+def capture_frame(as_array=True):
+    with camera_lock:
+        return(_capture_frame(as_array))
+
+def _capture_frame(as_array):
+    global frame_metadata
+    if config.persistent_stream:
+        start_streaming()
+        result = None   # start with None to enter loop
+        while result is None:
+            # capture_led_frame() + add_timeout() returns None on timeout,
+            # forcing another frame to be captured:
+            result = capture_led_frame(as_array)
+        frame, frame_metadata = result
+        return(frame)
+    cam.start()
+    GPIO.output(config.IMAGER_LED_PIN, GPIO.HIGH)    # Turn on LED
+    capture = capture_single_array if as_array else capture_single_image
+    frame = None   # start with None to enter loop
+    while frame is None:
+        # If image capture fails, capture_single_array() + add_timeout()
+        # decoration restarts the camera and returns None, forcing
+        # another image to be captured:
+        frame = capture()
+    cam.stop()
+    GPIO.output(config.IMAGER_LED_PIN, GPIO.LOW)     # Turn off LED
+    return(frame)
+
+# Capture a burst of config.frames_per_sample LED-lit frames at each of the
+# exposures config.burst_exposure_factors (relative to the exposure set by
+# adjust_settings()), reducing each frame to per-ROI running sums as soon as
+# it arrives so at most one frame is held in memory. Returns the statistics
+# for roi_engine.combine_moments():
+def capture_burst(channel=1):
+    with camera_lock:
+        return(_capture_burst(channel))
+
+def _capture_burst(channel):
+    global frame_metadata
+    factors = config.burst_exposure_factors or [1.0]
+    stacked = len(factors) > 1 or factors[0] != 1.0
+    if config.persistent_stream:
+        start_streaming()
+    else:
+        cam.start()
+    stats = []
+    GPIO.output(config.IMAGER_LED_PIN, GPIO.HIGH)    # Turn on LED
+    led_on_ns = hardware.sensor_clock_ns()
+    try:
+        for factor in factors:
+            exposure = int(exposure_us*factor)
+            if stacked:
+                cam.set_controls({"ExposureTime": exposure})
+            sums = sumsq = saturated = 0
+            frames = settling = 0
+            while frames < config.frames_per_sample:
+                request = capture_request()
+                if request is None:
+                    continue          # timed out: capture another frame
+                try:
+                    metadata = request.get_metadata()
+                    if metadata.get("SensorTimestamp", led_on_ns) < led_on_ns:
+                        continue      # exposed before the LED was on
+                    if (stacked and abs(metadata.get("ExposureTime", exposure) - exposure) > 0.05*exposure
+                            and settling < config.exposure_settle_frames):
+                        settling += 1
+                        continue      # new exposure time not applied yet
+                    frame = request.make_array("main")
+                    if config.drift_tracking and not stats and frames == 0:
+                        registration.track(frame, channel)   # first frame of the burst
+                    s, q, k = roi_engine.roi_moments(frame, channel, config.saturation_level)
+                    frame = None
+                    sums, sumsq, saturated = sums + s, sumsq + q, saturated + k
+                    frames += 1
+                    frame_metadata = metadata
+                finally:
+                    request.release()
+            stats.append((exposure, frames, sums, sumsq, saturated))
+    finally:
         GPIO.output(config.IMAGER_LED_PIN, GPIO.LOW)     # Turn off LED
-        # Get average pixel value for each ROI:
-        roi_avgs = []
-        for roi in config.ROIs: 
-            roi_avgs.append(roi_avg(image, roi)[1])  # green channel
-        # Add timestamp & ROI averages to temp data file:
-        timestamp = [int(time.time())]        # 1st entry is the time stamp
-        with open(config.data_directory + '/temp_data.csv', 'a') as f:
-            writer = csv.writer(f, delimiter=',', lineterminator='\n')
-            writer.writerow(timestamp + roi_avgs)
-        image = None
+        if stacked:
+            cam.set_controls({"ExposureTime": exposure_us})
+        if not config.persistent_stream:
+            cam.stop()
+    return(stats)
+
+# Extract fluorescence measurements from ROIs in image:
+@log_function_call
+def get_image_data():
+    if roi_engine.bbox is None:   # no ROIs set up
+        return([])
+    try:
+        t0 = time.perf_counter()
+        factors = config.burst_exposure_factors or [1.0]
+        if config.frames_per_sample > 1 or len(factors) > 1 or factors[0] != 1.0:
+            stats = capture_burst(channel=1)
+        else:
+            frame = capture_frame(as_array=config.raw_capture)
+            if config.drift_tracking:
+                registration.track(frame, channel=1)
+            stats = [(exposure_us, 1) + roi_engine.roi_moments(np.asarray(frame), 1, config.saturation_level)]
+        t1 = time.perf_counter()
+        # Get average pixel value for each ROI (green channel), with pixel
+        # variance and saturated pixel counts. Only the ROI bounding box of
+        # the frames is read:
+        result = roi_engine.combine_moments(stats, exposure_us)
+        roi_avgs = result['values']
+        t2 = time.perf_counter()
+        # Add timestamp & ROI averages to temp sample log:
+        dx, dy = roi_engine.offset
+        append_sample(time.time(), roi_avgs, var=result['var'], sat=result['sat'], dx=dx, dy=dy)
+        t3 = time.perf_counter()
+        stage_times.update({'capture': t1-t0, 'roi': t2-t1, 'write': t3-t2, 'total': t3-t0})
+        for (stage, seconds) in stage_times.items():
+            sample_seconds.observe(seconds, stage)
+        samples_taken.inc()
+        frame = None
         return(roi_avgs)
     except Exception as e:
-        print(f'Exception in get_image_data(): {e}', flush=True)
+        sample_errors.inc()
+        log.exception(f'Exception in get_image_data(): {e}')
         return(f'Exception in get_image_data(): {e}')
 
-# Return a PIL image with time stamp (add colored ROI boxes if add_ROIs true):
+# Types of the extra per-sample fields stored in the sample log:
+sample_fields = {'var': '<f4', 'sat': '<u4', 'dx': '<i2', 'dy': '<i2'}
+
+# Append one sample (and extra fields, see sample_fields) to the temp sample
+# log, creating it on the first sample:
+def append_sample(timestamp, values, **extra):
+    global sample_log
+    with sample_log_lock:
+        if sample_log is None:
+            extra_fields = [(name, sample_fields[name], np.shape(value)) for (name, value) in extra.items()]
+            sample_log = samplelog.SampleLog(config.data_directory + '/temp_data.magi', len(values),
+                                             extra_fields)
+        sample_log.append(timestamp, values, **extra)
+
+# Close and delete the temp sample log (and any temp CSV from older versions):
 @log_function_call
-def get_image(add_ROIs):
+def clear_sample_log():
+    global sample_log
+    with sample_log_lock:
+        if sample_log is not None:
+            sample_log.close()
+            sample_log = None
+        for name in ('/temp_data.magi', '/temp_data.csv'):
+            if os.path.isfile(config.data_directory + name):
+                os.remove(config.data_directory + name)
+
+# Capture an image with time stamp (add colored ROI boxes if add_ROIs true),
+# encoded as 'png', 'jpeg' or 'webp' and scaled by scale. Returns (bytes,
+# MIME type):
+def render_image(add_ROIs, image_format='png', quality=None, scale=1.0):
+    image = capture_frame(as_array=False)   # capture PIL image
+    image = annotate_image(image, add_ROIs)
+    return(encode_image(image, image_format, quality, scale))
+
+# Return a rendered image as a base64 data URI:
+@log_function_call
+def get_image(add_ROIs, image_format='png', quality=None, scale=1.0):
     try:
-        cam.start()
-        GPIO.output(config.IMAGER_LED_PIN, GPIO.HIGH)
-        image = capture_single_image()     # capture PIL image
-        cam.stop()
-        GPIO.output(config.IMAGER_LED_PIN, GPIO.LOW)
-        image = annotate_image(image, add_ROIs)
-        buffer = BytesIO()                 # create a buffer to hold the image
-        image.save(buffer, format="PNG")   # Convert image to PNG
-        png_image = buffer.getvalue()
-        png_base64 = base64.b64encode(png_image).decode('utf-8')  # Encode as base64
-        image = None
-        png_image = None
-        return(f"data:image/png;base64,{png_base64}")
+        encoded, mime_type = render_image(add_ROIs, image_format, quality, scale)
+        encoded_base64 = base64.b64encode(encoded).decode('utf-8')  # Encode as base64
+        encoded = None
+        return(f"data:{mime_type};base64,{encoded_base64}")
     except Exception as e:
-        print(f'Exception in get_image(): {e}', flush=True)
+        log.exception(f'Exception in get_image(): {e}')
         return(f'Exception in get_image(): {e}')
 
 @log_function_call
 def end_imaging():
+    global sample_log
     # move temp data contents to time-stamped file:
+    with camera_lock:
+        stop_streaming()   # no more samples needed until the next assay
     output_filename = time.strftime("%Y%m%d_%Hh%Mm%Ss")
-    os.rename(config.data_directory + '/temp_data.csv', config.data_directory + '/' + output_filename + '.csv')
-    print(f'end_imaging() called, output_filename={output_filename}', flush=True)
-    sys.stdout.flush()
+    output_path = config.data_directory + '/' + output_filename
+    with sample_log_lock:
+        if sample_log is not None:
+            sample_log.close()
+            sample_log = None
+        if not os.path.isfile(config.data_directory + '/temp_data.magi'):
+            log.warning('end_imaging(): no samples taken, no output file')
+            return('')     # (the name of the last run may be the same)
+        os.rename(config.data_directory + '/temp_data.magi', output_path + '.magi')
+        samplelog.export_csv(output_path + '.magi', output_path + '.csv')   # for download
+    log.info(f'end_imaging() output_filename={output_filename}')
     return(output_filename)
 
+# Filter the curves of a run & extract TTPs (reusing cached analysis stages),
+# save the filtered curves as <filename>_filt.csv and return the results in
+# the column-oriented format of filter_curves.format_results():
+#   {'ttp': [TTP of each well], 't': [time (min)], 'y': [[curve of well 1], [well 2], ...]}
 @log_function_call
 def analyze_data(filename, filter_factor, cut_time, threshold):
-    # filter() returns: {'ttp': ttp, 'y_filt': y_filtered}
-    # where ttp is a list of TTP values for each well, and
-    # y_filtered is a list of data with format:
-    #   [ [{x: t1, y: val1}, {x: t2, y: val2}, ...]  <- well 1
-    #     [{x: t1, y: val1}, {x: t2, y: val2}, ...]  <- well 2
-    #      ... ]                                     <- etc
-    results = filter_curves.filter(
-        config.data_directory + '/' + filename + '.csv', 
-        float(filter_factor), 
-        float(cut_time), 
-        int(threshold) ) 
-    # Save filtered data to csv file:
-    y_filt = results['y_filt']
-    time_min = [entry['x'] for entry in y_filt[0]]  # time value, 1st well (same for all wells)
-    columns = []
-    for well in y_filt:
-        columns.append([entry['y'] for entry in well])
-    with open(config.data_directory + '/' + filename + '_filt.csv', 'a') as f:
-        #fieldnames = ["time (min)", "fluorescence"]
-        writer = csv.writer(f)
-        headers = ['time (min)'] + [f'well {i}' for i in range(len(columns))]
-        writer.writerow(headers)
-        for i, t in enumerate(time_min):
-            row = [t] + [values[i] for values in columns]
-            writer.writerow(row)
-    # Return original dictionary:
-    return(results)
-
+    t, yf_norm, ttp = analysis.analyze_curves(
+        config.data_directory + '/' + filename + '.csv',
+        float(filter_factor),
+        float(cut_time),
+        int(threshold) )
+    filter_curves.save_filtered(config.data_directory + '/' + filename + '_filt.csv', t, yf_norm)
+    return(filter_curves.format_results(t, yf_norm, ttp))
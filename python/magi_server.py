@@ -1,20 +1,40 @@
 # Multiplexed Array Gene Imager (MAGI) server
 
+import time
+start_time = time.monotonic()   # for startup timing, taken before the other imports
+
 from simple_pid import PID   # see https://pypi.org/project/simple-pid/
 import json
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+import queue
+import zlib
 import sys
 import os
 import subprocess
-import time
 import threading
-import RPi.GPIO as GPIO
-from gpiozero import MCP3008
+import logging
+import bisect
+import math
+from collections import namedtuple
+from hardware import GPIO, MCP3008
+import numpy as np
 
 import imager
+import analysis
+import assay_card
+import acquisition
+import events
+import calibration
+import registration
+import serverlog
+import metrics
+from ringbuffer import RingBuffer
 import config   # Cross-module global variables for all Python codes
 from config import log_function_call
 
+log = logging.getLogger('magi.server')
+
 # import objgraph # temp module for tracking memory leaks
 
 sys.path.append(config.magi_directory)  # Add application path to the Python search path
@@ -34,6 +54,7 @@ set_temp = 60
 r_F_prev = 23.0
 
 # Start heater PWM:
+pid_thread = None
 duty_cycle = 0
 pwm.start(duty_cycle)
 
@@ -42,139 +63,513 @@ const = MCP3008(channel=0)
 Tb = MCP3008(channel=1)
 Tt = MCP3008(channel=2)
 
+# Return the real path of a requested data file, or None if it does not
+# exist or is outside config.data_directory. Files are requested either by
+# their full path (as the client does) or relative to the data directory:
+def resolve_data_file(path):
+    directory = os.path.realpath(config.data_directory)
+    for candidate in (path, directory + '/' + path.lstrip('/')):
+        filename = os.path.realpath(candidate)
+        if os.path.commonpath([filename, directory]) == directory and os.path.isfile(filename):
+            return(filename)
+    return(None)
+
+# Parse a single "bytes=start-end" Range header. Returns (start, end)
+# inclusive, None for no (or an unsupported) range, or 'unsatisfiable':
+def parse_range(header, file_size):
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return(None)
+    try:
+        first, last = header[6:].strip().split('-')
+        if first == '':                      # suffix range: last N bytes
+            start, end = max(file_size - int(last), 0), file_size - 1
+        else:
+            start = int(first)
+            end = min(int(last), file_size - 1) if last else file_size - 1
+    except ValueError:
+        return(None)
+    if start >= file_size or start > end:
+        return('unsatisfiable')
+    return((start, end))
+
+# (add_ROIs, format, quality, scale) for imager.render_image() from a query.
+# Raises ValueError for an unknown format or an out-of-range option:
+def image_options(query, image_format, scale=1.0):
+    image_format = query.get('format', [image_format])[0]
+    if image_format not in imager.image_formats:
+        raise ValueError(f'unknown image format: {image_format}')
+    quality = int(query['quality'][0]) if 'quality' in query else None
+    if quality is not None and not 1 <= quality <= 100:
+        raise ValueError(f'quality must be 1..100: {quality}')
+    scale = float(query.get('scale', [scale])[0])
+    if not 0 < scale < float('inf'):      # also NaN
+        raise ValueError(f'scale must be > 0: {scale}')
+    return((query.get('rois', ['0'])[0] not in ('0', 'false'), image_format, quality, scale))
+
 # Flag to halt temperature control thread:
 stop_event = threading.Event()
 
 class S(BaseHTTPRequestHandler):
-    def _set_response(self):
+    # Persistent (keep-alive) connections: every response has a
+    # Content-Length, except streams, which close the connection. Small
+    # responses are sent without Nagle delays, and idle connections are
+    # closed after `timeout` seconds:
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    timeout = 120
+
+    # Push channel: stream sample, temperature and status events to the client.
+    # Samples since ?since=N (or the Last-Event-ID of a reconnecting client)
+    # are replayed from the acquisition buffer first:
+    def stream_events(self, query):
+        since = self.headers.get('Last-Event-ID')
+        since = int(since) + 1 if since is not None else int(query.get('since', ['0'])[0])
+        q = events.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            replayed = since
+            for sample in acquisition.samples_since(since):
+                self.wfile.write(events.format_event('sample', sample, sample['index']))
+                replayed = sample['index'] + 1
+            self.wfile.flush()
+            while True:
+                try:
+                    event, data, event_id = q.get(timeout=15)
+                except queue.Empty:
+                    self.wfile.write(b': keepalive\n\n')   # detect closed connections
+                    self.wfile.flush()
+                    continue
+                if event == 'sample' and event_id < replayed:
+                    continue          # already sent during replay
+                self.wfile.write(events.format_event(event, data, event_id))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            events.unsubscribe(q)
+
+    # A freshly captured image as raw bytes:
+    #   /image?rois=1&format=png|jpeg|webp&quality=85&scale=0.5
+    def send_image(self, query):
+        t0 = time.perf_counter()
+        try:
+            options = image_options(query, 'png')
+        except ValueError as e:
+            self.send_error(400, f'bad image request: {e}')
+            return
+        try:
+            body, mime_type = imager.render_image(*options)
+        except Exception as e:
+            log.exception(f'Exception in GET /image: {e}')
+            self.send_server_error(f'image failed: {type(e).__name__}: {e}')
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", mime_type)
+        self.send_header('Access-Control-Allow-Origin', '*');
+        self.send_header("Cache-Control", "no-store")     # every request is a new capture
+        self.send_header("Last-Modified", self.date_time_string(time.time()))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        record_latency('GET /image', time.perf_counter() - t0)
+
+    # All metrics in the Prometheus text format, for scraping:
+    def send_metrics(self):
+        body = metrics.exposition().encode('utf-8')
         self.send_response(200)
-        self.send_header('Content-type', 'text/html')
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
         self.send_header('Access-Control-Allow-Origin', '*');
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
+        self.wfile.write(body)
+
+    # Live preview for focusing and ROI alignment: a multipart JPEG stream
+    # (one LED-lit capture every config.preview_frame_period seconds or
+    # ?period=) until the client disconnects:
+    def stream_preview(self, query):
+        try:
+            options = image_options(query, 'jpeg', scale=0.5)
+            period = float(query.get('period', [config.preview_frame_period])[0])
+            if not 0 < period < float('inf'):
+                raise ValueError(f'period must be > 0: {period}')
+        except ValueError as e:
+            self.send_error(400, f'bad preview request: {e}')
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+        self.send_header('Access-Control-Allow-Origin', '*');
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            while True:
+                t0 = time.monotonic()
+                frame, mime_type = imager.render_image(*options)
+                self.wfile.write(b'--frame\r\nContent-Type: ' + mime_type.encode()
+                                 + b'\r\nContent-Length: ' + str(len(frame)).encode() + b'\r\n\r\n')
+                self.wfile.write(frame + b'\r\n')
+                self.wfile.flush()
+                time.sleep(max(period - (time.monotonic() - t0), 0))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
 
     # File download requests come as GET requests:
     def do_GET(self):
-        if os.path.isfile(self.path):
-            print(f'accessing {self.path}', flush=True)
-            file_size = os.path.getsize(self.path)
-            if self.path.endswith(".csv"):
-                content_type = "text/csv"
+        url = urlparse(self.path)
+        if url.path == '/events':
+            self.stream_events(parse_qs(url.query))
+        elif url.path in ('/image', '/preview.mjpg') and not imager.camera_ready.wait(config.camera_ready_timeout):
+            self.send_unavailable()
+        elif url.path == '/image':
+            self.send_image(parse_qs(url.query))
+        elif url.path == '/preview.mjpg':
+            self.stream_preview(parse_qs(url.query))
+        elif url.path == '/metrics':
+            self.send_metrics()
+        else:
+            filename = resolve_data_file(unquote(url.path))
+            if filename is not None:
+                self.send_file(filename)
             else:
-                content_type = "application/octet-stream"
-            self.send_response(200)
-            self.send_header("Content-Type", content_type)
+                log.warning(f'File not found: {url.path} (204 = no operation)')
+                self.send_response(204)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                #self.wfile.write(b"File not found.")
+
+    # Stream a data file in chunks (sendfile() where the platform supports
+    # it), with ETag/If-None-Match, a single byte Range, and gzip encoding
+    # of CSV files for clients that accept it:
+    def send_file(self, filename):
+        log.info(f'accessing {filename}')
+        st = os.stat(filename)
+        file_size = st.st_size
+        etag = f'"{st.st_mtime_ns:x}-{file_size:x}"'
+        content_type = "text/csv" if filename.endswith(".csv") else "application/octet-stream"
+        byte_range = parse_range(self.headers.get('Range'), file_size)
+        gzip = (byte_range is None and content_type == "text/csv"
+                and 'gzip' in self.headers.get('Accept-Encoding', ''))
+        if gzip:
+            etag = etag[:-1] + '-gzip"'     # the compressed representation has its own ETag
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
             self.send_header('Access-Control-Allow-Origin', '*');
-            self.send_header("Content-Disposition", f'attachment; filename="{os.path.basename(self.path)}"')
-            self.send_header("Content-Length", str(file_size))
+            self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept-Encoding")
+            self.send_header("Content-Length", "0")
             self.end_headers()
-            with open(self.path, "rb") as file:    
-                self.wfile.write(file.read())       # Send the file
-        else:
-            print(f'File not found (204 = no operation)', flush=True)
-            self.send_response(204)
+            return
+        if byte_range == 'unsatisfiable':
+            self.send_response(416)
+            self.send_header('Access-Control-Allow-Origin', '*');
+            self.send_header("Content-Range", f"bytes */{file_size}")
             self.send_header("Content-Length", "0")
             self.end_headers()
-            #self.wfile.write(b"File not found.")
+            return
+        start, end = byte_range or (0, file_size - 1)
+        self.send_response(206 if byte_range else 200)
+        self.send_header("Content-Type", content_type)
+        self.send_header('Access-Control-Allow-Origin', '*');
+        self.send_header('Access-Control-Expose-Headers', 'ETag, Content-Range, Content-Encoding')
+        self.send_header("Content-Disposition", f'attachment; filename="{os.path.basename(filename)}"')
+        self.send_header("Cache-Control", "no-cache")     # data files grow, always revalidate
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("ETag", etag)
+        if gzip:                  # compressed size unknown: body ends when the connection closes
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        else:
+            self.send_header("Content-Length", str(end - start + 1))
+            if byte_range:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{file_size}")
+        self.end_headers()
+        try:
+            with open(filename, "rb") as file:
+                if gzip:
+                    compressor = zlib.compressobj(1, zlib.DEFLATED, 31)   # fast level, 31: gzip container
+                    while chunk := file.read(config.download_chunk_size):
+                        self.wfile.write(compressor.compress(chunk))
+                    self.wfile.write(compressor.flush())
+                elif end >= start:
+                    self.connection.sendfile(file, start, end - start + 1)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    # CORS preflight for downloads with Range/If-None-Match headers:
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_header('Access-Control-Allow-Origin', '*');
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Range, If-None-Match')
+        self.send_header("Content-Length", "0")
+        self.end_headers()
 
     # Server function requests come as POST requests:
     def do_POST(self):
         content_length = int(self.headers['Content-Length'])  # gets the size of data
         post_data = self.rfile.read(content_length)           # get the data
-        self._set_response()
         post_data_decoded = post_data.decode('utf-8')
         post_dict = dict(pair.split('=') for pair in post_data_decoded.split('&'))
         info = json.loads(post_dict['todo'])
         action = info[0]
         data = info[1]
-        #print(f'{action}: {data}', flush=True)
+        log.debug('%s: %.200s', action, data)
         # objgraph.show_most_common_types()  # check memory use
-        # sys.stdout.flush()
-        if action == 'setupAssay':       # Update global variables from the assay card data
-            config.card_filename = data['card_filename']
-            card_data = data['card_dict']
-            config.well_config = card_data["well_config"]
-            config.roi_upper_left = tuple(int(val) for val in card_data["roi_upper_left"])
-            config.roi_width = int(card_data["roi_width"])
-            config.roi_height = int(card_data["roi_height"])
-            config.roi_spacing_x = int(card_data["roi_spacing_x"])
-            config.roi_spacing_y = int(card_data["roi_spacing_y"])
-            config.positives = card_data["hit_criteria"]
-            config.gene_names = data['gene_names']
-            config.gene_colors = data['gene_colors']
-            imager.setup_ROIs()      # set up the ROIs from assay card data
-            imager.get_image(True)   # capture a new image showing ROIs
-            results = "config.py globals updated from card data"
-            self.wfile.write(results.encode('utf-8'))
-        if action == 'ping':                  # respond to server ping
-            results = 'server is ready'
-            self.wfile.write(results.encode('utf-8'))
-        if action == 'onLoad':                # Housekeeping on starting application
-            results = clear_globals()         # clear all global variables
-            GPIO.output(config.STATUS_LED_PIN, GPIO.HIGH)  # turn LED on to indicate system is ready
-            self.wfile.write(results.encode('utf-8'))
-        if action == 'start':    # Start the PID loop for temp control
-            clear_temp_file()    # Clear temp data file (if "end assay" not hit last run)
-            start_pid()
-            results = "PID thread started"
-            self.wfile.write(results.encode('utf-8'))
-        if action == 'getImage':              # Return an image of the chip with colored ROIs
-            add_ROIs = data
-            results = imager.get_image(add_ROIs)
-            self.wfile.write(results.encode('utf-8'))
-        if action == 'getImageData':          # Capture image & ROI values
-            results = imager.get_image_data()
-            self.wfile.write(",".join([str(x) for x in results]).encode('utf-8'))
-        if action == 'getTemperature':        # Return chip temperature
-            # results = str(well_temp)
-            # well_temps = []  # reset the list
-            results = str(get_average_temperature(3))
-            self.wfile.write(results.encode('utf-8'))
-        elif action == 'endAssay':                 # Turn off PID loop and rename final data file
-            results = imager.end_imaging()
-            print('calling end_pid()', flush=True)
-            sys.stdout.flush()
-            end_pid()
-            self.wfile.write(results.encode('utf-8'))
-        elif action == 'adjust':              # Turn off PID loop and rename final data file
-            exposure_time_ms = int(data['exposure_time'])
-            analogue_gain = float(data['analogue_gain'])
-            colour_gains = (float(data['red_gain']), float(data['blue_gain']))
-            results = imager.adjust_settings(exposure_time_ms, analogue_gain, colour_gains)
-            self.wfile.write(results.encode('utf-8'))
-        elif action == 'analyze':             # Filter curves & extract TTP values
-            filename = data['filename']
-            filter_factor = data['filter_factor']
-            cut_time = data['cut_time']
-            threshold = data['threshold']
-            results = imager.analyze_data(filename, filter_factor, cut_time, threshold)
-            self.wfile.write(json.dumps(results).encode('utf-8'))
-            #self.wfile.write(results.encode('utf-8'))
-        elif action == 'shutdown':       # Power down the Pi
-            shutdown()
-        elif action == 'reboot':         # Reboot the Pi
-            reboot()
-        elif action == 'getLog':         # Return the server log file contents
-            if not os.path.isfile(config.logfile):    # Create a blank file if it doesn't exist
-                with open(config.logfile, 'w') as f:
-                    pass
-            with open(config.logfile, 'r') as f:
-                results = f.read()
-            results += f"\n\nLog file size: {float(os.path.getsize(config.logfile))/1e6:.02f} MB"
-            self.wfile.write(json.dumps(results).encode('utf-8'))
-        elif action == 'clearLog':          # Clear the server log file
-            open(config.logfile, 'w').close()
-            results = f'{config.logfile} cleared'
-            print(results, flush=True)
-            self.wfile.write(json.dumps(results).encode('utf-8'))
+        entry = actions.get(action)
+        if entry is None:
+            log.warning(f'Unknown action: {action}')
+            self.send_response(400)
+            self.send_header('Access-Control-Allow-Origin', '*');
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if entry.camera and not imager.camera_ready.wait(config.camera_ready_timeout):
+            self.send_unavailable()
+            return
+        t0 = time.perf_counter()
+        try:
+            results = entry.handler(data)
+        except Exception as e:
+            log.exception(f'Exception in action {action}: {e}')
+            self.send_server_error(f'{action} failed: {type(e).__name__}: {e}')
+            record_latency(action, time.perf_counter() - t0)
+            return
+        if results is not None:
+            if entry.content_type == 'application/json':
+                body = json.dumps(results, separators=(',', ':'))
+            else:
+                body = str(results)
+            body = body.encode('utf-8')
+            # Large responses (e.g. analysis results) are gzipped for clients
+            # that accept it (browsers decode them transparently):
+            gzip = (len(body) >= config.gzip_min_bytes
+                    and 'gzip' in self.headers.get('Accept-Encoding', ''))
+            if gzip:
+                compressor = zlib.compressobj(1, zlib.DEFLATED, 31)   # fast level, 31: gzip container
+                body = compressor.compress(body) + compressor.flush()
+            self.send_response(200)
+            self.send_header('Content-type', entry.content_type)
+            self.send_header('Access-Control-Allow-Origin', '*');
+            if gzip:
+                self.send_header("Content-Encoding", "gzip")
+                self.send_header("Vary", "Accept-Encoding")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.close_connection = True    # no response (e.g. shutdown)
+        record_latency(action, time.perf_counter() - t0)
+
+    # 500 with the error text for an action that raised an exception (the
+    # connection stays usable):
+    def send_server_error(self, message):
+        body = message.encode('utf-8')
+        self.send_response(500)
+        self.send_header('Content-type', 'text/plain; charset=utf-8')
+        self.send_header('Access-Control-Allow-Origin', '*');
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Camera requests made before the camera setup has finished wait for it
+    # (for up to config.camera_ready_timeout s), then get a 503:
+    def send_unavailable(self):
+        log.warning('Camera not ready (503)')
+        self.send_response(503)
+        self.send_header('Access-Control-Allow-Origin', '*');
+        self.send_header("Retry-After", "1")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
 
     def log_message(self, format, *args):  # Suppress server output
         return
 
-# Delete contents of the temp data file:
+# -------------------------------------
+# POST action handlers
+# -------------------------------------
+
+# Action table entry. handler(data) returns the response body (a string, an
+# object to be JSON encoded for 'application/json', or None for no
+# response). Handlers run on the request thread (one thread per
+# connection), so a long job (analysis, camera settings) does not delay
+# other requests. Actions using the camera wait for the camera setup at
+# startup.
+Action = namedtuple('Action', ['handler', 'content_type', 'camera'])
+actions = {}    # action name -> Action
+
+# Decorator to register a handler for a POST action:
+def action(name, content_type='text/html', camera=False):
+    def register(func):
+        actions[name] = Action(func, content_type, camera)
+        return func
+    return register
+
+# Per-action latency histograms:
+request_seconds = metrics.histogram('magi_request_seconds', 'Request latency by action', label='action')
+
+def record_latency(action_name, seconds):
+    request_seconds.observe(seconds, action_name)
+
+@action('setupAssay', camera=True)
+def setup_assay(data):       # Update global variables from the assay card data
+    card = assay_card.compile_card(data['card_dict'], data['card_filename'],
+                                   data.get('gene_names'), data.get('gene_colors'))
+    assay_card.apply(card)
+    imager.setup_ROIs()      # set up the ROIs (and ROI annotation layer) from assay card data
+    if config.roi_registration:   # align the ROIs with the wells in a reference frame
+        offset = registration.register(imager.capture_frame(as_array=True))
+        return(f"config.py globals updated from card data, ROI offset {offset}")
+    return("config.py globals updated from card data")
+
+@action('ping')
+def ping(data):              # respond to server ping
+    return('server is ready')
+
+@action('onLoad')
+def on_load(data):           # Housekeeping on starting application
+    results = clear_globals()         # clear all global variables
+    GPIO.output(config.STATUS_LED_PIN, GPIO.HIGH)  # turn LED on to indicate system is ready
+    return(results)
+
+@action('start', camera=True)
+def start(data):             # Start the PID loop for temp control and sampling
+    clear_temp_file()    # Clear temp data file (if "end assay" not hit last run)
+    start_pid()
+    results = "PID thread started"
+    if isinstance(data, dict) and 'period' in data:   # server-side sampling
+        acquisition.start(float(data['period']))
+        results += f", sampling every {acquisition.period} s"
+    events.publish('status', {'state': 'running', 'message': results})
+    return(results)
+
+@action('getImage', camera=True)
+def get_image(data):         # Return an image of the chip with colored ROIs
+    # data is the add ROIs flag, or {'rois': .., 'format': .., 'quality': .., 'scale': ..}
+    if isinstance(data, dict):
+        return(imager.get_image(data.get('rois', False), data.get('format', 'png'),
+                                data.get('quality'), float(data.get('scale', 1.0))))
+    add_ROIs = data
+    return(imager.get_image(add_ROIs))
+
+@action('getImageData', camera=True)
+def get_image_data(data):    # Capture image & ROI values
+    results = imager.get_image_data()
+    return(",".join([str(x) for x in results]))
+
+@action('getSamples', content_type='application/json')
+def get_samples(data):       # Return buffered samples since a sample index
+    since = int(data['since']) if isinstance(data, dict) else 0
+    return(acquisition.samples_since(since))
+
+@action('getTemperature')
+def get_temperature(data):   # Return chip temperature
+    return(str(get_average_temperature()))
+
+@action('getTemperatureHistory', content_type='application/json')
+def get_temperature_history(data):   # Return temperature history since data['since'] (unix time)
+    since = float(data.get('since', 0)) if isinstance(data, dict) else 0.0
+    history = temperature_history.since(since)
+    return(dict(zip(['t'] + temperature_columns, history.T.tolist())))
+
+@action('endAssay')
+def end_assay(data):         # Turn off PID loop and rename final data file
+    acquisition.stop()
+    results = imager.end_imaging()
+    log.info('calling end_pid()')
+    end_pid()
+    if results:      # not for a run without samples
+        save_temperature_history(results)
+    events.publish('status', {'state': 'ended', 'filename': results})
+    return(results)
+
+@action('adjust', camera=True)
+def adjust(data):            # Change the camera exposure & gain settings
+    exposure_time_ms = int(data['exposure_time'])
+    analogue_gain = float(data['analogue_gain'])
+    colour_gains = (float(data['red_gain']), float(data['blue_gain']))
+    return(imager.adjust_settings(exposure_time_ms, analogue_gain, colour_gains))
+
+@action('analyze', content_type='application/json')
+def analyze(data):           # Filter curves & extract TTP values
+    filename = data['filename']
+    filter_factor = data['filter_factor']
+    cut_time = data['cut_time']
+    threshold = data['threshold']
+    events.publish('status', {'state': 'analyzing', 'filename': filename})
+    results = imager.analyze_data(filename, filter_factor, cut_time, threshold)
+    events.publish('status', {'state': 'analyzed', 'filename': filename, 'ttp': results['ttp']})
+    return(results)
+
+@action('analyzeBatch', content_type='application/json')
+def analyze_batch(data):     # Re-analyze all runs in a data (sub)directory
+    root = os.path.realpath(config.data_directory)
+    directory = os.path.realpath(root + '/' + data.get('directory', '').lstrip('/'))
+    if os.path.commonpath([directory, root]) != root or not os.path.isdir(directory):
+        return({'error': 'invalid directory'})
+    return(analysis.analyze_directory(directory, float(data.get('filter_factor', 10.0)),
+                                      float(data.get('cut_time', 0.0)), int(data.get('threshold', 0)),
+                                      config.analysis_processes, config.card))
+
+@action('shutdown')
+def shutdown_action(data):   # Power down the Pi
+    shutdown()
+
+@action('reboot')
+def reboot_action(data):     # Reboot the Pi
+    reboot()
+
+@action('getLog', content_type='application/json')
+def get_log(data):           # Return a page of the server log: the last lines before an offset
+    data = data if isinstance(data, dict) else {}
+    text, start, size = serverlog.tail(config.logfile, int(data.get('lines', config.log_tail_lines)),
+                                       data.get('before'), data.get('level'))
+    return({'text': text, 'start': start, 'size': size})
+
+@action('clearLog', content_type='application/json')
+def clear_log(data):         # Clear the server log file
+    serverlog.clear(config.logfile)
+    results = f'{config.logfile} cleared'
+    log.info(results)
+    return(results)
+
+@action('getPidStats', content_type='application/json')
+def get_pid_stats(data):     # Return control loop timing & CPU use
+    return(dict(pid_stats, jitter_buckets_ms=[str(b) for b in pid_jitter_buckets_ms],
+                jitter_buckets=list(pid_stats.get('jitter_buckets', []))))
+
+@action('getStartup', content_type='application/json')
+def get_startup(data):       # Return startup timing
+    return(startup)
+
+@action('getStats', content_type='application/json')
+def get_stats(data):         # Return per-action latency histograms & traced function calls
+    return({'buckets_ms': [f'{b*1e3:g}' for b in metrics.latency_buckets] + ['inf'],
+            'actions': {name: {'count': v['count'], 'sum_ms': v['sum']*1e3, 'buckets': v['buckets']}
+                        for (name, v) in request_seconds.values().items()},
+            'calls': serverlog.call_stats()})
+
+@action('getMetrics', content_type='application/json')
+def get_metrics(data):       # Return all metrics (see metrics.py; Prometheus format: GET /metrics)
+    return(metrics.snapshot())
+
+
+# Delete the temp sample log:
 @log_function_call
 def clear_temp_file():
-    with open(config.data_directory + '/temp_data.csv', 'w') as f:
-        pass     
+    imager.clear_sample_log()
 
 # Clear globals in config.py:
 @log_function_call
@@ -187,87 +582,203 @@ def clear_globals():
     config.roi_spacing_y = 0        
     config.ROIs = []                # list of upper left corners for all ROIs
     config.card_filename = ''
+    config.card = None
+    config.positives = {}
     config.gene_names = []
     config.gene_colors = []
     return('globals cleared')
 
 
-# Calibration function for PWM (temperature control):
-def cali_fun(y_data):
-    y_adj = (
-        0.00000000000225474 * y_data ** 5 -
-        0.00000000027648357 * y_data ** 4 -
-        0.00000000611604906 * y_data ** 3 +
-        0.00005022119088712 * y_data ** 2 +
-        0.10392688339191500 * y_data +
-        24.8772182731984000
-        )
-    return y_adj
-
-# Function for Pre-Filter Calculation:
-def Gp(des_temp):
+# Function for Pre-Filter Calculation. a_val/b_val were tuned per iteration
+# of the old free-running loop (config.prefilter_reference_period), so the
+# filter is scaled to the actual time step dt (s):
+def Gp(des_temp, dt=None):
     global r_F_prev
-    r_F = config.a_val*r_F_prev + config.b_val*des_temp
+    if dt is None:
+        a = config.a_val
+        b = config.b_val
+    else:
+        a = config.a_val**(dt/config.prefilter_reference_period)
+        b = config.b_val*(1 - a)/(1 - config.a_val)
+    r_F = a*r_F_prev + b*des_temp
     r_F_prev = r_F
     return r_F
 
-# Return the average well temperature over n measurements to reduce noise:
-def get_average_temperature(n):
-    temp_sum = 0
-    for idx in range(n):
-        temp_sum += well_temp
-        time.sleep(50e-3)   # sleep for PID update period
-    return(temp_sum/n)
+# Control loop samples (time, temperature, setpoint, duty cycle) written by
+# run_pid(): every iteration for the last few seconds, and averaged every
+# config.temperature_history_period for the whole assay:
+temperature_columns = ['temperature', 'setpoint', 'duty_cycle']
+temperature_recent = RingBuffer(
+    2*max(config.temperature_history_period, config.temperature_average_window)/config.pid_period + 2,
+    temperature_columns)
+temperature_history = RingBuffer(
+    config.temperature_history_length/config.temperature_history_period, temperature_columns)
+
+# Return the average well temperature over the last `seconds` of control
+# loop samples to reduce noise:
+def get_average_temperature(seconds=None):
+    mean = temperature_recent.mean(seconds or config.temperature_average_window)
+    return(well_temp if mean is None else mean['temperature'])
+
+# Save the temperature history of the assay next to its data file:
+@log_function_call
+def save_temperature_history(output_filename):
+    np.savetxt(config.data_directory + '/' + output_filename + '_temp.csv', temperature_history.since(),
+               fmt=['%.3f', '%.3f', '%.3f', '%.2f'], delimiter=',', comments='',
+               header='time (s),temperature (C),setpoint (C),duty cycle (%)')
+
+# Read the sensor ADC channels, summing calibration.oversample readings of
+# each (config.adc_oversample). Returns integer sums [reference, bottom, top]:
+def read_adc():
+    sums = [0, 0, 0]
+    for _ in range(calibration.oversample):
+        sums[0] += const.raw_value
+        sums[1] += Tb.raw_value
+        sums[2] += Tt.raw_value
+    return(sums)
+
+# Control loop timing, updated by run_pid(): iterations, overruns (periods
+# skipped because an iteration ran late), wake-up jitter histogram (ms)
+# and CPU use (fraction of one core):
+pid_jitter_buckets_ms = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, float('inf')]
+pid_stats = {}
 
+# Control loop and assay metrics (cumulative over all assays):
+pid_iteration_seconds = metrics.histogram('magi_pid_iteration_seconds',
+                                          'Duration of a control loop iteration (ADC read to PWM update)')
+pid_jitter_seconds = metrics.histogram('magi_pid_jitter_seconds', 'Control loop wake-up delay',
+                                       buckets=[b/1e3 for b in pid_jitter_buckets_ms[:-1]])
+pid_overruns = metrics.counter('magi_pid_overruns_total', 'Control loop periods skipped')
+metrics.gauge('magi_well_temperature_celsius', 'Well temperature', function=lambda: well_temp)
+metrics.gauge('magi_setpoint_celsius', 'Temperature setpoint (after the pre-filter)',
+              function=lambda: pid.setpoint)
+metrics.gauge('magi_heater_duty_cycle_percent', 'Heater PWM duty cycle', function=lambda: duty_cycle)
+metrics.gauge('magi_pid_cpu_ratio', 'Control loop CPU use (fraction of one core)',
+              function=lambda: pid_stats.get('cpu', 0.0))
+metrics.gauge('magi_sampling', 'Server-side sampling running',
+              function=lambda: int(acquisition.thread is not None and acquisition.thread.is_alive()))
+metrics.gauge('magi_sample_slots_missed', 'Sample slots skipped in the current assay',
+              function=lambda: acquisition.missed)
+metrics.gauge('magi_camera_ready', 'Camera set up', function=lambda: int(imager.camera_ready.is_set()))
+metrics.gauge('magi_uptime_seconds', 'Time since the server started',
+              function=lambda: time.monotonic() - start_time)
 
-# Temperature control (run in separate thread):
+def reset_pid_stats(period):
+    pid_stats.clear()
+    pid_stats.update({'period_s': period, 'iterations': 0, 'overruns': 0,
+                      'jitter_mean_ms': 0.0, 'jitter_max_ms': 0.0,
+                      'jitter_buckets': [0]*len(pid_jitter_buckets_ms), 'cpu': 0.0})
+
+# Temperature control (run in separate thread). Runs every config.pid_period
+# seconds on a monotonic schedule; iterations that start late do not shift
+# later ones, and whole periods that were missed are skipped and counted:
 @log_function_call
 def run_pid(stop_event):
-    global well_temp
+    global well_temp, duty_cycle
     global const, Tb, Tt
-    rd = 50*1e6       # PID update period (ns)
-    ptrd = time.time_ns()   # time stamp for PID
-    start_time = time.time_ns()
+    period = config.pid_period
+    pid.sample_time = None          # the loop sets the update rate
+    reset_pid_stats(period)
+    jitter_sum = 0.0
+    temperature_recent.clear()
+    temperature_history.clear()
+    phistory = time.time()   # time stamp for temperature history samples
+    pevent = time.time_ns()  # time stamp for temperature events
+    t_prev = t_next = t_start = time.monotonic()
+    cpu_start, wall_start = time.thread_time(), t_next
     while not stop_event.is_set():
+        now = time.monotonic()
+        jitter_ms = (now - t_next)*1e3
         try:
-            pid.setpoint = Gp(set_temp)     # Change setpoint based on Pre-Filter
-            value_raw = [const.value, Tb.value, Tt.value]    # Read ADC values
-            values = [x*1023 for x in value_raw]
-            # Change the duty cycle based on the ADC reading    
-            duty_cycle = pid(config.b_bias*cali_fun(values[1] - values[0]) + (1-config.b_bias)*cali_fun(values[2] - values[0]))
+            pid.setpoint = Gp(set_temp, now - t_prev)    # Change setpoint based on Pre-Filter
+            sums = read_adc()                            # Read ADC values
+            # Change the duty cycle based on the ADC reading
+            well_temp = calibration.well_temperature(sums)   # calibration table lookup
+            duty_cycle = pid(well_temp)
             pwm.ChangeDutyCycle(duty_cycle)
-            if time.time_ns() - ptrd >= rd:      # Update values every 50ms
-                ptrd = time.time_ns()
-                well_temp = config.b_bias*cali_fun(values[1] - values[0]) + (1-config.b_bias)*cali_fun(values[2] - values[0])
+            t_wall = time.time()
+            temperature_recent.append(t_wall, (well_temp, pid.setpoint, duty_cycle))
+            if t_wall - phistory >= config.temperature_history_period:
+                phistory = t_wall
+                mean = temperature_recent.mean(config.temperature_history_period)
+                temperature_history.append(t_wall, [mean[c] for c in temperature_columns])
+            if time.time_ns() - pevent >= config.temperature_event_period*1e9:
+                pevent = time.time_ns()
+                events.publish('temperature', {
+                    't': now - t_start,     # sec since the control loop (the assay) started
+                    'temperature': well_temp,
+                    'setpoint': pid.setpoint,
+                    'duty_cycle': duty_cycle
+                    })
         except Exception as e:
-            print(f'Exception in run_pid: {e}', flush=True)
+            log.exception(f'Exception in run_pid: {e}')
+        pid_iteration_seconds.observe(time.monotonic() - now)
+        pid_jitter_seconds.observe(jitter_ms/1e3)
+        t_prev = now
+        pid_stats['iterations'] += 1
+        jitter_sum += jitter_ms
+        pid_stats['jitter_mean_ms'] = jitter_sum/pid_stats['iterations']
+        pid_stats['jitter_max_ms'] = max(pid_stats['jitter_max_ms'], jitter_ms)
+        pid_stats['jitter_buckets'][bisect.bisect_left(pid_jitter_buckets_ms, jitter_ms)] += 1
+        t_next += period
+        now = time.monotonic()
+        if now > t_next:          # iteration overran one or more periods
+            skipped = math.ceil((now - t_next)/period)
+            pid_stats['overruns'] += skipped
+            pid_overruns.inc(skipped)
+            t_next += skipped*period
+        pid_stats['cpu'] = (time.thread_time() - cpu_start)/max(now - wall_start, 1e-9)
+        stop_event.wait(t_next - now)
 
 @log_function_call
 def start_pid():
+    global pid_thread
+    if pid_thread is not None and pid_thread.is_alive():   # one control loop at a time
+        log.warning('start_pid(): PID thread already running')
+        return
     GPIO.output(config.FAN_PIN, GPIO.HIGH)   # Turn on system fan
-    t = threading.Thread(target=run_pid, args=(stop_event,))    # Start the PID loop
-    t.daemon = True
-    t.start()
+    stop_event.clear()
+    pid_thread = threading.Thread(target=run_pid, args=(stop_event,))    # Start the PID loop
+    pid_thread.daemon = True
+    pid_thread.start()
 
 @log_function_call
 def end_pid():
-    print('end_pid() called', flush=True)
-    sys.stdout.flush()
+    log.info('end_pid() called')
     stop_event.set()
+    if pid_thread is not None:
+        pid_thread.join()     # no more duty cycle updates after this
     pwm.ChangeDutyCycle(0)
 
+# Startup timing: seconds from the start of the server process (module
+# import) to each startup stage, and from boot to ready:
+startup = {}
+
+def startup_mark(stage):
+    startup[stage] = round(time.monotonic() - start_time, 3)
+
+def setup_camera():
+    log.info("Setting up camera...")
+    imager.setup_camera(exposure_time_ms=50, analogue_gain=0.5, color_gains=(1.2,1.0))
+    log.info("Camera setup done")
+    startup_mark('camera_ready')
+    if hasattr(time, 'CLOCK_BOOTTIME'):
+        startup['boot_to_ready'] = round(time.clock_gettime(time.CLOCK_BOOTTIME), 3)
+    log.info(f"System ready: {startup}")
+
 @log_function_call
 def run(port):
+    startup_mark('imports')
     handler_class=S
     server_address = ('', port)
-    httpd = HTTPServer(server_address, handler_class)
-    print("MAGI server started", flush=True)
-    print("Setting up camera...", flush=True)
-    sys.stdout.flush()
-    imager.setup_camera(exposure_time_ms=50, analogue_gain=0.5, color_gains=(1.2,1.0))
-    print("Camera setup done", flush=True)
-    print("System ready", flush=True)
-    sys.stdout.flush()
+    httpd = ThreadingHTTPServer(server_address, handler_class)   # event streams hold a thread each
+    httpd.daemon_threads = True
+    startup_mark('server_ready')
+    log.info("MAGI server started")
+    if config.background_camera_setup:    # answer requests (ping) during the camera setup
+        threading.Thread(target=setup_camera, daemon=True).start()
+    else:
+        setup_camera()
     try:
         httpd.serve_forever()     # blocking call
     except KeyboardInterrupt:
@@ -277,24 +788,30 @@ def run(port):
     GPIO.output(config.FAN_PIN, GPIO.LOW)
     GPIO.output(config.PWM_PIN, GPIO.LOW)
     GPIO.cleanup()
-    print('\n\nGPIO cleaned up', flush=True)
-    sys.stdout.flush()
+    log.info('GPIO cleaned up')
 
 @log_function_call
 def shutdown():
     GPIO.cleanup()
+    if config.simulate_hardware:
+        log.info('shutdown skipped (simulated hardware)')
+        return
     subprocess.call("sudo shutdown -h now", shell=True)
 
 @log_function_call
 def reboot():
     GPIO.cleanup()
+    if config.simulate_hardware:
+        log.info('reboot skipped (simulated hardware)')
+        return
     subprocess.call("sudo reboot", shell=True)
 
 
 if __name__ == "__main__":
-    print("MAGI server starting...", flush=True)
-    sys.stdout.flush()
+    serverlog.setup(config.logfile, config.log_level, config.log_max_bytes,
+                    config.log_backup_count, console=sys.stdout.isatty())
+    log.info("MAGI server starting...")
     GPIO.output(config.STATUS_LED_PIN, GPIO.LOW)   # start with status light off
-    run(8080)
+    run(config.server_port)
 
 
@@ -0,0 +1,234 @@
+# In-process metrics: counters, gauges and fixed-bucket histograms
+#
+# Metrics are module-level objects created once at import, e.g.
+#
+#   capture_seconds = metrics.histogram('magi_capture_seconds', 'Frame capture time')
+#   capture_seconds.observe(t1 - t0)
+#
+# Updates take no lock: every thread adds to its own shard of a metric
+# (a threading.local dict of label value -> counts), and only the first
+# update from a thread registers its shard. Shards are summed when the
+# metrics are read; the shards of finished threads (e.g. HTTP connection
+# threads) are folded into one. A metric may have one label (e.g. 'action'),
+# given as the label value on each update.
+#
+# exposition() renders all metrics in the Prometheus text format (GET
+# /metrics), snapshot() as compact JSON (getMetrics action).
+
+import time
+import bisect
+import functools
+import threading
+
+# Default histogram buckets (upper bounds, s): 0.1 ms to 10 s:
+latency_buckets = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+                   0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+max_shards = 64     # fold the shards of finished threads beyond this many
+
+registry = {}       # metric name -> metric, in order of creation
+registry_lock = threading.Lock()
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, label=None):
+        self.name, self.help, self.label = name, help, label
+        self.local = threading.local()
+        self.shards = []        # [(thread, {label value: counts})]
+        self.retired = {}       # summed shards of finished threads
+        self.lock = threading.Lock()
+
+    # The calling thread's shard:
+    def shard(self):
+        try:
+            return(self.local.shard)
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                if len(self.shards) >= max_shards:
+                    self.fold()
+                self.shards.append((threading.current_thread(), shard))
+            return(shard)
+
+    # Fold the shards of finished threads into self.retired (with self.lock):
+    def fold(self):
+        live = []
+        for (thread, shard) in self.shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                add_counts(self.retired, shard)
+        self.shards = live
+
+    # Counts per label value, summed over all threads:
+    def collect(self):
+        with self.lock:
+            self.fold()
+            totals = {}
+            add_counts(totals, self.retired)
+            for (thread, shard) in self.shards:
+                add_counts(totals, shard)
+        return(totals)
+
+    def reset(self):
+        with self.lock:
+            for (thread, shard) in self.shards:
+                shard.clear()
+            self.retired.clear()
+
+def add_counts(totals, shard):
+    for (value, counts) in list(shard.items()):
+        total = totals.get(value)
+        if total is None:
+            totals[value] = list(counts)
+        else:
+            for (i, count) in enumerate(counts):
+                total[i] += count
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, label=''):
+        shard = self.shard()
+        counts = shard.get(label)
+        if counts is None:
+            counts = shard[label] = [0]
+        counts[0] += amount
+
+    def values(self):
+        return({value: counts[0] for (value, counts) in self.collect().items()})
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    # counts: one per bucket (the last for values above all buckets), then the sum:
+    def __init__(self, name, help, label=None, buckets=latency_buckets):
+        super().__init__(name, help, label)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, label=''):
+        shard = self.shard()
+        counts = shard.get(label)
+        if counts is None:
+            counts = shard[label] = [0]*(len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    # {label value: {'count', 'sum', 'buckets': per-bucket counts}}:
+    def values(self):
+        return({value: {'count': sum(counts[:-1]), 'sum': counts[-1], 'buckets': counts[:-1]}
+                for (value, counts) in self.collect().items()})
+
+# Gauges hold the last value set (a plain assignment), or are computed by
+# `function` (returning a number or {label value: number}) when read:
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help, label=None, function=None):
+        self.name, self.help, self.label = name, help, label
+        self.function = function
+        self.current = {}
+
+    def set(self, value, label=''):
+        self.current[label] = value
+
+    def values(self):
+        if self.function is None:
+            return(dict(self.current))
+        value = self.function()
+        return(value if isinstance(value, dict) else {'': value})
+
+    def reset(self):
+        self.current.clear()
+
+# Create a metric, or return the one already registered under the name:
+def register(cls, name, *args, **kwargs):
+    with registry_lock:
+        metric = registry.get(name)
+        if metric is None:
+            metric = registry[name] = cls(name, *args, **kwargs)
+    return(metric)
+
+def counter(name, help, label=None):
+    return(register(Counter, name, help, label))
+
+def histogram(name, help, label=None, buckets=latency_buckets):
+    return(register(Histogram, name, help, label, buckets))
+
+def gauge(name, help, label=None, function=None):
+    return(register(Gauge, name, help, label, function))
+
+# Decorator observing the duration of every call in `histogram`:
+def timed(histogram, label=''):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - t0, label)
+        return wrapper
+    return decorate
+
+def reset():
+    for metric in list(registry.values()):
+        metric.reset()
+
+def label_text(label, value, extra=''):
+    labels = [f'{label}="{escape(value)}"'] if label and value != '' else []
+    labels += [extra] if extra else []
+    return('{' + ','.join(labels) + '}' if labels else '')
+
+def escape(value):
+    return(str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+def number(value):
+    value = float(value)
+    if value != value:
+        return('NaN')
+    if abs(value) == float('inf'):
+        return('+Inf' if value > 0 else '-Inf')
+    return(str(int(value)) if value.is_integer() and abs(value) < 1e15 else repr(value))
+
+# All metrics in the Prometheus text exposition format (version 0.0.4):
+def exposition():
+    lines = []
+    for metric in list(registry.values()):
+        try:
+            values = metric.values()
+        except Exception:   # a failing gauge function must not break the scrape
+            values = {}
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for (value, v) in values.items():
+            if metric.kind != 'histogram':
+                lines.append(f'{metric.name}{label_text(metric.label, value)} {number(v)}')
+                continue
+            cumulative = 0
+            for (le, count) in zip(metric.buckets + (float('inf'),), v['buckets']):
+                cumulative += count
+                le_label = 'le="' + ('+Inf' if le == float('inf') else repr(le)) + '"'
+                lines.append(f'{metric.name}_bucket{label_text(metric.label, value, le_label)} {cumulative}')
+            lines.append(f'{metric.name}_sum{label_text(metric.label, value)} {number(v["sum"])}')
+            lines.append(f'{metric.name}_count{label_text(metric.label, value)} {v["count"]}')
+    return('\n'.join(lines) + '\n')
+
+# All metrics as {name: value} for unlabeled metrics or {name: {label value:
+# value}}, with histograms as {'count', 'sum', 'buckets'} (per-bucket counts
+# for the upper bounds in 'le' of the metric, the last one above all bounds):
+def snapshot():
+    result = {}
+    for metric in list(registry.values()):
+        try:
+            values = metric.values()
+        except Exception:
+            continue
+        if metric.kind == 'histogram':
+            empty = {'count': 0, 'sum': 0.0, 'buckets': [0]*(len(metric.buckets) + 1)}
+            values = (dict(values.get('', empty), le=list(metric.buckets)) if metric.label is None
+                      else {'le': list(metric.buckets), 'values': values})
+        elif metric.label is None:
+            values = values.get('', 0)
+        result[metric.name] = values
+    return(result)
@@ -0,0 +1,151 @@
+# Incremental (online) TTP detection during an assay
+#
+# Each new sample from the acquisition scheduler is passed through a causal
+# Butterworth filter with per-well state, so provisional TTPs and hit calls
+# are available while the assay is running. The zero-phase filter in
+# filter_curves.filter() remains the final answer after the assay ends.
+#
+# A well is called once its filtered curve has risen by at least
+# config.online_min_rise, is above 90% of its rise so far, and its slope has
+# fallen below config.online_plateau_fraction of the peak slope (i.e. the
+# midpoint of the amplification curve has passed). Its provisional TTP is
+# then found with get_ttp() on the curve normalized so far, corrected for
+# the group delay of the causal filter.
+
+import logging
+
+import numpy as np
+
+import events
+import filter_curves
+import config   # Cross-module global variables for all Python codes
+from config import log_function_call
+
+log = logging.getLogger('magi.online')
+
+sos = None
+zi = None               # filter state, (sections, 2, wells)
+delay_min = 0.0         # filter group delay (min)
+threshold = 0
+n = 0                   # number of samples so far
+t = None                # sample times (min), grown by doubling
+yf = None               # filtered samples (samples x wells)
+last_good = None        # last repaired raw value per well
+raw_max = None
+f_min = f_max = None    # running min/max of the filtered curves
+prev = None             # previous filtered sample
+peak_slope = None
+called = None           # True once a well has been called
+ttp = None              # provisional TTP per well (min)
+call_time = None        # assay time (min) at which each well was called
+genes = []              # gene target for each well
+calls = {}              # target -> current hit status
+
+# Start online analysis for a new assay sampled every `period` seconds:
+@log_function_call
+def reset(num_wells, period, filter_factor=10.0, threshold_value=0):
+    global sos, zi, delay_min, threshold, n, t, yf, last_good, raw_max
+    global f_min, f_max, prev, peak_slope, called, ttp, call_time, genes, calls
+    from scipy.signal import butter, sos2tf, group_delay   # slow import, only when used
+    fs = 60.0/period             # sample rate (cycles/min)
+    f_nyquist = fs/2.0
+    Wn = f_nyquist/filter_factor
+    if Wn >= f_nyquist:
+        Wn = 0.999*f_nyquist
+    sos = butter(6, Wn, btype='low', analog=False, fs=fs, output='sos')
+    delay_samples = group_delay(sos2tf(sos), w=[1e-3*np.pi])[1][0]
+    delay_min = float(delay_samples)/fs
+    threshold = threshold_value
+    zi = None
+    n = 0
+    t = np.zeros(256)
+    yf = np.zeros((256, num_wells))
+    last_good = raw_max = f_min = f_max = prev = None
+    peak_slope = np.zeros(num_wells)
+    called = np.zeros(num_wells, dtype=bool)
+    ttp = np.full(num_wells, -0.001)
+    call_time = np.full(num_wells, np.nan)
+    genes = [str(gene) for row in config.well_config for gene in row][:num_wells]
+    calls = {}
+
+# Add one sample (t_sec since the start of the assay, one value per well):
+def update(t_sec, values):
+    global zi, n, t, yf, last_good, raw_max, f_min, f_max, prev
+    from scipy.signal import sosfilt, sosfilt_zi   # loaded by reset()
+    y = np.asarray(values, dtype=float)
+    # Remove spurious dropped data (as in filter_curves.repair_dropouts()):
+    if last_good is not None:
+        y = np.where(y < 2, last_good, y)
+    last_good = y
+    if zi is None:           # start the filter in steady state at the first sample
+        zi = sosfilt_zi(sos)[:, :, None] * y[None, None, :]
+        raw_max = y.copy()
+    f, zi = sosfilt(sos, y[None, :], axis=0, zi=zi)
+    f = f[0]
+    if n == len(t):          # grow history buffers
+        t = np.concatenate([t, np.zeros_like(t)])
+        yf = np.concatenate([yf, np.zeros_like(yf)])
+    t[n] = t_sec/60.0
+    yf[n] = f
+    n += 1
+    raw_max = np.maximum(raw_max, y)
+    if prev is None:
+        f_min, f_max, prev = f.copy(), f.copy(), f
+        return
+    np.minimum(f_min, f, out=f_min)
+    np.maximum(f_max, f, out=f_max)
+    slope = f - prev
+    prev = f
+    np.maximum(peak_slope, slope, out=peak_slope)
+    rise = f_max - f_min
+    with np.errstate(divide='ignore', invalid='ignore'):
+        level = (f - f_min)/rise
+    new = (~called & (rise >= config.online_min_rise) & (raw_max >= threshold)
+           & (level > 0.9) & (slope < config.online_plateau_fraction*peak_slope))
+    for well in np.flatnonzero(new):
+        norm = (yf[:n, well] - f_min[well])/rise[well]
+        well_ttp = filter_curves.get_ttp(t[:n], norm)
+        if well_ttp < 0:     # no clean midpoint crossing yet
+            continue
+        called[well] = True
+        ttp[well] = well_ttp - delay_min
+        call_time[well] = t[n-1]
+        events.publish('well', {'well': int(well), 'gene': genes[well] if well < len(genes) else '',
+                                'ttp': float(ttp[well]), 't': float(t[n-1])})
+    evaluate_hits()
+
+# Evaluate the hit rules of the current card (config.card) the same way the
+# client does after analysis: a gene amplified once all its wells are
+# called and their mean TTP is in (0.1, 50) min. A gene that has not
+# amplified is only known not to once config.online_decision_time has
+# passed. Targets whose status changes are pushed as 'call' events:
+def evaluate_hits():
+    card = config.card
+    if card is None or not card.targets or card.num_wells != len(ttp):
+        return
+    now = t[n-1]
+    decided = now >= config.online_decision_time
+    amplified = card.amplified(np.where(called, ttp, np.nan))   # uncalled wells: NaN mean
+    status_array, final_array = card.evaluate(amplified, decided)
+    for (target, status, final) in zip(card.targets, status_array.tolist(), final_array.tolist()):
+        if calls.get(target) != (status, final):
+            calls[target] = (status, final)
+            log.info(f'online call: {target} {status} (final={final}) @ {now:.2f} min')
+            events.publish('call', {'target': target, 'status': status,
+                                    'provisional': not final, 't': float(now)})
+
+# Replay a recorded run CSV through the online detector and compare the
+# provisional TTPs and call times with the offline filter_curves.filter()
+# result. Returns per-well arrays (NaN where a well was never called):
+@log_function_call
+def replay(filename, filter_factor=10.0, threshold_value=0):
+    data = filter_curves.load_data(filename)
+    num_wells = len(config.well_config) * len(config.well_config[0])
+    period = float(np.median(np.diff(data[:, 0])))
+    reset(num_wells, period, filter_factor, threshold_value)
+    for row in data:
+        update(row[0] - data[0, 0], row[1:num_wells+1])
+    offline = np.array(filter_curves.filter(filename, filter_factor, 0.0, threshold_value)['ttp'])
+    online_ttp = np.where(called, ttp, np.nan)
+    return({'offline_ttp': offline, 'online_ttp': online_ttp,
+            'call_time': call_time.copy(), 'latency': call_time - offline})
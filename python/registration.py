@@ -0,0 +1,128 @@
+# ROI registration and drift tracking
+#
+# The ROIs from the card file can be off by a few pixels from the wells in
+# the image (card placement), and the card can move while it heats. Each
+# well is modeled by a zero-mean kernel: +1 inside its ROI and a negative
+# ring config.registration_ring px wide around it. The sum of all well
+# kernels (the card geometry template) is correlated with the image:
+#
+#   register() - at setupAssay, cross-correlation of a reference frame with
+#                the template by FFT, over shifts of up to
+#                config.registration_search px
+#   track()    - for each sample, the same score for shifts of up to
+#                config.drift_search px around the current offset, from box
+#                sums on an integral image of the ROI area only
+#
+# The offset found is applied by roi_engine (roi_engine.offset). Drift is
+# only tracked after a successful registration, i.e. when the wells are
+# visible in the image.
+
+import logging
+
+import numpy as np
+
+import roi_engine
+import config   # Cross-module global variables for all Python codes
+from config import log_function_call
+
+log = logging.getLogger('magi.registration')
+
+score = 0.0         # detection score of the last registration (peak z-score)
+locked = False      # True after a successful registration: track() is active
+
+# ROI upper left corners and size:
+def roi_boxes():
+    x = np.array([int(roi['x']) for roi in config.ROIs])
+    y = np.array([int(roi['y']) for roi in config.ROIs])
+    return(x, y, int(config.roi_width), int(config.roi_height))
+
+# Weight of the ring relative to the ROI so that each well kernel sums to zero:
+def ring_weight():
+    w, h, r = config.roi_width, config.roi_height, config.registration_ring
+    return(w*h/((w + 2*r)*(h + 2*r) - w*h))
+
+# Card geometry template for a frame of the given (height, width):
+def template(shape):
+    t = np.zeros(shape, dtype=np.float32)
+    x, y, w, h = roi_boxes()
+    r = config.registration_ring
+    for (xi, yi) in zip(x, y):
+        t[max(yi-r, 0):yi+h+r, max(xi-r, 0):xi+w+r] = -ring_weight()
+    for (xi, yi) in zip(x, y):
+        t[yi:yi+h, xi:xi+w] = 1
+    return(t)
+
+# Range of offsets (dx, dy) keeping all ROIs (with rings) inside the frame:
+def offset_limits(frame_shape):
+    x, y, w, h = roi_boxes()
+    r = config.registration_ring
+    return((r - x.min(), frame_shape[1] - r - w - x.max()),
+           (r - y.min(), frame_shape[0] - r - h - y.max()))
+
+# Find the ROI offset in a reference frame and apply it. The offset is only
+# changed if the correlation peak stands out (z-score of at least
+# config.registration_min_score); otherwise the card geometry is used as is:
+@log_function_call
+def register(frame, channel=1):
+    global score, locked
+    locked = False
+    if not config.ROIs:
+        return((0, 0))
+    g = np.asarray(frame)[..., channel].astype(np.float32)
+    g -= g.mean()
+    correlation = np.fft.irfft2(np.fft.rfft2(g)*np.conj(np.fft.rfft2(template(g.shape))), s=g.shape)
+    (dx_min, dx_max), (dy_min, dy_max) = offset_limits(g.shape)
+    search = config.registration_search
+    dx = np.arange(max(-search, dx_min), min(search, dx_max) + 1)
+    dy = np.arange(max(-search, dy_min), min(search, dy_max) + 1)
+    window = correlation[np.ix_(dy % g.shape[0], dx % g.shape[1])]   # c[dy, dx] = sum g(p+d)*t(p)
+    iy, ix = np.unravel_index(window.argmax(), window.shape)
+    score = float((window[iy, ix] - window.mean())/(window.std() + 1e-12))
+    locked = score >= config.registration_min_score
+    if locked:
+        roi_engine.offset = (int(dx[ix]), int(dy[iy]))
+    else:
+        roi_engine.offset = (0, 0)
+    log.info(f'ROI registration: offset={roi_engine.offset}, score={score:.1f}')
+    return(roi_engine.offset)
+
+# Box sums of an integral image (with a leading row & column of zeros) for
+# boxes with upper left corners (x, y) (arrays) and size w x h:
+def box_sums(integral, x, y, w, h):
+    return(integral[y+h, x+w] - integral[y, x+w] - integral[y+h, x] + integral[y, x])
+
+# Update the ROI offset for drift, searching config.drift_search px around
+# the current offset. The offset only moves if the best score beats the
+# current one by config.drift_hysteresis of the score range, so noise does
+# not make the ROIs jitter. Returns the offset:
+def track(frame, channel=1):
+    if roi_engine.bbox is None or not locked:
+        return(roi_engine.offset)
+    frame = np.asarray(frame)
+    x, y, w, h = roi_boxes()
+    r = config.registration_ring
+    k = config.drift_search
+    dx0, dy0 = roi_engine.offset
+    # Candidate offsets within the frame:
+    (dx_min, dx_max), (dy_min, dy_max) = offset_limits(frame.shape)
+    dxs = np.arange(max(dx0-k, dx_min), min(dx0+k, dx_max) + 1)
+    dys = np.arange(max(dy0-k, dy_min), min(dy0+k, dy_max) + 1)
+    if len(dxs) == 0 or len(dys) == 0:
+        return(roi_engine.offset)
+    # Integral image of the area the candidates can reach:
+    X0, Y0 = int(x.min() + dxs[0] - r), int(y.min() + dys[0] - r)
+    X1, Y1 = int(x.max() + dxs[-1] + w + r), int(y.max() + dys[-1] + h + r)
+    region = frame[Y0:Y1, X0:X1, channel]
+    integral = np.zeros((region.shape[0] + 1, region.shape[1] + 1), dtype=np.int64)
+    integral[1:, 1:] = region.cumsum(axis=0, dtype=np.int64).cumsum(axis=1)
+    DX, DY = np.meshgrid(dxs, dys)                  # (len(dys), len(dxs)) candidates
+    xs = x[None, None, :] + DX[..., None] - X0      # ROI corners for every candidate
+    ys = y[None, None, :] + DY[..., None] - Y0
+    inner = box_sums(integral, xs, ys, w, h)
+    outer = box_sums(integral, xs - r, ys - r, w + 2*r, h + 2*r)
+    scores = (inner - ring_weight()*(outer - inner)).sum(axis=-1)
+    current = scores[dy0 - dys[0], dx0 - dxs[0]] if (dxs[0] <= dx0 <= dxs[-1] and dys[0] <= dy0 <= dys[-1]) else -np.inf
+    iy, ix = np.unravel_index(scores.argmax(), scores.shape)
+    if scores[iy, ix] - current > config.drift_hysteresis*(scores.max() - scores.min()):
+        roi_engine.offset = (int(dxs[ix]), int(dys[iy]))
+    return(roi_engine.offset)
@@ -0,0 +1,77 @@
+# Fixed-size ring buffer of timestamped numeric samples
+#
+# Samples are rows of a preallocated float64 array (no per-sample objects).
+# A single writer thread appends; readers never block it. A sample is
+# published by advancing the sample count after its row has been written,
+# and readers only use rows below the count they read. Running column sums
+# are stored per row, so the mean over the last k samples costs O(1).
+
+import bisect
+
+import numpy as np
+
+class RingBuffer:
+    # columns: names of the values stored with each time stamp
+    def __init__(self, capacity, columns):
+        self.capacity = int(capacity)
+        self.columns = list(columns)
+        self.t = np.zeros(self.capacity)
+        self.data = np.zeros((self.capacity, len(self.columns)))
+        self.cumsum = np.zeros((self.capacity, len(self.columns)))   # running sums up to each row
+        self.total = np.zeros(len(self.columns))
+        self.n = 0           # number of samples ever appended
+
+    def append(self, t, values):
+        i = self.n % self.capacity
+        self.total += values
+        self.t[i] = t
+        self.data[i] = values
+        self.cumsum[i] = self.total
+        self.n += 1          # publish the sample
+
+    def clear(self):
+        self.total = np.zeros(len(self.columns))
+        self.n = 0
+
+    def __len__(self):
+        return(min(self.n, self.capacity))
+
+    # Latest sample as {'t': .., column: ..}, or None if empty:
+    def latest(self):
+        n = self.n
+        if n == 0:
+            return(None)
+        i = (n - 1) % self.capacity
+        return(dict(zip(['t'] + self.columns, [float(self.t[i])] + self.data[i].tolist())))
+
+    # Column means of the last k samples (at most capacity - 1):
+    def mean_last(self, k):
+        n = self.n
+        k = min(int(k), n, self.capacity - 1)
+        if k <= 0:
+            return(None)
+        last = self.cumsum[(n - 1) % self.capacity]
+        first = self.cumsum[(n - 1 - k) % self.capacity] if n > k else 0.0
+        return(dict(zip(self.columns, ((last - first)/k).tolist())))
+
+    # Absolute index of the first stored sample with time stamp >= t:
+    def index_at(self, t, n=None):
+        n = self.n if n is None else n
+        oldest = max(n - self.capacity, 0)
+        return(bisect.bisect_left(range(oldest, n), t, key=lambda j: self.t[j % self.capacity]) + oldest)
+
+    # Column means of the samples in the last `seconds`:
+    def mean(self, seconds):
+        n = self.n
+        if n == 0:
+            return(None)
+        t_last = self.t[(n - 1) % self.capacity]
+        return(self.mean_last(n - self.index_at(t_last - seconds, n)))
+
+    # Copy of all stored samples with time stamp > since, as a
+    # (samples x (1 + columns)) array of time stamp and values:
+    def since(self, since=float('-inf')):
+        n = self.n
+        start = self.index_at(np.nextafter(since, np.inf), n)
+        rows = np.arange(start, n) % self.capacity
+        return(np.column_stack([self.t[rows], self.data[rows]]))
@@ -0,0 +1,107 @@
+# Vectorized ROI extraction engine
+#
+# All ROIs on an assay card share the same width and height, so the pixels
+# of every ROI can be gathered from a frame with a single fancy-index into a
+# (num_rois, roi_height, roi_width, channels) array and reduced in one pass.
+# The index arrays are built once by build_index() (called from
+# imager.setup_ROIs()) and reused for every captured frame.
+
+import numpy as np
+
+import config   # Cross-module global variables for all Python codes
+from config import log_function_call
+
+# Precomputed indexes (relative to the upper left corner of the ROI bounding box):
+bbox = None       # (x0, y0, x1, y1) bounding box enclosing all ROIs
+row_index = None  # (num_rois, roi_height, 1) row indexes
+col_index = None  # (num_rois, 1, roi_width) column indexes
+offset = (0, 0)   # (dx, dy) shift of all ROIs found by registration.py
+
+# Build the gather indexes for the current ROI list:
+@log_function_call
+def build_index(ROIs=None, roi_width=None, roi_height=None):
+    global bbox, row_index, col_index, offset
+    offset = (0, 0)
+    ROIs = config.ROIs if ROIs is None else ROIs
+    roi_width = config.roi_width if roi_width is None else roi_width
+    roi_height = config.roi_height if roi_height is None else roi_height
+    if not ROIs:
+        bbox = row_index = col_index = None
+        return
+    x = np.array([int(roi['x']) for roi in ROIs])
+    y = np.array([int(roi['y']) for roi in ROIs])
+    x0, y0 = int(x.min()), int(y.min())
+    bbox = (x0, y0, int(x.max()) + int(roi_width), int(y.max()) + int(roi_height))
+    row_index = (y - y0)[:, None, None] + np.arange(int(roi_height))[None, :, None]
+    col_index = (x - x0)[:, None, None] + np.arange(int(roi_width))[None, None, :]
+
+# Return the part of the frame covered by the (shifted) ROIs (a view, not a copy):
+def crop(frame):
+    x0, y0, x1, y1 = bbox
+    dx, dy = offset
+    return(frame[y0+dy:y1+dy, x0+dx:x1+dx])
+
+# Gather all ROI pixels as a (num_rois, roi_height*roi_width, channels) array:
+def gather(frame):
+    pixels = crop(np.asarray(frame))[row_index, col_index]
+    if pixels.ndim == 3:              # single channel (e.g. luma) frame
+        pixels = pixels[..., None]
+    return(pixels.reshape(pixels.shape[0], -1, pixels.shape[-1]))
+
+# Return per-ROI, per-channel mean, median and standard deviation as
+# (num_rois, channels) float arrays:
+def roi_stats(frame):
+    pixels = gather(frame).astype(np.float32)
+    return({
+        'mean': pixels.mean(axis=1),
+        'median': np.median(pixels, axis=1),
+        'std': pixels.std(axis=1)
+        })
+
+# Return the scaled average of one channel for every ROI, matching the values
+# previously produced by imager.roi_avg() (int(100 * mean)):
+def roi_values(frame, channel=1):
+    if bbox is None:                  # no ROIs set up
+        return([])
+    pixels = gather(frame)[..., channel]
+    sums = pixels.sum(axis=1, dtype=np.int64)
+    return([int(100*s/pixels.shape[1]) for s in sums])
+
+# Per-ROI pixel sum, sum of squares and number of saturated pixels of one
+# channel (int64 arrays), for reducing bursts of frames with running sums:
+def roi_moments(frame, channel=1, saturation=255):
+    pixels = gather(frame)[..., channel]
+    wide = pixels.astype(np.int32)
+    sums = pixels.sum(axis=1, dtype=np.int64)
+    sumsq = np.einsum('ij,ij->i', wide, wide, dtype=np.int64)
+    saturated = np.count_nonzero(pixels >= saturation, axis=1)
+    return(sums, sumsq, saturated)
+
+# Combine burst statistics [(exposure, frames, sums, sumsq, saturated), ...]
+# (one entry per exposure) into per-ROI values scaled to reference_exposure.
+# Each ROI averages the exposures without saturated pixels, weighted by
+# collected light (frames * exposure); if all are saturated, the shortest
+# exposure is used. Returns values (int(100 * mean), as roi_values()),
+# pixel variance and total saturated pixel count per ROI:
+def combine_moments(stats, reference_exposure):
+    pixels = row_index.shape[1]*col_index.shape[2]
+    if len(stats) == 1 and stats[0][0] == reference_exposure:
+        exposure, frames, sums, sumsq, saturated = stats[0]
+        count = frames*pixels
+        mean = sums/count
+        return({'values': ((100*sums)//count).tolist(), 'var': sumsq/count - mean**2,
+                'sat': saturated})
+    exposures = np.array([float(entry[0]) for entry in stats])
+    frames = np.array([entry[1] for entry in stats])
+    scale = (reference_exposure/exposures)[:, None]
+    means = np.array([entry[2] for entry in stats])/(frames*pixels)[:, None]
+    variances = np.array([entry[3] for entry in stats])/(frames*pixels)[:, None] - means**2
+    saturated = np.array([entry[4] for entry in stats])
+    weights = (frames*exposures)[:, None]*(saturated == 0)
+    all_saturated = weights.sum(axis=0) == 0
+    weights[exposures.argmin(), all_saturated] = 1
+    weights = weights/weights.sum(axis=0)
+    mean = (weights*means*scale).sum(axis=0)
+    return({'values': (100*mean).astype(int).tolist(),
+            'var': (weights*variances*scale**2).sum(axis=0),
+            'sat': saturated.sum(axis=0)})
@@ -0,0 +1,140 @@
+# Binary append-only sample log
+#
+# Replaces the per-sample CSV text writer. The file is a fixed header
+# followed by fixed-size records, so it can be memory-mapped and loaded
+# for analysis without parsing:
+#
+#   header:  b'MAGILOG1' | uint32 header length | JSON record layout
+#            (padded with spaces to a multiple of 64 bytes)
+#   records: index (uint32) | crc (uint32) | time (float64) | values (float32 x N)
+#            [| extra fields declared in the header]
+#
+# Each record is written with a single os.write() call and carries a CRC32
+# of its other fields. On opening an existing log, a torn or partial record
+# at the end (e.g. after a power loss) is detected and truncated away.
+
+import os
+import json
+import time
+import zlib
+import logging
+
+import numpy as np
+
+import config   # Cross-module global variables for all Python codes
+from config import log_function_call
+
+log = logging.getLogger('magi.samplelog')
+
+MAGIC = b'MAGILOG1'
+
+# Record layout for num_values ROI values plus optional extra fields
+# [(name, dtype, shape), ...]:
+def record_dtype(num_values, extra_fields=()):
+    fields = [('index', '<u4'), ('crc', '<u4'), ('time', '<f8'), ('values', '<f4', (num_values,))]
+    fields += [tuple(field) for field in extra_fields]
+    return(np.dtype(fields))
+
+def _dtype_from_descr(descr):
+    return(np.dtype([tuple(field[:2]) + ((tuple(field[2]),) if len(field) > 2 else ())
+                     for field in descr]))
+
+# Read the header, returning (record dtype, header length):
+def read_header(f):
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError('not a MAGI sample log')
+    header_len = int(np.frombuffer(f.read(4), '<u4')[0])
+    layout = json.loads(f.read(header_len - len(MAGIC) - 4))
+    return(_dtype_from_descr(layout['descr']), header_len)
+
+def _crc(record):
+    return(zlib.crc32(record.tobytes()[8:]))    # everything after index & crc
+
+class SampleLog:
+    # Open (and recover) an existing log, or create a new one with
+    # num_values ROI values per record:
+    def __init__(self, filename, num_values=None, extra_fields=(), fsync=None, fsync_interval=None):
+        self.filename = filename
+        self.fsync = config.sample_log_fsync if fsync is None else fsync
+        self.fsync_interval = config.sample_log_fsync_interval if fsync_interval is None else fsync_interval
+        self.last_fsync = time.monotonic()
+        if os.path.isfile(filename) and os.path.getsize(filename) > 0:
+            with open(filename, 'rb') as f:
+                self.dtype, self.header_len = read_header(f)
+            self.count = self.recover()
+        else:
+            self.dtype = record_dtype(num_values, extra_fields)
+            layout = json.dumps({'descr': self.dtype.descr}).encode('utf-8')
+            self.header_len = -(-(len(MAGIC) + 4 + len(layout))//64)*64
+            header = MAGIC + np.uint32(self.header_len).tobytes() + layout
+            header += b' '*(self.header_len - len(header))
+            with open(filename, 'wb') as f:
+                f.write(header)
+            self.count = 0
+        self.fd = os.open(filename, os.O_WRONLY | os.O_APPEND)
+        self.record = np.zeros(1, dtype=self.dtype)
+
+    # Drop partial or corrupt records from the end of the file, return the
+    # number of good records:
+    def recover(self):
+        size = os.path.getsize(self.filename) - self.header_len
+        count = size//self.dtype.itemsize
+        if count > 0:
+            records = np.memmap(self.filename, dtype=self.dtype, mode='r',
+                                offset=self.header_len, shape=(count,))
+            while count > 0 and (records[count-1]['index'] != count-1
+                                 or records[count-1]['crc'] != _crc(records[count-1:count])):
+                count -= 1
+            del records
+        good_size = self.header_len + count*self.dtype.itemsize
+        if good_size != os.path.getsize(self.filename):
+            log.warning(f'{self.filename}: dropped {os.path.getsize(self.filename) - good_size} '
+                        f'bytes of partial records')
+            os.truncate(self.filename, good_size)
+        return(count)
+
+    # Append one sample; extra fields (if declared) are given as keywords:
+    def append(self, timestamp, values, **extra):
+        record = self.record
+        record['index'] = self.count
+        record['time'] = timestamp
+        record['values'] = values
+        for (name, value) in extra.items():
+            record[name] = value
+        record['crc'] = _crc(record)
+        os.write(self.fd, record.tobytes())
+        self.count += 1
+        if self.fsync == 'always' or (self.fsync == 'interval'
+                and time.monotonic() - self.last_fsync >= self.fsync_interval):
+            os.fsync(self.fd)
+            self.last_fsync = time.monotonic()
+
+    def close(self):
+        if self.fd is not None:
+            if self.fsync != 'never':
+                os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+# Memory-map all complete records of a log (no parsing):
+def load(filename):
+    with open(filename, 'rb') as f:
+        dtype, header_len = read_header(f)
+    count = (os.path.getsize(filename) - header_len)//dtype.itemsize
+    if count == 0:
+        return(np.zeros(0, dtype=dtype))
+    return(np.memmap(filename, dtype=dtype, mode='r', offset=header_len, shape=(count,)))
+
+# Return the log as a (samples x (1 + values)) array in the CSV layout:
+# unix time stamp (s, float) followed by the ROI values:
+def to_array(filename):
+    records = load(filename)
+    return(np.column_stack([records['time'], records['values']]))
+
+# Write the log in the CSV layout used by the temp_data.csv text writer:
+@log_function_call
+def export_csv(filename, csv_filename):
+    data = to_array(filename)
+    data[:, 0] = np.trunc(data[:, 0])     # whole seconds
+    np.savetxt(csv_filename, data, fmt='%d', delimiter=',')
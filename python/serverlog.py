@@ -0,0 +1,148 @@
+# Server log and function call tracing
+#
+# Modules log through the standard logging module with loggers named
+# 'magi.<module>'. setup() routes all of them through a queue
+# (QueueHandler): the calling thread only enqueues the record (no file I/O
+# or flush), and a listener thread (QueueListener) writes it to the log file,
+# which is rotated by size (RotatingFileHandler: magi_server.log,
+# magi_server.log.1, ...). Records below config.log_level are dropped
+# before they are created. Lines have the form:
+#
+#   2024-05-01 12:00:00.123 INFO Thread-3 magi.imager: message key=value ...
+#
+# config.log_function_call times every config.trace_sample_every-th call of
+# a decorated function; trace() keeps per-function call statistics and logs
+# the sampled durations at DEBUG level.
+
+import os
+import sys
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+log_format = '%(asctime)s.%(msecs)03d %(levelname)s %(threadName)s %(name)s: %(message)s'
+date_format = '%Y-%m-%d %H:%M:%S'
+levels = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+
+root = logging.getLogger('magi')
+listener = None      # QueueListener writing the log file
+file_handler = None
+calls = {}           # function name -> {'calls', 'sampled', 'total_ms', 'max_ms'}
+                     # (calls: count at the last sampled call)
+calls_lock = threading.Lock()
+trace_log = logging.getLogger('magi.trace')
+
+# Log to `filename` (and to stdout if console) from a listener thread:
+def setup(filename, level='INFO', max_bytes=2*1024*1024, backup_count=3, console=False):
+    global listener, file_handler
+    stop()
+    file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes,
+                                                        backupCount=backup_count)
+    handlers = [file_handler] + ([logging.StreamHandler(sys.stdout)] if console else [])
+    formatter = logging.Formatter(log_format, date_format)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    records = queue.SimpleQueue()
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level)
+    root.propagate = False
+    listener = logging.handlers.QueueListener(records, *handlers)
+    listener.start()
+    threading.excepthook = log_thread_exception
+
+# Write out queued records and close the log file:
+def stop():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+        file_handler.close()
+
+atexit.register(stop)
+
+def log_thread_exception(args):
+    root.error(f'uncaught exception in thread {args.thread.name if args.thread else "?"}',
+               exc_info=(args.exc_type, args.exc_value, args.exc_traceback))
+
+# Record the duration of a sampled call, the count-th call of the function:
+def trace(name, seconds, count=None):
+    ms = seconds*1e3
+    with calls_lock:
+        stats = calls.get(name)
+        if stats is None:
+            stats = calls[name] = {'calls': 0, 'sampled': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+        stats['sampled'] += 1
+        stats['calls'] = max(stats['calls'], count or stats['sampled'])
+        stats['total_ms'] += ms
+        stats['max_ms'] = max(stats['max_ms'], ms)
+    if trace_log.isEnabledFor(logging.DEBUG):
+        trace_log.debug(f'call {name} duration_ms={ms:.3f}')
+
+# Per-function call statistics with mean durations of the sampled calls:
+def call_stats():
+    with calls_lock:
+        return({name: dict(stats, mean_ms=stats['total_ms']/stats['sampled'])
+                for (name, stats) in calls.items()})
+
+# Last `lines` lines of the log file at or above `level`, ending before
+# byte offset `before` (default: end of file), read backwards in blocks.
+# Returns (text, start, size): start is the byte offset of the first line
+# returned (pass it as `before` for the previous page):
+def tail(filename, lines=200, before=None, level=None, block_size=64*1024):
+    if not os.path.isfile(filename):
+        return('', 0, 0)
+    size = os.path.getsize(filename)
+    end = size if before is None else min(int(before), size)
+    min_level = levels.index(level) if level in levels else 0
+    selected = []       # selected lines, last first
+    with open(filename, 'rb') as f:
+        position = end
+        rest = b''      # incomplete first line of the data read so far
+        while position > 0 and len(selected) < lines:
+            start = max(position - block_size, 0)
+            f.seek(start)
+            data = f.read(position - start) + rest
+            position = start
+            parts = data.split(b'\n')
+            rest = parts.pop(0) if position > 0 else b''
+            offset = position + len(rest) + 1 if position > 0 else 0
+            offsets = []
+            for part in parts:
+                offsets.append(offset)
+                offset += len(part) + 1
+            for (offset, line) in zip(reversed(offsets), reversed(parts)):
+                if line and line_level(line) >= min_level:
+                    selected.append((offset, line))
+                    if len(selected) == lines:
+                        break
+    start = selected[-1][0] if len(selected) == lines else 0
+    text = b'\n'.join(line for (offset, line) in reversed(selected)).decode('utf-8', 'replace')
+    return(text, start, size)
+
+# Level index of a log line (continuation lines, e.g. tracebacks, count as
+# ERROR so they are kept with their record):
+def line_level(line):
+    fields = line.split(b' ', 3)
+    if len(fields) > 2 and fields[2].decode('ascii', 'replace') in levels:
+        return(levels.index(fields[2].decode('ascii')))
+    return(levels.index('ERROR'))
+
+# Truncate the log file and delete its backups:
+def clear(filename):
+    if file_handler is not None:
+        file_handler.acquire()
+        try:
+            if file_handler.stream is not None:
+                file_handler.stream.seek(0)
+                file_handler.stream.truncate()
+        finally:
+            file_handler.release()
+    else:
+        open(filename, 'w').close()
+    for i in range(1, 100):
+        backup = f'{filename}.{i}'
+        if not os.path.isfile(backup):
+            break
+        os.remove(backup)